@@ -0,0 +1,84 @@
+"""
+Micro-benchmark del middleware di autenticazione.
+Misura il costo per richiesta di AuthMiddleware (ASGI puro) rispetto a un'app vuota,
+per route pubblica, file statico, pagina HTML e API con utente già in cache.
+Non usa il database: l'utente del token viene inserito direttamente nella cache.
+
+Uso (dalla cartella principale del progetto):
+    python scripts/bench_auth_middleware.py [iterazioni]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wms_app.middleware.auth_middleware import AuthMiddleware
+from wms_app.services.auth_cache import AuthenticatedUser, authenticated_user_cache
+from wms_app.services.jwt_service import JWTService
+
+
+async def empty_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message):
+    pass
+
+
+def make_scope(path: str, token: str = None) -> dict:
+    headers = [(b"host", b"localhost")]
+    if token:
+        headers.append((b"authorization", f"Bearer {token}".encode()))
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": headers,
+        "scheme": "http",
+        "server": ("localhost", 8000),
+    }
+
+
+async def measure(app, scope: dict, iterations: int) -> float:
+    """Microsecondi medi per richiesta"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+
+async def main(iterations: int):
+    token = JWTService.create_access_token({"sub": "bench", "user_id": 0})
+    authenticated_user_cache.set(token, AuthenticatedUser(0, "bench", "bench@example.com", True, frozenset({"admin"})))
+
+    middleware = AuthMiddleware(empty_app)
+    cases = [
+        ("route pubblica /login", make_scope("/login")),
+        ("file statico /static/js/app.js", make_scope("/static/js/app.js")),
+        ("pagina HTML /inventory/manage", make_scope("/inventory/manage")),
+        ("API /api/auth/me (utente in cache)", make_scope("/api/auth/me", token)),
+    ]
+
+    baseline = await measure(empty_app, make_scope("/login"), iterations)
+    print(f"App vuota (baseline): {baseline:8.2f} µs/richiesta")
+    for name, scope in cases:
+        elapsed = await measure(middleware, scope, iterations)
+        print(f"{name:40s} {elapsed:8.2f} µs/richiesta (+{elapsed - baseline:.2f})")
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        middleware.is_public_route("/inventory/manage")
+    print(f"is_public_route (regex compilata):       {(time.perf_counter() - started) / iterations * 1_000_000:8.2f} µs")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,75 @@
+"""
+Benchmark del pianificatore di consolidamenti.
+Genera un magazzino sintetico (SKU con giacenze parziali sparse su più ubicazioni) e
+confronta il pianificatore a bin packing con il vecchio greedy "un solo target per SKU":
+ubicazioni liberate e tempo di pianificazione. Non usa il database.
+
+Uso (dalla cartella principale del progetto):
+    python scripts/bench_consolidation_planner.py [sku] [max_ubicazioni_per_sku] [seed]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wms_app.services.consolidation_planner import StockSlot, plan_sku_consolidation
+
+
+def greedy_single_target(slots, pallet_quantity):
+    """Algoritmo precedente: il miglior target singolo, riempito in ordine crescente"""
+    best = 0
+    for target in slots:
+        space = pallet_quantity - target.quantity
+        if space <= 0:
+            continue
+        moved = freed = 0
+        for slot in sorted((slot for slot in slots if slot is not target), key=lambda slot: slot.quantity):
+            if moved + slot.quantity <= space:
+                moved += slot.quantity
+                freed += 1
+        best = max(best, freed)
+    return best
+
+
+def build_warehouse(sku_count, max_locations, seed):
+    rng = random.Random(seed)
+    warehouse = []
+    for number in range(sku_count):
+        pallet_quantity = rng.choice([6, 12, 24, 40, 60, 100])
+        slots = []
+        for _ in range(rng.randint(2, max_locations)):
+            fila, campata = rng.randint(1, 30), chr(ord('A') + rng.randint(0, 11))
+            piano, posizione = rng.randint(1, 5), rng.randint(1, 4)
+            slots.append(StockSlot(f"{fila}{campata}{piano}P{posizione}", rng.randint(1, pallet_quantity),
+                                   fila, campata, piano, posizione))
+        warehouse.append((f"SKU-{number:05d}", pallet_quantity, slots))
+    return warehouse
+
+
+def run(sku_count, max_locations, seed):
+    warehouse = build_warehouse(sku_count, max_locations, seed)
+    locations = sum(len(slots) for _, _, slots in warehouse)
+
+    started = time.perf_counter()
+    greedy_freed = sum(greedy_single_target(slots, pallet_quantity) for _, pallet_quantity, slots in warehouse)
+    greedy_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    moves = [move for sku, pallet_quantity, slots in warehouse
+             for move in plan_sku_consolidation(sku, pallet_quantity, slots)]
+    planner_elapsed = time.perf_counter() - started
+    planner_freed = sum(move.locations_freed for move in moves)
+
+    print(f"{sku_count} SKU, {locations} ubicazioni (2..{max_locations} per SKU), seed {seed}")
+    print(f"  greedy target singolo  {greedy_freed:6d} ubicazioni liberate in {greedy_elapsed:.3f} s")
+    print(f"  bin packing            {planner_freed:6d} ubicazioni liberate in {planner_elapsed:.3f} s "
+          f"({len(moves)} consolidamenti)")
+
+
+if __name__ == "__main__":
+    sku_arg = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_locations_arg = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    seed_arg = int(sys.argv[3]) if len(sys.argv) > 3 else 42
+    run(sku_arg, max_locations_arg, seed_arg)
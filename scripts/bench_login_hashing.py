@@ -0,0 +1,100 @@
+"""
+Benchmark del login a inizio turno: N login contemporanei sullo stesso processo.
+Confronta il KDF eseguito direttamente nell'event loop (come faceva login prima del pool)
+con il pool dedicato di PasswordHasher, misurando throughput, latenze e il ritardo
+massimo dell'event loop (quanto resterebbero bloccate le altre richieste).
+Non usa il database: ogni "login" è la verify_and_update di un hash già calcolato.
+
+Uso (dalla cartella principale del progetto):
+    python scripts/bench_login_hashing.py [login_contemporanei] [workers]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wms_app.services.password_hasher import PasswordHasher, PasswordHasherBusy
+
+
+async def loop_lag_probe(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Ritardo massimo (ms) osservato da un task che dovrebbe svegliarsi ogni interval secondi"""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst * 1000
+
+
+async def run_burst(login, logins: int) -> dict:
+    latencies = []
+    rejected = 0
+
+    async def one_login():
+        nonlocal rejected
+        started = time.perf_counter()
+        try:
+            await login()
+        except PasswordHasherBusy:
+            rejected += 1
+            return
+        latencies.append(time.perf_counter() - started)
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(loop_lag_probe(stop))
+    await asyncio.sleep(0.02)
+    started = time.perf_counter()
+    await asyncio.gather(*(one_login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    max_lag_ms = await probe
+
+    latencies.sort()
+    return {
+        "elapsed_s": elapsed,
+        "logins_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000 if latencies else 0.0,
+        "max_loop_lag_ms": max_lag_ms,
+        "rejected": rejected,
+    }
+
+
+def print_result(label: str, result: dict):
+    print(
+        f"{label:<28} {result['elapsed_s']:>7.2f}s {result['logins_per_s']:>8.1f}/s "
+        f"p50 {result['p50_ms']:>8.1f} ms  p95 {result['p95_ms']:>8.1f} ms  "
+        f"lag loop {result['max_loop_lag_ms']:>8.1f} ms  rifiutati {result['rejected']}"
+    )
+
+
+async def main(logins: int, workers: int):
+    hasher = PasswordHasher(workers=workers, max_pending=logins)
+    stored_hash = hasher.hash("turno-mattina")
+    print(f"Schema {hasher.scheme}, {logins} login contemporanei, pool da {workers} thread\n")
+
+    async def inline_login():
+        hasher.verify_and_update("turno-mattina", stored_hash)
+
+    async def pooled_login():
+        await hasher.verify_and_update_async("turno-mattina", stored_hash)
+
+    print_result("KDF nell'event loop", await run_burst(inline_login, logins))
+    print_result(f"Pool dedicato ({workers} thread)", await run_burst(pooled_login, logins))
+
+    limited = PasswordHasher(workers=workers, max_pending=max(1, logins // 4))
+
+    async def limited_login():
+        await limited.verify_and_update_async("turno-mattina", stored_hash)
+
+    print_result(f"Pool con coda {max(1, logins // 4)}", await run_burst(limited_login, logins))
+    hasher.shutdown()
+    limited.shutdown()
+
+
+if __name__ == "__main__":
+    burst = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    pool_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    asyncio.run(main(burst, pool_workers))
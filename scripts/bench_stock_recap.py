@@ -0,0 +1,90 @@
+"""
+Benchmark del recap di carico/scarico da file scanner.
+Genera un file sintetico (default 10.000 righe) con ubicazioni, EAN e SKU presi dal
+database configurato e misura _build_add_stock_recap / _build_subtract_stock_recap:
+tempo, numero di query SQL e tempo speso nel database. Non scrive nulla.
+
+Uso (dalla cartella principale del progetto):
+    python scripts/bench_stock_recap.py [righe] [ripetizioni]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wms_app.database.database import SessionLocal
+from wms_app.database.instrumentation import (
+    get_request_stats,
+    install_query_instrumentation,
+    reset_request_stats,
+    start_request_stats,
+)
+from wms_app.models.inventory import Inventory, Location
+from wms_app.models.products import EanCode, Product
+from wms_app.routers.inventory import _build_add_stock_recap, _build_subtract_stock_recap
+
+
+def build_scanner_file(db, line_count: int, seed: int = 42) -> list:
+    """Ubicazioni (metà con giacenza) seguite da blocchi di EAN/SKU, con qualche SKU_QTY e codici errati"""
+    rng = random.Random(seed)
+    stocked = [name for (name,) in db.query(Inventory.location_name).filter(Inventory.quantity > 0).distinct().limit(200)]
+    locations = stocked + [name for (name,) in db.query(Location.name).limit(200)]
+    codes = [ean for (ean,) in db.query(EanCode.ean)] + [sku for (sku,) in db.query(Product.sku)]
+    if not locations or not codes:
+        raise SystemExit("Database senza ubicazioni o prodotti: niente da misurare")
+
+    lines = []
+    while len(lines) < line_count:
+        lines.append(rng.choice(locations))
+        for _ in range(rng.randint(1, 40)):
+            roll = rng.random()
+            if roll < 0.1:
+                lines.append(f"{rng.choice(codes)}_{rng.randint(2, 24)}")
+            elif roll < 0.12:
+                lines.append("CODICE_SCONOSCIUTO")
+            else:
+                lines.append(rng.choice(codes))
+    return lines[:line_count]
+
+
+def measure(builder, lines, repetitions: int):
+    timings = []
+    for _ in range(repetitions):
+        db = SessionLocal()
+        token = start_request_stats()
+        try:
+            started = time.perf_counter()
+            result = builder(lines, db)
+            timings.append(time.perf_counter() - started)
+            stats = get_request_stats()
+        finally:
+            reset_request_stats(token)
+            db.close()
+    timings.sort()
+    return timings[len(timings) // 2], stats, result
+
+
+def main(line_count: int, repetitions: int):
+    install_query_instrumentation()
+    db = SessionLocal()
+    try:
+        lines = build_scanner_file(db, line_count)
+    finally:
+        db.close()
+
+    print(f"File sintetico: {len(lines)} righe, mediana su {repetitions} ripetizioni\n")
+    for label, builder in (("carico", _build_add_stock_recap), ("scarico", _build_subtract_stock_recap)):
+        median, stats, result = measure(builder, lines, repetitions)
+        print(
+            f"{label:<8} {median * 1000:>9.1f} ms  query {stats.statement_count:>6}  "
+            f"db {stats.db_time_ms:>8.1f} ms  recap {len(result['recap_items']):>5}  "
+            f"errori {len(result['errors']):>5}  warning {len(result['warnings']):>5}"
+        )
+
+
+if __name__ == "__main__":
+    lines_arg = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    repetitions_arg = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    main(lines_arg, repetitions_arg)
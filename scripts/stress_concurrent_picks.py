@@ -0,0 +1,167 @@
+"""
+Stress test della concorrenza ottimistica su una riga di giacenza "calda".
+Crea l'ubicazione STRESS_TEST con una giacenza del primo prodotto a catalogo e lancia
+in parallelo N thread (un palmare ciascuno) che prelevano 1 pezzo alla volta dalla stessa
+riga, ognuno con la propria sessione:
+
+- modalità "cas" (default): batch di InventoryMutationService (UPDATE/DELETE versionati)
+  con run_with_retry, come gli endpoint di prelievo; nessun aggiornamento perso, i
+  conflitti vengono ripetuti;
+- modalità "naive": lettura e UPDATE ... SET quantity = ? senza controllo di versione,
+  per confronto: i prelievi concorrenti si sovrascrivono.
+
+Alla fine verifica che giacenza finale = iniziale - prelievi riusciti e rimuove i dati di
+prova. Scrive sul database configurato: eseguirlo su una copia.
+
+Uso (dalla cartella principale del progetto):
+    python scripts/stress_concurrent_picks.py [thread] [prelievi_per_thread] [cas|naive]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, select, update
+
+from wms_app.database.database import SessionLocal
+from wms_app.models.inventory import Inventory, Location, StockMovement
+from wms_app.models.products import Product
+from wms_app.services.inventory_mutation_service import InventoryMutationService
+from wms_app.services.optimistic_lock import run_with_retry
+from wms_app.services.stock_ledger import install_stock_ledger, set_ledger_context
+
+STRESS_LOCATION = "STRESS_TEST"
+STRESS_REASON = "STRESS_TEST"
+
+
+class PickStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.picked = 0
+        self.attempts = 0
+        self.conflicts = 0  # prelievi abbandonati con 409 dopo i tentativi
+        self.out_of_stock = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+
+def setup(quantity: int) -> str:
+    db = SessionLocal()
+    try:
+        sku = db.execute(select(Product.sku).order_by(Product.sku).limit(1)).scalar()
+        if sku is None:
+            raise SystemExit("Catalogo vuoto: serve almeno un prodotto")
+        cleanup(db)
+        set_ledger_context(db, STRESS_REASON)
+        db.add(Location(name=STRESS_LOCATION, available=True))
+        db.add(Inventory(location_name=STRESS_LOCATION, product_sku=sku, quantity=quantity))
+        db.commit()
+        return sku
+    finally:
+        db.close()
+
+
+def cleanup(db):
+    db.execute(delete(Inventory.__table__).where(Inventory.location_name == STRESS_LOCATION))
+    db.execute(delete(Location.__table__).where(Location.name == STRESS_LOCATION))
+    db.execute(delete(StockMovement.__table__).where(StockMovement.reason == STRESS_REASON))
+    db.commit()
+
+
+def pick_cas(sku: str, stats: PickStats):
+    db = SessionLocal()
+    attempts = 0
+
+    def apply_pick():
+        nonlocal attempts
+        attempts += 1
+        batch = InventoryMutationService.batch(db, STRESS_REASON)
+        if not batch.adjust(STRESS_LOCATION, sku, -1).ok:
+            db.rollback()
+            return False
+        batch.apply()
+        db.commit()
+        return True
+
+    try:
+        picked = run_with_retry(db, apply_pick)
+        stats.add(picked=int(picked), out_of_stock=int(not picked), attempts=attempts)
+    except HTTPException:
+        stats.add(conflicts=1, attempts=attempts)
+    finally:
+        db.close()
+
+
+def pick_naive(sku: str, stats: PickStats):
+    db = SessionLocal()
+    try:
+        table = Inventory.__table__
+        where = (table.c.location_name == STRESS_LOCATION, table.c.product_sku == sku)
+        quantity = db.execute(select(table.c.quantity).where(*where)).scalar()
+        if not quantity:
+            stats.add(out_of_stock=1, attempts=1)
+            return
+        db.execute(update(table).where(*where).values(quantity=quantity - 1))
+        db.commit()
+        stats.add(picked=1, attempts=1)
+    finally:
+        db.close()
+
+
+def run(threads: int, picks_per_thread: int, mode: str):
+    install_stock_ledger()
+    initial = threads * picks_per_thread
+    sku = setup(initial)
+    stats = PickStats()
+    pick = pick_cas if mode == "cas" else pick_naive
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        barrier.wait()
+        for _ in range(picks_per_thread):
+            pick(sku, stats)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    db = SessionLocal()
+    try:
+        final = db.execute(select(Inventory.quantity).where(
+            Inventory.location_name == STRESS_LOCATION, Inventory.product_sku == sku
+        )).scalar() or 0
+        lost_updates = final - (initial - stats.picked)
+        ledger_picked = db.execute(select(func.coalesce(func.sum(StockMovement.quantity), 0)).where(
+            StockMovement.reason == STRESS_REASON, StockMovement.location_from == STRESS_LOCATION
+        )).scalar()
+        print(f"Modalità {mode}: {threads} thread x {picks_per_thread} prelievi su {sku}@{STRESS_LOCATION}")
+        print(f"  tempo            {elapsed:.2f} s ({stats.picked / elapsed:.0f} prelievi/s)")
+        print(f"  prelievi riusciti {stats.picked}, tentativi {stats.attempts}, "
+              f"ripetuti {stats.attempts - stats.picked - stats.conflicts - stats.out_of_stock}, "
+              f"409 {stats.conflicts}, senza giacenza {stats.out_of_stock}")
+        print(f"  giacenza iniziale {initial}, finale {final}, attesa {initial - stats.picked}")
+        print(f"  aggiornamenti persi: {lost_updates}, prelievi nel registro movimenti: {ledger_picked}")
+        cleanup(db)
+    finally:
+        db.close()
+    return lost_updates
+
+
+if __name__ == "__main__":
+    threads_arg = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    picks_arg = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    mode_arg = sys.argv[3] if len(sys.argv) > 3 else "cas"
+    if mode_arg not in ("cas", "naive"):
+        raise SystemExit("Modalità non valida: usare 'cas' o 'naive'")
+    lost = run(threads_arg, picks_arg, mode_arg)
+    sys.exit(1 if mode_arg == "cas" and lost else 0)
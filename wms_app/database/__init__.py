@@ -1,4 +1,4 @@
 # Questo file rende la cartella 'database' un pacchetto Python.
 
 # Esponiamo gli elementi importanti dal file database.py
-from .database import Base, engine, get_db, SessionLocal
\ No newline at end of file
+from .database import Base, engine, get_db, SessionLocal, get_request_session, close_request_session, get_write_lock, get_read_db, read_engine, async_engine, get_async_db, AsyncSessionLocal
\ No newline at end of file
@@ -1,26 +1,324 @@
-from sqlalchemy import create_engine
+import asyncio
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+
+from fastapi import HTTPException, Request, status
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+
+# URL del database: letto da DATABASE_URL (es. postgresql://user:pwd@db:5432/wms_db)
+# Se non impostato si usa il file SQLite nella cartella principale del progetto (sviluppo)
+DEFAULT_DATABASE_URL = "sqlite:///./wms.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL)
+
+# Alcuni provider espongono ancora lo schema "postgres://", non più accettato da SQLAlchemy 2
+if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
+    SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+# URL per il motore asincrono (aiosqlite / asyncpg): se non impostato si deriva da DATABASE_URL
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+
+# URL per le sole letture pesanti (report, analisi, log): tipicamente una replica PostgreSQL.
+# Se non impostato si usa lo stesso database (su SQLite con un pool di connessioni in sola lettura)
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL")
+if READ_DATABASE_URL and READ_DATABASE_URL.startswith("postgres://"):
+    READ_DATABASE_URL = READ_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+# Parametri del pool di connessioni (solo PostgreSQL / server database)
+# Con il postgres di docker-compose (max_connections=100) i default lasciano margine
+# per più worker uvicorn: pool_size + max_overflow connessioni per processo
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))  # secondi di attesa per una connessione libera
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # ricicla le connessioni dopo 30 minuti
+DB_ECHO = os.getenv("DB_ECHO", "False").lower() == "true"
+
+# Profilo SQLite di produzione (applicato ad ogni nuova connessione)
+# WAL permette alle letture (es. dashboard /analysis) di procedere mentre è in corso una scrittura
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # sicuro con WAL, molto più veloce di FULL
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))  # attesa sul lock invece di "database is locked"
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 65536))  # 64 MB di page cache per connessione
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))  # 256 MB di I/O memory-mapped
+
+# Serializzazione delle scritture nel processo: SQLite ammette un solo writer alla volta e una
+# transazione che passa da lettura a scrittura fallisce subito con SQLITE_BUSY senza attendere
+# il busy_timeout. Le operazioni di scrittura più frequenti si mettono quindi in coda qui.
+SQLITE_WRITE_LOCK = os.getenv("SQLITE_WRITE_LOCK", "True").lower() == "true"
+SQLITE_WRITE_LOCK_TIMEOUT = float(os.getenv("SQLITE_WRITE_LOCK_TIMEOUT", 30))  # secondi
+
+
+def is_sqlite_url(url: str) -> bool:
+    """Indica se l'URL punta a un database SQLite"""
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Imposta i PRAGMA del profilo SQLite su ogni nuova connessione DBAPI"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")  # valore negativo = KiB
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+
+def create_wms_engine(url: str = SQLALCHEMY_DATABASE_URL):
+    """
+    Crea il "motore" di SQLAlchemy con il profilo adatto al backend.
+
+    - SQLite: connessione condivisa tra thread, PRAGMA del profilo (WAL, cache, mmap) su ogni connessione
+    - PostgreSQL (produzione): QueuePool dimensionato con pre-ping e riciclo connessioni
+    """
+    if is_sqlite_url(url):
+        database = make_url(url).database
+        if not database or database == ":memory:":
+            # Database in memoria: una sola connessione condivisa, altrimenti ogni
+            # connessione vedrebbe un database vuoto diverso
+            return create_engine(
+                url,
+                echo=DB_ECHO,
+                connect_args={"check_same_thread": False},
+                poolclass=StaticPool,
+            )
+        sqlite_engine = create_engine(
+            url,
+            echo=DB_ECHO,
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(sqlite_engine, "connect", _apply_sqlite_pragmas)
+        return sqlite_engine
+
+    return create_engine(
+        url,
+        echo=DB_ECHO,
+        poolclass=QueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,  # scarta connessioni chiuse dal server (restart, idle timeout)
+    )
+
+
+def _apply_sqlite_read_pragmas(dbapi_connection, connection_record):
+    """PRAGMA delle connessioni di sola lettura: qualsiasi scrittura fallisce"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+def create_wms_read_engine(url: str):
+    """
+    Crea il motore per le letture pesanti.
+
+    - SQLite: pool separato sullo stesso file con query_only; in WAL i lettori vedono uno
+      snapshot consistente e non bloccano lo scrittore (picking, carichi)
+    - PostgreSQL: stesso profilo del motore principale, puntato sulla replica
+    """
+    read_engine = create_wms_engine(url)
+    if is_sqlite_url(url):
+        event.listen(read_engine, "connect", _apply_sqlite_read_pragmas)
+    return read_engine
+
+
+def to_async_url(url: str) -> str:
+    """Converte l'URL sincrono nell'equivalente con driver asincrono"""
+    parsed_url = make_url(url)
+    backend = parsed_url.get_backend_name()
+    if backend == "sqlite":
+        return parsed_url.set(drivername="sqlite+aiosqlite").render_as_string(hide_password=False)
+    if backend == "postgresql":
+        return parsed_url.set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+    raise ValueError(f"Backend database non supportato in modalità asincrona: {backend}")
+
+
+def create_wms_async_engine(url: str):
+    """
+    Crea il motore asincrono con lo stesso profilo di quello sincrono
+    (PRAGMA su SQLite, pool dimensionato con pre-ping su PostgreSQL).
+    """
+    if is_sqlite_url(url):
+        database = make_url(url).database
+        if not database or database == ":memory:":
+            return create_async_engine(url, echo=DB_ECHO, poolclass=StaticPool)
+        async_sqlite_engine = create_async_engine(url, echo=DB_ECHO)
+        event.listen(async_sqlite_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+        return async_sqlite_engine
+
+    return create_async_engine(
+        url,
+        echo=DB_ECHO,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
 
-# Percorso del file del database SQLite
-# Il database verrà creato nella cartella principale del progetto
-SQLALCHEMY_DATABASE_URL = "sqlite:///./wms.db"
 
 # Crea il "motore" di SQLAlchemy per connettersi al database
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = create_wms_engine(SQLALCHEMY_DATABASE_URL)
+IS_SQLITE = is_sqlite_url(SQLALCHEMY_DATABASE_URL)
+
+# Motore per le letture pesanti: replica se configurata, altrimenti connessioni in sola
+# lettura su SQLite o lo stesso motore su PostgreSQL senza replica
+if READ_DATABASE_URL:
+    read_engine = create_wms_read_engine(READ_DATABASE_URL)
+elif IS_SQLITE and make_url(SQLALCHEMY_DATABASE_URL).database not in (None, "", ":memory:"):
+    read_engine = create_wms_read_engine(SQLALCHEMY_DATABASE_URL)
+else:
+    read_engine = engine
+
+# Motore asincrono per gli endpoint async def: le query non bloccano l'event loop
+async_engine = create_wms_async_engine(ASYNC_DATABASE_URL or to_async_url(SQLALCHEMY_DATABASE_URL))
+
+
+def dispose_engines():
+    """
+    Scarta le connessioni inattive dei pool (dopo un ripristino del database): le
+    successive ripartono dal file ripristinato. Le connessioni in uso restano valide fino
+    alla restituzione al pool. Per il motore asincrono il pool viene solo sganciato: le sue
+    connessioni vanno chiuse dall'event loop che le ha aperte.
+    """
+    engine.dispose()
+    if read_engine is not engine:
+        read_engine.dispose()
+    async_engine.sync_engine.dispose(close=False)
 
 # Crea una sessione per le transazioni con il database
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Sessioni per report e consultazioni (nessuna scrittura)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
 # Una classe base per i nostri modelli di dati (le tabelle)
 Base = declarative_base()
 
+# Sessioni asincrone: expire_on_commit=False evita lazy load impliciti dopo il commit,
+# non consentiti con AsyncSession
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Sessione unica per richiesta: creata alla prima necessità e condivisa tramite request.state
+# tra middleware di autenticazione, dependency di permesso e rotta
+def get_request_session(request: Request):
+    db = getattr(request.state, "db", None)
+    if db is None:
+        db = SessionLocal()
+        request.state.db = db
+    return db
+
+def close_request_session(request: Request):
+    db = getattr(request.state, "db", None)
+    if db is not None:
+        request.state.db = None
+        db.close()
+
 # Funzione per ottenere una sessione del database
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    if getattr(request.state, "db", None) is not None:
+        # Sessione già aperta dal middleware: la chiude chi l'ha creata
+        yield request.state.db
+        return
+    db = get_request_session(request)
+    try:
+        yield db
+    finally:
+        close_request_session(request)
+
+# Funzione per ottenere una sessione di sola lettura (analisi, log, storico prodotto).
+# Con una replica i dati possono essere in ritardo di qualche istante: non usarla
+# per letture che precedono una scrittura
+def get_read_db():
+    db = ReadSessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+# Funzione per ottenere una sessione asincrona del database (endpoint async def)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Lock di processo per le scritture su SQLite (threading.Lock: lo condividono le richieste
+# e i job dello scheduler, che girano in thread)
+_sqlite_write_lock = threading.Lock()
+
+# Coda delle richieste in attesa del lock, una per event loop: chi attende resta sull'event
+# loop e non occupa un token del threadpool, che serve a chi detiene il lock per lavorare
+_async_write_queues = weakref.WeakKeyDictionary()
+
+# Intervallo di ripetuta del tentativo sul lock di processo (secondi)
+_WRITE_LOCK_POLL_INTERVAL = 0.005
+
+
+def _write_lock_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Database occupato da altre operazioni di scrittura, riprova tra qualche secondo."
+    )
+
+
+@contextmanager
+def serialized_write():
+    """
+    Context manager che serializza le scritture nel processo quando il backend è SQLite.
+    Con PostgreSQL (o con SQLITE_WRITE_LOCK=False) non fa nulla. Blocca il thread
+    chiamante: dagli endpoint usare la dependency get_write_lock.
+    """
+    if not (IS_SQLITE and SQLITE_WRITE_LOCK):
+        yield
+        return
+
+    if not _sqlite_write_lock.acquire(timeout=SQLITE_WRITE_LOCK_TIMEOUT):
+        raise _write_lock_busy()
+    try:
+        yield
+    finally:
+        _sqlite_write_lock.release()
+
+
+# Dependency per le rotte che scrivono in modo intensivo: le richieste si accodano su un
+# asyncio.Lock e solo la prima prova il lock di processo, senza bloccare né l'event loop
+# né un thread del threadpool
+async def get_write_lock():
+    if not (IS_SQLITE and SQLITE_WRITE_LOCK):
+        yield
+        return
+
+    loop = asyncio.get_running_loop()
+    queue = _async_write_queues.get(loop)
+    if queue is None:
+        queue = _async_write_queues[loop] = asyncio.Lock()
+    deadline = loop.time() + SQLITE_WRITE_LOCK_TIMEOUT
+
+    try:
+        await asyncio.wait_for(queue.acquire(), timeout=SQLITE_WRITE_LOCK_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise _write_lock_busy()
+    try:
+        # Il lock di processo può essere tenuto da un job dello scheduler
+        while not _sqlite_write_lock.acquire(blocking=False):
+            if loop.time() >= deadline:
+                raise _write_lock_busy()
+            await asyncio.sleep(_WRITE_LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            _sqlite_write_lock.release()
+    finally:
+        queue.release()
@@ -0,0 +1,201 @@
+"""
+Strumentazione SQL per richiesta.
+Gli hook sugli eventi dei motori SQLAlchemy contano gli statement e il tempo speso nel
+database per ogni richiesta HTTP; i totali finiscono nell'header Server-Timing e in una
+tabella in memoria per endpoint (ultime QUERY_METRICS_WINDOW richieste).
+
+Se una richiesta esegue la stessa forma di statement più di QUERY_NPLUS1_THRESHOLD volte
+viene registrato un warning: è il segnale tipico di un N+1 (una query per riga di file,
+per SKU, per ubicazione...).
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from wms_app.database.slow_query_log import is_capturing_plan, slow_query_log
+
+logger = logging.getLogger(__name__)
+
+QUERY_METRICS_ENABLED = os.getenv("QUERY_METRICS_ENABLED", "True").lower() == "true"
+QUERY_METRICS_WINDOW = int(os.getenv("QUERY_METRICS_WINDOW", 200))  # richieste conservate per endpoint
+QUERY_NPLUS1_THRESHOLD = int(os.getenv("QUERY_NPLUS1_THRESHOLD", 20))  # ripetizioni della stessa query
+
+
+class RequestQueryStats:
+    """Contatori SQL di una singola richiesta"""
+
+    __slots__ = ("statement_count", "db_time", "statement_shapes", "scope")
+
+    def __init__(self, scope: Optional[dict] = None):
+        self.scope = scope  # scope ASGI: dopo il routing contiene la rotta che ha originato la query
+        self.statement_count = 0
+        self.db_time = 0.0  # secondi
+        self.statement_shapes = Counter()
+
+    @property
+    def db_time_ms(self) -> float:
+        return self.db_time * 1000
+
+    def repeated_statements(self, threshold: int = QUERY_NPLUS1_THRESHOLD) -> List[Dict[str, Any]]:
+        """Statement eseguiti più di threshold volte nella richiesta (sospetti N+1)"""
+        return [
+            {"statement": statement, "count": count}
+            for statement, count in self.statement_shapes.most_common()
+            if count > threshold
+        ]
+
+
+# Statistiche della richiesta in corso: il ContextVar viene copiato nei thread del
+# threadpool (endpoint sync) e nei task, l'oggetto mutabile resta condiviso
+# Segnaposto per le richieste che non hanno risolto una rotta
+UNMATCHED_ROUTE = "<unmatched>"
+
+_current_request_stats: ContextVar[Optional[RequestQueryStats]] = ContextVar("current_request_stats", default=None)
+
+
+def start_request_stats(scope: Optional[dict] = None) -> Any:
+    """Attiva la raccolta per la richiesta corrente; restituisce il token per il reset"""
+    return _current_request_stats.set(RequestQueryStats(scope))
+
+
+def get_request_stats() -> Optional[RequestQueryStats]:
+    """Statistiche della richiesta corrente (None fuori da una richiesta)"""
+    return _current_request_stats.get()
+
+
+def reset_request_stats(token: Any):
+    _current_request_stats.reset(token)
+
+
+def endpoint_name(scope: Optional[dict]) -> Optional[str]:
+    """
+    Metodo + template della rotta (es. GET /products/{sku}/history). Le richieste senza
+    rotta (404, rifiutate prima del routing) finiscono tutte in "<METODO> <unmatched>":
+    il path grezzo farebbe crescere senza limite le chiavi delle metriche.
+    """
+    if not scope:
+        return None
+    path = getattr(scope.get("route"), "path", None) or UNMATCHED_ROUTE
+    return f"{scope.get('method', '')} {path}"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_request_stats.get() is None and slow_query_log is None:
+        return
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get("query_start_time")
+    if not start_times:
+        return
+    elapsed = time.perf_counter() - start_times.pop()
+    if is_capturing_plan():
+        return
+
+    stats = _current_request_stats.get()
+    if stats is not None:
+        stats.statement_count += 1
+        stats.db_time += elapsed
+        # Lo statement compilato ha già i parametri come segnaposto: il testo è la "forma" della query
+        stats.statement_shapes[statement] += 1
+
+    if slow_query_log is not None:
+        slow_query_log.record(
+            conn, statement, parameters, executemany, elapsed * 1000,
+            route=endpoint_name(stats.scope) if stats is not None else None
+        )
+
+
+def _handle_error(exception_context):
+    # Uno statement fallito non passa da after_cursor_execute: scarta il suo tempo di inizio
+    start_times = exception_context.connection.info.get("query_start_time") if exception_context.connection else None
+    if start_times:
+        start_times.pop()
+
+
+_instrumentation_installed = False
+
+
+def install_query_instrumentation():
+    """
+    Registra gli hook su tutti i motori (sincroni, di lettura e il sync_engine degli async).
+    Servono sia alle metriche per richiesta sia allo slow query log.
+    """
+    global _instrumentation_installed
+    if _instrumentation_installed:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+    _instrumentation_installed = True
+
+
+class EndpointMetricsTable:
+    """Tabella a finestra mobile dei costi SQL per endpoint"""
+
+    def __init__(self, window: int = QUERY_METRICS_WINDOW):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._nplus1_warnings: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, stats: RequestQueryStats, total_time_ms: float, nplus1_detected: bool = False):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append((stats.statement_count, stats.db_time_ms, total_time_ms))
+            if nplus1_detected:
+                self._nplus1_warnings[endpoint] += 1
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Riepilogo per endpoint, ordinato per tempo database medio decrescente"""
+        with self._lock:
+            items = [(endpoint, list(samples)) for endpoint, samples in self._samples.items()]
+            nplus1_warnings = dict(self._nplus1_warnings)
+
+        report = []
+        for endpoint, samples in items:
+            statements = [sample[0] for sample in samples]
+            db_times = sorted(sample[1] for sample in samples)
+            total_times = [sample[2] for sample in samples]
+            requests = len(samples)
+            report.append({
+                "endpoint": endpoint,
+                "requests": requests,
+                "avg_statements": round(sum(statements) / requests, 1),
+                "max_statements": max(statements),
+                "avg_db_ms": round(sum(db_times) / requests, 2),
+                "p95_db_ms": round(db_times[min(requests - 1, int(requests * 0.95))], 2),
+                "avg_total_ms": round(sum(total_times) / requests, 2),
+                "nplus1_warnings": nplus1_warnings.get(endpoint, 0),
+            })
+        report.sort(key=lambda item: item["avg_db_ms"], reverse=True)
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+            self._nplus1_warnings.clear()
+
+
+endpoint_metrics = EndpointMetricsTable()
+
+
+def report_nplus1(endpoint: str, stats: RequestQueryStats) -> bool:
+    """Registra un warning per gli statement ripetuti oltre soglia; True se trovati"""
+    repeated = stats.repeated_statements()
+    for item in repeated[:3]:
+        logger.warning(
+            f"⚠️ Possibile N+1 su {endpoint}: statement eseguito {item['count']} volte "
+            f"({stats.statement_count} query totali): {item['statement'][:200]}"
+        )
+    return bool(repeated)
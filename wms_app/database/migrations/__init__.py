@@ -0,0 +1,12 @@
+# Migrazioni versionate dello schema del database
+from .runner import (
+    MIGRATIONS,
+    SchemaVersionError,
+    get_current_version,
+    get_latest_version,
+    get_pending_migrations,
+    read_schema_version,
+    schema_version_table,
+    upgrade,
+    verify_schema,
+)
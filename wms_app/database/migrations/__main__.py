@@ -0,0 +1,89 @@
+"""
+Entry point a riga di comando per le migrazioni dello schema.
+
+Uso:
+    python -m wms_app.database.migrations upgrade [--to VERSIONE]
+    python -m wms_app.database.migrations current
+    python -m wms_app.database.migrations status
+    python -m wms_app.database.migrations check
+"""
+import argparse
+import sys
+
+from sqlalchemy import select
+
+from wms_app.database.database import engine
+from wms_app.database.migrations.runner import (
+    MIGRATIONS,
+    get_current_version,
+    get_latest_version,
+    schema_version_table,
+    upgrade,
+)
+from wms_app.database.query_plans import check_hot_queries
+
+
+def cmd_upgrade(args) -> int:
+    before = _current_version()
+    applied = upgrade(engine, target_version=args.to)
+    if applied:
+        print(f"✅ Schema aggiornato dalla versione {before} alla {_current_version()} (applicate: {applied})")
+    else:
+        print(f"✅ Schema già aggiornato alla versione {before}")
+    return 0
+
+
+def cmd_current(args) -> int:
+    print(f"Versione database: {_current_version()} - versione codice: {get_latest_version()}")
+    return 0
+
+
+def cmd_status(args) -> int:
+    with engine.connect() as connection:
+        applied = {}
+        if get_current_version(connection) > 0:
+            rows = connection.execute(select(schema_version_table)).fetchall()
+            applied = {row.version: row.applied_at for row in rows}
+
+    for migration in MIGRATIONS:
+        if migration.VERSION in applied:
+            print(f"  [x] {migration.VERSION:03d} {migration.DESCRIPTION} ({applied[migration.VERSION]})")
+        else:
+            print(f"  [ ] {migration.VERSION:03d} {migration.DESCRIPTION}")
+    return 0
+
+
+def cmd_check(args) -> int:
+    with engine.connect() as connection:
+        report = check_hot_queries(connection)
+
+    print(f"Dialetto: {report['dialect']} - query su indice: {report['using_index']}/{report['total_queries']}")
+    for query in report["queries"]:
+        marker = "✅" if query["uses_index"] else "❌"
+        print(f"{marker} {query['name']}: {' | '.join(query['plan']) or query.get('error', '')}")
+    return 0 if not report["full_scans"] else 1
+
+
+def _current_version() -> int:
+    with engine.connect() as connection:
+        return get_current_version(connection)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m wms_app.database.migrations", description="Migrazioni schema WMS")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    upgrade_parser = subparsers.add_parser("upgrade", help="Applica le migrazioni in sospeso")
+    upgrade_parser.add_argument("--to", type=int, default=None, help="Versione di destinazione (default: ultima)")
+    upgrade_parser.set_defaults(func=cmd_upgrade)
+
+    subparsers.add_parser("current", help="Mostra la versione dello schema").set_defaults(func=cmd_current)
+    subparsers.add_parser("status", help="Elenca migrazioni applicate e in sospeso").set_defaults(func=cmd_status)
+    subparsers.add_parser("check", help="Verifica l'uso degli indici sulle query hot path").set_defaults(func=cmd_check)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Runner delle migrazioni versionate dello schema WMS.
+Ogni migrazione è un modulo con VERSION, DESCRIPTION e una funzione upgrade(connection);
+le versioni applicate vengono registrate nella tabella schema_version.
+
+Le migrazioni devono essere idempotenti (IF NOT EXISTS, checkfirst, controllo colonne):
+su un database precedente al sistema di migrazioni vengono prima create le tabelle
+mancanti dai modelli e poi applicate tutte le migrazioni.
+"""
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from . import versions
+
+# Tabella di servizio separata dai modelli applicativi
+schema_metadata = MetaData()
+
+schema_version_table = Table(
+    "schema_version",
+    schema_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False, default=datetime.utcnow),
+)
+
+# Migrazioni registrate, in ordine di versione
+MIGRATIONS = sorted(versions.ALL_MIGRATIONS, key=lambda migration: migration.VERSION)
+
+# Tabella usata per riconoscere un database creato prima del sistema di migrazioni
+LEGACY_MARKER_TABLE = "inventory"
+
+
+class SchemaVersionError(RuntimeError):
+    """Lo schema del database non corrisponde alla versione attesa dal codice"""
+
+
+def get_latest_version() -> int:
+    """Versione dello schema attesa dal codice"""
+    return MIGRATIONS[-1].VERSION if MIGRATIONS else 0
+
+
+def get_model_metadata() -> List[MetaData]:
+    """Metadata di tutti i modelli (i log usano una Base dichiarativa separata)"""
+    from wms_app.database.database import Base
+    from wms_app import models  # noqa: F401 - registra i modelli sulla Base
+    from wms_app.models import auth  # noqa: F401
+    from wms_app.models import logs
+
+    return [Base.metadata, logs.Base.metadata]
+
+
+def get_current_version(connection: Connection) -> int:
+    """Versione dello schema registrata nel database (0 se mai migrato)"""
+    if not inspect(connection).has_table(schema_version_table.name):
+        return 0
+    versions_applied = connection.execute(select(schema_version_table.c.version)).scalars().all()
+    return max(versions_applied, default=0)
+
+
+def get_pending_migrations(connection: Connection) -> list:
+    """Migrazioni non ancora applicate al database"""
+    current_version = get_current_version(connection)
+    return [migration for migration in MIGRATIONS if migration.VERSION > current_version]
+
+
+def _record_version(connection: Connection, migration):
+    connection.execute(schema_version_table.insert().values(
+        version=migration.VERSION,
+        description=migration.DESCRIPTION,
+        applied_at=datetime.utcnow()
+    ))
+
+
+def _is_version_recorded(engine: Engine, version: int) -> bool:
+    with engine.connect() as connection:
+        return connection.execute(
+            select(schema_version_table.c.version).where(schema_version_table.c.version == version)
+        ).first() is not None
+
+
+def upgrade(engine: Engine, target_version: Optional[int] = None) -> List[int]:
+    """
+    Porta lo schema a target_version (default: ultima versione).
+
+    - Database vuoto: crea tutte le tabelle dai modelli (già allineati all'ultima
+      versione) e registra tutte le migrazioni come applicate.
+    - Database esistente: crea le tabelle mancanti e applica le migrazioni in sospeso,
+      ognuna nella propria transazione insieme alla registrazione della versione.
+
+    Returns:
+        List[int]: Versioni registrate durante l'esecuzione
+    """
+    with engine.connect() as connection:
+        is_empty_database = not inspect(connection).has_table(LEGACY_MARKER_TABLE)
+
+    schema_metadata.create_all(bind=engine, checkfirst=True)
+
+    if is_empty_database and target_version is None:
+        with engine.begin() as connection:
+            for metadata in get_model_metadata():
+                metadata.create_all(bind=connection, checkfirst=True)
+            for migration in MIGRATIONS:
+                _record_version(connection, migration)
+        return [migration.VERSION for migration in MIGRATIONS]
+
+    with engine.begin() as connection:
+        for metadata in get_model_metadata():
+            metadata.create_all(bind=connection, checkfirst=True)
+
+    with engine.connect() as connection:
+        pending = get_pending_migrations(connection)
+
+    applied = []
+    for migration in pending:
+        if target_version is not None and migration.VERSION > target_version:
+            break
+        try:
+            with engine.begin() as connection:
+                migration.upgrade(connection)
+                _record_version(connection, migration)
+        except IntegrityError:
+            # Ignorato solo se un altro processo ha registrato la stessa versione nel
+            # frattempo: gli errori della migrazione stessa (es. indice unico su righe
+            # duplicate) devono fermare l'aggiornamento
+            if not _is_version_recorded(engine, migration.VERSION):
+                raise
+            continue
+        applied.append(migration.VERSION)
+
+    return applied
+
+
+def read_schema_version(engine: Engine) -> int:
+    """
+    Lettura economica della versione corrente, senza reflection dello schema:
+    usata all'avvio di ogni worker.
+    """
+    try:
+        with engine.connect() as connection:
+            return connection.execute(
+                select(func.max(schema_version_table.c.version))
+            ).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        # Tabella schema_version assente: database mai migrato
+        return 0
+
+
+def verify_schema(engine: Engine, auto_migrate: Optional[bool] = None) -> int:
+    """
+    Verifica all'avvio che il database sia alla versione attesa dal codice.
+    Se DB_AUTO_MIGRATE è attivo (default solo su SQLite) applica le migrazioni mancanti,
+    altrimenti solleva SchemaVersionError: in produzione le migrazioni vanno eseguite
+    una sola volta prima di avviare i worker con
+        python -m wms_app.database.migrations upgrade
+    """
+    if auto_migrate is None:
+        default_auto_migrate = "True" if engine.dialect.name == "sqlite" else "False"
+        auto_migrate = os.getenv("DB_AUTO_MIGRATE", default_auto_migrate).lower() == "true"
+
+    current_version = read_schema_version(engine)
+    latest_version = get_latest_version()
+
+    if current_version == latest_version:
+        return current_version
+
+    if current_version > latest_version:
+        raise SchemaVersionError(
+            f"Il database è alla versione {current_version}, più recente del codice ({latest_version})."
+        )
+
+    if not auto_migrate:
+        raise SchemaVersionError(
+            f"Schema database alla versione {current_version}, attesa {latest_version}. "
+            f"Esegui: python -m wms_app.database.migrations upgrade"
+        )
+
+    upgrade(engine)
+    return read_schema_version(engine)
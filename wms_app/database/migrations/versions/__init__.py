@@ -0,0 +1,14 @@
+# Elenco delle migrazioni dello schema: aggiungere qui ogni nuovo modulo vNNN_*
+from . import v001_hot_indexes
+from . import v002_hashed_refresh_tokens
+from . import v003_stock_ledger
+from . import v004_optimistic_versions
+from . import v005_location_coordinates
+
+ALL_MIGRATIONS = [
+    v001_hot_indexes,
+    v002_hashed_refresh_tokens,
+    v003_stock_ledger,
+    v004_optimistic_versions,
+    v005_location_coordinates,
+]
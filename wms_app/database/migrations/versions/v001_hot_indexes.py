@@ -0,0 +1,54 @@
+"""
+Indici sulle tabelle più interrogate (inventario, prenotazioni, ordini, EAN, seriali)
+e vincolo di unicità (location_name, product_sku) su inventory.
+"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+VERSION = 1
+DESCRIPTION = "Indici hot path inventory/reservations/orders e unicità ubicazione-SKU"
+
+# Stessi nomi usati nei modelli, così create_all e migrazione producono lo stesso schema
+INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_inventory_location_sku ON inventory (location_name, product_sku)",
+    "CREATE INDEX IF NOT EXISTS ix_inventory_product_sku ON inventory (product_sku)",
+    "CREATE INDEX IF NOT EXISTS ix_reservations_sku_status_expires ON inventory_reservations (product_sku, status, expires_at)",
+    "CREATE INDEX IF NOT EXISTS ix_order_lines_order_id ON order_lines (order_id)",
+    "CREATE INDEX IF NOT EXISTS ix_outgoing_stock_order_line_id ON outgoing_stock (order_line_id)",
+    "CREATE INDEX IF NOT EXISTS ix_ean_codes_product_sku ON ean_codes (product_sku)",
+    "CREATE INDEX IF NOT EXISTS ix_product_serials_serial_number ON product_serials (serial_number)",
+]
+
+
+def upgrade(connection: Connection):
+    # Prima del vincolo di unicità consolida eventuali record duplicati (es. TERRA):
+    # la quantità totale finisce nel record con id minore, gli altri vengono eliminati
+    connection.execute(text("""
+        UPDATE inventory
+        SET quantity = (
+            SELECT SUM(dup.quantity) FROM inventory dup
+            WHERE dup.location_name = inventory.location_name
+              AND dup.product_sku = inventory.product_sku
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM inventory
+            WHERE location_name IS NOT NULL AND product_sku IS NOT NULL
+            GROUP BY location_name, product_sku
+            HAVING COUNT(*) > 1
+        )
+    """))
+    connection.execute(text("""
+        DELETE FROM inventory
+        WHERE location_name IS NOT NULL AND product_sku IS NOT NULL
+          AND id NOT IN (
+            SELECT MIN(id) FROM inventory
+            WHERE location_name IS NOT NULL AND product_sku IS NOT NULL
+            GROUP BY location_name, product_sku
+        )
+    """))
+
+    for statement in INDEXES:
+        connection.execute(text(statement))
+
+    # Aggiorna le statistiche del planner per i nuovi indici
+    connection.execute(text("ANALYZE"))
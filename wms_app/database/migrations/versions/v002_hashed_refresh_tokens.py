@@ -0,0 +1,46 @@
+"""
+Refresh token salvati come hash SHA-256, una sessione per utente e indice sulla
+scadenza per lo sweep periodico di user_sessions.
+"""
+import hashlib
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+VERSION = 2
+DESCRIPTION = "Refresh token hashati, unicità user_sessions.user_id e indice expires_at"
+
+INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_user_sessions_user_id ON user_sessions (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_user_sessions_expires_at ON user_sessions (expires_at)",
+]
+
+_SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+def upgrade(connection: Connection):
+    # Le sessioni già scadute non servono più
+    connection.execute(
+        text("DELETE FROM user_sessions WHERE expires_at < :now"), {"now": datetime.utcnow()}
+    )
+
+    # Una sola sessione per utente (la più recente), come già previsto dal login
+    connection.execute(text("""
+        DELETE FROM user_sessions
+        WHERE id NOT IN (SELECT MAX(id) FROM user_sessions GROUP BY user_id)
+    """))
+
+    # I token in chiaro vengono sostituiti dal loro hash: le sessioni attive restano valide
+    rows = connection.execute(text("SELECT id, token FROM user_sessions")).all()
+    for session_id, token in rows:
+        if _SHA256_HEX.match(token):
+            continue
+        connection.execute(
+            text("UPDATE user_sessions SET token = :token WHERE id = :id"),
+            {"token": hashlib.sha256(token.encode()).hexdigest(), "id": session_id}
+        )
+
+    for statement in INDEXES:
+        connection.execute(text(statement))
@@ -0,0 +1,46 @@
+"""
+Registro dei movimenti di giacenza (stock_movements) e fotografie notturne
+(stock_snapshots). Le tabelle vengono create dal runner a partire dai modelli; qui si
+assicurano gli indici e si salva una prima fotografia delle giacenze, punto di partenza
+per le interrogazioni "giacenza alla data".
+"""
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+VERSION = 3
+DESCRIPTION = "Registro movimenti stock_movements e fotografie stock_snapshots"
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_stock_movements_sku_timestamp ON stock_movements (product_sku, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_movements_from_timestamp ON stock_movements (location_from, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_movements_to_timestamp ON stock_movements (location_to, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_movements_order_number ON stock_movements (order_number)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_movements_timestamp ON stock_movements (timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_snapshots_taken_at_location ON stock_snapshots (taken_at, location_name)",
+]
+
+
+def upgrade(connection: Connection):
+    from wms_app.models.inventory import StockMovement, StockSnapshot
+
+    StockMovement.__table__.create(bind=connection, checkfirst=True)
+    StockSnapshot.__table__.create(bind=connection, checkfirst=True)
+
+    for statement in INDEXES:
+        connection.execute(text(statement))
+
+    # Fotografia iniziale: lo storico precedente resta nei log operazioni
+    has_snapshot = connection.execute(text("SELECT 1 FROM stock_snapshots LIMIT 1")).first()
+    if has_snapshot is None:
+        last_movement_id = connection.execute(text("SELECT MAX(id) FROM stock_movements")).scalar() or 0
+        connection.execute(
+            text("""
+                INSERT INTO stock_snapshots (taken_at, last_movement_id, location_name, product_sku, quantity)
+                SELECT :taken_at, :last_movement_id, location_name, product_sku, quantity
+                FROM inventory
+                WHERE location_name IS NOT NULL AND quantity IS NOT NULL AND quantity <> 0
+            """),
+            {"taken_at": datetime.utcnow(), "last_movement_id": last_movement_id}
+        )
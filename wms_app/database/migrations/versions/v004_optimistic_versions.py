@@ -0,0 +1,20 @@
+"""
+Colonna version su inventory e order_lines per la concorrenza ottimistica: gli UPDATE
+dell'ORM diventano "... WHERE id = ? AND version = ?" (vedi services/optimistic_lock.py).
+Le righe esistenti partono dalla versione 1.
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+
+VERSION = 4
+DESCRIPTION = "Colonna version su inventory e order_lines (concorrenza ottimistica)"
+
+VERSIONED_TABLES = ["inventory", "order_lines"]
+
+
+def upgrade(connection: Connection):
+    inspector = inspect(connection)
+    for table_name in VERSIONED_TABLES:
+        columns = {column["name"] for column in inspector.get_columns(table_name)}
+        if "version" not in columns:
+            connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
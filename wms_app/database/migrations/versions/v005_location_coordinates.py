@@ -0,0 +1,54 @@
+"""
+Coordinate strutturate sulle ubicazioni: fila, campata, piano, posizione e tipo (kind).
+Le colonne vengono aggiunte se mancanti e valorizzate dal nome con lo stesso parser usato
+dal modello alla creazione (parse_location_name); poi si creano gli indici.
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+
+VERSION = 5
+DESCRIPTION = "Coordinate fila/campata/piano/posizione e tipo sulle ubicazioni"
+
+COLUMNS = {
+    "fila": "INTEGER",
+    "campata": "VARCHAR(10)",
+    "piano": "INTEGER",
+    "posizione": "INTEGER",
+    "kind": "VARCHAR(20) NOT NULL DEFAULT 'ALTRO'",
+}
+
+# Stessi nomi usati nel modello, così create_all e migrazione producono lo stesso schema
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_locations_fila_campata_piano_posizione ON locations (fila, campata, piano, posizione)",
+    "CREATE INDEX IF NOT EXISTS ix_locations_piano ON locations (piano)",
+    "CREATE INDEX IF NOT EXISTS ix_locations_kind ON locations (kind)",
+]
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def upgrade(connection: Connection):
+    from wms_app.models.inventory import parse_location_name
+
+    existing = {column["name"] for column in inspect(connection).get_columns("locations")}
+    for column, definition in COLUMNS.items():
+        if column not in existing:
+            connection.execute(text(f"ALTER TABLE locations ADD COLUMN {column} {definition}"))
+
+    names = connection.execute(text("SELECT name FROM locations")).scalars().all()
+    statement = text("""
+        UPDATE locations
+        SET fila = :fila, campata = :campata, piano = :piano, posizione = :posizione, kind = :kind
+        WHERE name = :b_name
+    """)
+    for start in range(0, len(names), BACKFILL_CHUNK_SIZE):
+        connection.execute(statement, [
+            {"b_name": name, **parse_location_name(name)}
+            for name in names[start:start + BACKFILL_CHUNK_SIZE]
+        ])
+
+    for statement_sql in INDEXES:
+        connection.execute(text(statement_sql))
+
+    # Aggiorna le statistiche del planner per i nuovi indici
+    connection.execute(text("ANALYZE"))
@@ -0,0 +1,137 @@
+"""
+Verifica dei piani di esecuzione delle query più frequenti.
+Esegue EXPLAIN QUERY PLAN (SQLite) o EXPLAIN (PostgreSQL) su un campione di query
+hot path e riporta quali usano un indice e quali fanno una scansione completa.
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+# Query rappresentative dei filtri usati da routers/inventory.py, routers/orders.py,
+# ReservationService e dalla gestione EAN/seriali
+HOT_QUERIES = [
+    {
+        "name": "inventory_by_location_sku",
+        "description": "Giacenza di uno SKU in una ubicazione",
+        "sql": "SELECT id, quantity FROM inventory WHERE location_name = :location AND product_sku = :sku",
+    },
+    {
+        "name": "inventory_other_sku_in_location",
+        "description": "Controllo ubicazione occupata da altro SKU",
+        "sql": "SELECT id, product_sku FROM inventory WHERE location_name = :location AND product_sku != :sku AND quantity > 0",
+    },
+    {
+        "name": "inventory_by_sku",
+        "description": "Ubicazioni di uno SKU",
+        "sql": "SELECT location_name, quantity FROM inventory WHERE product_sku = :sku AND quantity > 0",
+    },
+    {
+        "name": "active_reservations_by_sku",
+        "description": "Prenotazioni attive non scadute di uno SKU",
+        "sql": "SELECT location_name, reserved_quantity FROM inventory_reservations "
+               "WHERE product_sku = :sku AND status = 'active' AND expires_at > :now",
+    },
+    {
+        "name": "order_lines_by_order",
+        "description": "Righe di un ordine",
+        "sql": "SELECT id, product_sku, requested_quantity FROM order_lines WHERE order_id = :order_id",
+    },
+    {
+        "name": "outgoing_by_order_line",
+        "description": "Stock in uscita di una riga ordine",
+        "sql": "SELECT id, quantity FROM outgoing_stock WHERE order_line_id = :order_line_id",
+    },
+    {
+        "name": "eans_by_product",
+        "description": "EAN associati a uno SKU",
+        "sql": "SELECT ean FROM ean_codes WHERE product_sku = :sku",
+    },
+    {
+        "name": "serial_lookup",
+        "description": "Ricerca di un numero seriale",
+        "sql": "SELECT id, order_number FROM product_serials WHERE serial_number = :serial",
+    },
+]
+
+# Parametri fittizi: servono solo a far pianificare la query
+SAMPLE_PARAMS = {
+    "location": "1A1P1",
+    "sku": "SKU",
+    "now": datetime(2000, 1, 1),
+    "order_id": 1,
+    "order_line_id": 1,
+    "serial": "SERIAL",
+}
+
+
+def _explain_prefix(connection: Connection) -> str:
+    return "EXPLAIN QUERY PLAN" if connection.dialect.name == "sqlite" else "EXPLAIN"
+
+
+def _plan_lines(connection: Connection, rows) -> List[str]:
+    if connection.dialect.name == "sqlite":
+        return [str(row[-1]) for row in rows]  # colonna "detail"
+    return [str(row[0]) for row in rows]
+
+
+def explain_statement(connection: Connection, sql: str, params: Optional[Dict[str, Any]] = None) -> List[str]:
+    """Restituisce il piano di esecuzione di una query come lista di righe testuali"""
+    rows = connection.execute(text(f"{_explain_prefix(connection)} {sql}"), params or {}).fetchall()
+    return _plan_lines(connection, rows)
+
+
+def explain_driver_statement(connection: Connection, statement: str, parameters: Any = None) -> List[str]:
+    """
+    Come explain_statement, ma per uno statement già compilato dal driver
+    (segnaposto ?, %(nome)s, $1...) con i parametri nel formato DBAPI
+    """
+    rows = connection.exec_driver_sql(f"{_explain_prefix(connection)} {statement}", parameters or ()).fetchall()
+    return _plan_lines(connection, rows)
+
+
+def plan_uses_index(plan_lines: List[str]) -> bool:
+    """True se il piano accede alle tabelle tramite indice e senza scansioni complete"""
+    plan = " ".join(plan_lines).upper()
+    full_scan = "SEQ SCAN" in plan or any(
+        line.upper().startswith("SCAN ") and " USING " not in line.upper() for line in plan_lines
+    )
+    uses_index = "USING INDEX" in plan or "USING COVERING INDEX" in plan or \
+        "USING INTEGER PRIMARY KEY" in plan or "INDEX SCAN" in plan or "INDEX ONLY SCAN" in plan
+    return uses_index and not full_scan
+
+
+def check_hot_queries(connection: Connection) -> Dict[str, Any]:
+    """
+    Esegue EXPLAIN su tutte le HOT_QUERIES.
+
+    Returns:
+        dict: dialetto, riepilogo e dettaglio del piano per ciascuna query
+    """
+    results = []
+    for query in HOT_QUERIES:
+        try:
+            plan = explain_statement(connection, query["sql"], SAMPLE_PARAMS)
+            results.append({
+                "name": query["name"],
+                "description": query["description"],
+                "uses_index": plan_uses_index(plan),
+                "plan": plan,
+            })
+        except Exception as e:
+            results.append({
+                "name": query["name"],
+                "description": query["description"],
+                "uses_index": False,
+                "plan": [],
+                "error": str(e),
+            })
+
+    return {
+        "dialect": connection.dialect.name,
+        "total_queries": len(results),
+        "using_index": sum(1 for result in results if result["uses_index"]),
+        "full_scans": [result["name"] for result in results if not result["uses_index"]],
+        "queries": results,
+    }
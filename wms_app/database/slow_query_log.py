@@ -0,0 +1,217 @@
+"""
+Log delle query lente con cattura del piano di esecuzione.
+Ogni statement più lento di SLOW_QUERY_THRESHOLD_MS viene registrato con SQL normalizzato,
+forma dei parametri, durata, rotta di origine e output di EXPLAIN QUERY PLAN / EXPLAIN
+(catturato una sola volta per forma di query).
+
+Storage:
+- in memoria, aggregato per SQL normalizzato e limitato a SLOW_QUERY_MAX_ENTRIES forme
+  (consultabile da /admin/api/database/slow-queries)
+- file JSON lines a rotazione (SLOW_QUERY_LOG_FILE), per l'analisi a posteriori
+"""
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from wms_app.database.query_plans import explain_driver_statement, plan_uses_index
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_LOG_ENABLED = os.getenv("SLOW_QUERY_LOG_ENABLED", "True").lower() == "true"
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 200))
+SLOW_QUERY_MAX_ENTRIES = int(os.getenv("SLOW_QUERY_MAX_ENTRIES", 200))  # forme di query distinte in memoria
+SLOW_QUERY_LOG_FILE = os.getenv("SLOW_QUERY_LOG_FILE", "logs/slow_queries.log")  # vuoto = nessun file
+SLOW_QUERY_LOG_MAX_BYTES = int(os.getenv("SLOW_QUERY_LOG_MAX_BYTES", 5 * 1024 * 1024))
+SLOW_QUERY_LOG_BACKUP_COUNT = int(os.getenv("SLOW_QUERY_LOG_BACKUP_COUNT", 3))
+
+# Solo questi statement vengono passati a EXPLAIN (DDL, PRAGMA e INSERT non interessano)
+EXPLAINABLE_PREFIXES = ("SELECT", "WITH", "UPDATE", "DELETE")
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = r"(?:\?|%s|%\([^)]*\)s|\$\d+)"
+_PLACEHOLDER_LIST = re.compile(rf"\(\s*{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+# Impedisce che l'EXPLAIN eseguito dal log venga a sua volta misurato e registrato
+_capture_state = threading.local()
+
+
+def is_capturing_plan() -> bool:
+    return getattr(_capture_state, "active", False)
+
+
+def normalize_sql(statement: str) -> str:
+    """
+    Forma canonica di uno statement: letterali sostituiti da ? e liste IN di lunghezza
+    variabile collassate, così le stesse query con parametri diversi si aggregano
+    """
+    normalized = _STRING_LITERAL.sub("?", statement)
+    normalized = _NUMBER_LITERAL.sub("?", normalized)
+    normalized = _PLACEHOLDER_LIST.sub("(?, ...)", normalized)
+    return _WHITESPACE.sub(" ", normalized).strip()
+
+
+def parameter_shape(parameters: Any, executemany: bool = False) -> Any:
+    """Tipi dei parametri legati (mai i valori: possono contenere dati sensibili)"""
+    if executemany:
+        batch = list(parameters or [])
+        return {"executemany": len(batch), "row": parameter_shape(batch[0]) if batch else None}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+class SlowQueryLog:
+    """Registro limitato delle query lente, aggregato per SQL normalizzato"""
+
+    def __init__(
+        self,
+        threshold_ms: float = SLOW_QUERY_THRESHOLD_MS,
+        max_entries: int = SLOW_QUERY_MAX_ENTRIES,
+        log_file: Optional[str] = SLOW_QUERY_LOG_FILE
+    ):
+        self.threshold_ms = threshold_ms
+        self.max_entries = max_entries
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._log_file = log_file
+        self._file_logger = None  # creato alla prima query lenta
+
+    @staticmethod
+    def _create_file_logger(log_file: str) -> Optional[logging.Logger]:
+        try:
+            Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(
+                log_file,
+                maxBytes=SLOW_QUERY_LOG_MAX_BYTES,
+                backupCount=SLOW_QUERY_LOG_BACKUP_COUNT,
+                encoding="utf-8"
+            )
+        except OSError as e:
+            logger.warning(f"Slow query log su file non disponibile ({log_file}): {e}")
+            return None
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        file_logger = logging.getLogger("wms_app.slow_queries")
+        file_logger.handlers = [handler]
+        file_logger.setLevel(logging.INFO)
+        file_logger.propagate = False
+        return file_logger
+
+    def record(
+        self,
+        conn,
+        statement: str,
+        parameters: Any,
+        executemany: bool,
+        duration_ms: float,
+        route: Optional[str] = None
+    ):
+        """Registra lo statement se supera la soglia; cattura il piano alla prima occorrenza"""
+        if duration_ms < self.threshold_ms:
+            return
+
+        normalized = normalize_sql(statement)
+        route = route or "background"
+        now = datetime.utcnow().isoformat()
+
+        with self._lock:
+            entry = self._entries.get(normalized)
+            is_new_shape = entry is None and self._make_room(duration_ms)
+            if is_new_shape:
+                entry = {
+                    "normalized_sql": normalized,
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "last_ms": 0.0,
+                    "first_seen": now,
+                    "last_seen": now,
+                    "routes": {},
+                    "parameter_shape": parameter_shape(parameters, executemany),
+                    "plan": None,
+                    "uses_index": None,
+                    "plan_error": None,
+                }
+                self._entries[normalized] = entry
+            if entry is not None:
+                entry["count"] += 1
+                entry["total_ms"] += duration_ms
+                entry["max_ms"] = max(entry["max_ms"], duration_ms)
+                entry["last_ms"] = duration_ms
+                entry["last_seen"] = now
+                entry["routes"][route] = entry["routes"].get(route, 0) + 1
+
+        if is_new_shape:
+            self._capture_plan(conn, statement, parameters, executemany, entry)
+
+        if self._log_file and self._file_logger is None:
+            self._file_logger = self._create_file_logger(self._log_file)
+            if self._file_logger is None:
+                self._log_file = None
+        if self._file_logger:
+            self._file_logger.info(json.dumps({
+                "timestamp": now,
+                "duration_ms": round(duration_ms, 2),
+                "route": route,
+                "normalized_sql": normalized,
+                "parameter_shape": parameter_shape(parameters, executemany),
+                "plan": entry["plan"] if is_new_shape else None,
+            }, ensure_ascii=False, default=str))
+
+    def _make_room(self, duration_ms: float) -> bool:
+        """
+        Al limite di forme conservate scarta la meno lenta, se più veloce della nuova:
+        in memoria restano i casi peggiori. False se la nuova forma non va conservata.
+        """
+        if len(self._entries) < self.max_entries:
+            return True
+        fastest = min(self._entries.values(), key=lambda entry: entry["max_ms"])
+        if fastest["max_ms"] >= duration_ms:
+            return False
+        del self._entries[fastest["normalized_sql"]]
+        return True
+
+    def _capture_plan(self, conn, statement: str, parameters: Any, executemany: bool, entry: Dict[str, Any]):
+        if executemany or not statement.lstrip().upper().startswith(EXPLAINABLE_PREFIXES):
+            return
+        _capture_state.active = True
+        try:
+            # Connessione separata: quella originale è nel mezzo dell'esecuzione
+            with conn.engine.connect() as explain_connection:
+                plan = explain_driver_statement(explain_connection, statement, parameters)
+            entry["plan"] = plan
+            entry["uses_index"] = plan_uses_index(plan)
+        except Exception as e:
+            entry["plan_error"] = str(e)
+        finally:
+            _capture_state.active = False
+
+    def worst(self, limit: int = 50, order_by: str = "max_ms") -> List[Dict[str, Any]]:
+        """Le forme di query peggiori per max_ms, total_ms, avg_ms o count"""
+        with self._lock:
+            entries = [dict(entry, routes=dict(entry["routes"])) for entry in self._entries.values()]
+        for entry in entries:
+            entry["avg_ms"] = round(entry["total_ms"] / entry["count"], 2)
+            entry["total_ms"] = round(entry["total_ms"], 2)
+            entry["max_ms"] = round(entry["max_ms"], 2)
+            entry["last_ms"] = round(entry["last_ms"], 2)
+        if order_by not in ("max_ms", "total_ms", "avg_ms", "count"):
+            order_by = "max_ms"
+        entries.sort(key=lambda entry: entry[order_by], reverse=True)
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog() if SLOW_QUERY_LOG_ENABLED else None
@@ -2,38 +2,50 @@ from fastapi import FastAPI, Depends, Request
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, and_, or_, select
 from wms_app.routers.auth import require_permission
 from wms_app.middleware.auth_middleware import AuthMiddleware
+from wms_app.middleware.query_metrics_middleware import QueryMetricsMiddleware
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import atexit
 
 from wms_app.database import database
-from wms_app.models import products, inventory, orders, reservations, serials, ddt, settings, logs, auth
+from wms_app.database.migrations import verify_schema
+from wms_app.database.instrumentation import QUERY_METRICS_ENABLED, install_query_instrumentation
+from wms_app.services.location_occupancy import install_occupancy_tracking
+from wms_app.services.stock_ledger import STOCK_SNAPSHOT_HOUR, install_stock_ledger
+from wms_app.services.jwt_service import REFRESH_TOKEN_SWEEP_MINUTES
 from wms_app.models.inventory import Location, Inventory  
 from wms_app.models.orders import Order, OrderLine, OutgoingStock
 from wms_app.models.serials import ProductSerial
 
 
 
-# Crea le tabelle del database (solo se non esistono già)
-products.Base.metadata.create_all(bind=database.engine)
-inventory.Base.metadata.create_all(bind=database.engine)
-orders.Base.metadata.create_all(bind=database.engine)
-reservations.Base.metadata.create_all(bind=database.engine)
-serials.Base.metadata.create_all(bind=database.engine)
-ddt.Base.metadata.create_all(bind=database.engine)
-settings.Base.metadata.create_all(bind=database.engine)
-logs.Base.metadata.create_all(bind=database.engine)
-auth.Base.metadata.create_all(bind=database.engine)
+# Verifica che lo schema del database sia alla versione attesa dal codice.
+# Le tabelle e le migrazioni si gestiscono con: python -m wms_app.database.migrations upgrade
+verify_schema(database.engine)
 
 app = FastAPI(title="WMS EPM")
 
-# Aggiungi middleware di autenticazione
-auth_middleware = AuthMiddleware()
-app.middleware("http")(auth_middleware)
+# Aggiungi middleware di autenticazione (ASGI puro, senza wrapping delle risposte)
+app.add_middleware(AuthMiddleware)
+
+# Hook SQL per slow query log e metriche per richiesta
+install_query_instrumentation()
+
+# Hook di sessione che tengono aggiornato l'indice di occupazione delle ubicazioni
+install_occupancy_tracking()
+
+# Hook di sessione che scrivono il registro dei movimenti di giacenza (stock_movements)
+install_stock_ledger()
+
+# Strumentazione SQL per richiesta (Server-Timing, metriche per endpoint, warning N+1).
+# Registrato dopo l'autenticazione così è il più esterno e conta anche le sue query
+if QUERY_METRICS_ENABLED:
+    app.add_middleware(QueryMetricsMiddleware)
 
 # ==================== BACKUP SCHEDULER ====================
 scheduler = AsyncIOScheduler()
@@ -86,6 +98,44 @@ async def run_backup_cleanup():
     except Exception as e:
         print(f"❌ Errore pulizia backup: {e}")
 
+def run_session_cleanup():
+    """
+    Rimuove le sessioni (refresh token) scadute a blocchi.
+    Funzione sincrona: APScheduler la esegue in un thread, fuori dall'event loop.
+    """
+    try:
+        from wms_app.services.jwt_service import JWTService
+        from wms_app.database.database import SessionLocal
+        
+        db = SessionLocal()
+        try:
+            deleted = JWTService.cleanup_expired_tokens(db)
+            if deleted:
+                print(f"🧹 Sessioni scadute rimosse: {deleted}")
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"❌ Errore pulizia sessioni: {e}")
+
+def run_stock_snapshot():
+    """
+    Salva la fotografia notturna delle giacenze per ubicazione.
+    Funzione sincrona: APScheduler la esegue in un thread, fuori dall'event loop.
+    """
+    try:
+        from wms_app.services.stock_ledger import StockLedgerService
+        from wms_app.database.database import SessionLocal, serialized_write
+        
+        db = SessionLocal()
+        try:
+            with serialized_write():
+                result = StockLedgerService.take_snapshot(db)
+            print(f"📸 Fotografia giacenze salvata: {result['rows']} righe")
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"❌ Errore fotografia giacenze: {e}")
+
 # Configura scheduler per backup automatici
 scheduler.add_job(
     run_daily_backup,
@@ -111,12 +161,30 @@ scheduler.add_job(
     replace_existing=True
 )
 
+scheduler.add_job(
+    run_session_cleanup,
+    IntervalTrigger(minutes=REFRESH_TOKEN_SWEEP_MINUTES),
+    id='session_cleanup',
+    name='Pulizia Sessioni Scadute',
+    replace_existing=True
+)
+
+scheduler.add_job(
+    run_stock_snapshot,
+    CronTrigger(hour=STOCK_SNAPSHOT_HOUR, minute=30),
+    id='stock_snapshot',
+    name='Fotografia Notturna Giacenze',
+    replace_existing=True
+)
+
 # Avvia scheduler
 scheduler.start()
 print("🚀 Scheduler backup avviato con successo")
 print("   - Backup giornaliero: ogni giorno alle 2:00")
 print("   - Backup settimanale: ogni domenica alle 3:00")
 print("   - Pulizia backup: primo giorno del mese alle 4:00")
+print(f"   - Pulizia sessioni scadute: ogni {REFRESH_TOKEN_SWEEP_MINUTES} minuti")
+print(f"   - Fotografia giacenze: ogni giorno alle {STOCK_SNAPSHOT_HOUR}:30")
 
 # Assicura che lo scheduler venga fermato quando l'app si chiude
 atexit.register(lambda: scheduler.shutdown())
@@ -159,13 +227,13 @@ async def get_products_page(request: Request):
 
 # API endpoints per statistiche dashboard
 @app.get("/api/stats/inventory")
-async def get_inventory_stats(db: Session = Depends(database.get_db)):
+async def get_inventory_stats(db: AsyncSession = Depends(database.get_async_db)):
     """Totale pezzi in magazzino (inventory + outgoing)"""
     # Totale in inventario (scaffali + TERRA)
-    total_inventory = db.query(func.sum(Inventory.quantity)).scalar() or 0
+    total_inventory = (await db.execute(select(func.sum(Inventory.quantity)))).scalar() or 0
     
     # Totale in uscita (già prelevato ma ancora fisicamente in magazzino)
-    total_outgoing = db.query(func.sum(OutgoingStock.quantity)).scalar() or 0
+    total_outgoing = (await db.execute(select(func.sum(OutgoingStock.quantity)))).scalar() or 0
     
     # Giacenza totale = inventario + stock in uscita (tutto quello fisicamente presente)
     total_stock = total_inventory + total_outgoing
@@ -173,32 +241,32 @@ async def get_inventory_stats(db: Session = Depends(database.get_db)):
     return {"count": total_stock}
 
 @app.get("/api/stats/ground")
-async def get_ground_stats(db: Session = Depends(database.get_db)):
+async def get_ground_stats(db: AsyncSession = Depends(database.get_async_db)):
     """Pezzi a terra (ubicazioni temporanee)"""
     # Assumiamo che le ubicazioni "a terra" inizino con "TERRA" o simili
-    ground_pieces = db.query(func.sum(Inventory.quantity)).filter(
+    ground_pieces = (await db.execute(select(func.sum(Inventory.quantity)).where(
         Inventory.location_name.like('TERRA%')
-    ).scalar() or 0
+    ))).scalar() or 0
     
     # Se non ci sono ubicazioni specifiche per terra, usa un valore di fallback
     if ground_pieces == 0:
         # Potremmo anche cercare ubicazioni che non seguono il pattern standard
-        ground_pieces = db.query(func.sum(Inventory.quantity)).filter(
+        ground_pieces = (await db.execute(select(func.sum(Inventory.quantity)).where(
             func.length(Inventory.location_name) < 5  # Ubicazioni con nomi corti potrebbero essere temporanee
-        ).scalar() or 0
+        ))).scalar() or 0
     
     return {"count": ground_pieces}
 
 @app.get("/api/stats/locations")
-async def get_locations_stats(db: Session = Depends(database.get_db)):
+async def get_locations_stats(db: AsyncSession = Depends(database.get_async_db)):
     """Ubicazioni utilizzate vs totali"""
     # Ubicazioni con inventario (utilizzate) - solo quelle con quantity > 0
-    used_locations = db.query(func.count(func.distinct(Inventory.location_name))).filter(
+    used_locations = (await db.execute(select(func.count(func.distinct(Inventory.location_name))).where(
         Inventory.quantity > 0
-    ).scalar() or 0
+    ))).scalar() or 0
     
     # Totale ubicazioni (stessa logica di analisi - senza filtro available)
-    total_locations = db.query(func.count(Location.name)).scalar() or 0
+    total_locations = (await db.execute(select(func.count(Location.name)))).scalar() or 0
     
     # Calcola percentuale di utilizzo
     usage_percentage = round((used_locations / total_locations * 100), 1) if total_locations > 0 else 0
@@ -214,16 +282,16 @@ async def get_locations_stats(db: Session = Depends(database.get_db)):
     }
 
 @app.get("/api/stats/orders")
-async def get_orders_stats(db: Session = Depends(database.get_db)):
+async def get_orders_stats(db: AsyncSession = Depends(database.get_async_db)):
     """Ordini da completare (picking < 100%)"""
     # Logica corretta: conta ordini attivi dove il progresso picking < 100%
     # Calcola il rapporto picked_quantity/requested_quantity per ogni ordine
     
-    subquery = db.query(
+    subquery = select(
         Order.id,
         func.sum(OrderLine.requested_quantity).label('total_requested'),
         func.sum(OrderLine.picked_quantity).label('total_picked')
-    ).join(OrderLine).filter(
+    ).join(OrderLine).where(
         and_(
             Order.is_completed == False,
             Order.is_archived == False, 
@@ -232,26 +300,26 @@ async def get_orders_stats(db: Session = Depends(database.get_db)):
     ).group_by(Order.id).subquery()
     
     # Conta ordini dove progresso picking < 100%
-    incomplete_orders = db.query(func.count()).select_from(subquery).filter(
+    incomplete_orders = (await db.execute(select(func.count()).select_from(subquery).where(
         or_(
             subquery.c.total_requested == 0,  # Ordini senza righe
             subquery.c.total_picked < subquery.c.total_requested  # Picking incompleto
         )
-    ).scalar() or 0
+    ))).scalar() or 0
     
     return {"count": incomplete_orders}
 
 @app.get("/api/stats/ready-orders")
-async def get_ready_orders_stats(db: Session = Depends(database.get_db)):
+async def get_ready_orders_stats(db: AsyncSession = Depends(database.get_async_db)):
     """Ordini pronti per evasione (picking = 100%)"""
     # Logica: conta ordini attivi dove il progresso picking = 100%
     # Ma non ancora completati (is_completed = False)
     
-    subquery = db.query(
+    subquery = select(
         Order.id,
         func.sum(OrderLine.requested_quantity).label('total_requested'),
         func.sum(OrderLine.picked_quantity).label('total_picked')
-    ).join(OrderLine).filter(
+    ).join(OrderLine).where(
         and_(
             Order.is_completed == False,
             Order.is_archived == False, 
@@ -260,32 +328,32 @@ async def get_ready_orders_stats(db: Session = Depends(database.get_db)):
     ).group_by(Order.id).subquery()
     
     # Conta ordini dove progresso picking = 100%
-    ready_orders = db.query(func.count()).select_from(subquery).filter(
+    ready_orders = (await db.execute(select(func.count()).select_from(subquery).where(
         and_(
             subquery.c.total_requested > 0,  # Deve avere righe
             subquery.c.total_picked >= subquery.c.total_requested  # Picking completo
         )
-    ).scalar() or 0
+    ))).scalar() or 0
     
     return {"count": ready_orders}
 
 @app.get("/api/stats/serials")
-async def get_serials_stats(db: Session = Depends(database.get_db)):
+async def get_serials_stats(db: AsyncSession = Depends(database.get_async_db)):
     """Seriali mancanti per ordini attivi"""
     # Logica corretta: ordini attivi che NON hanno seriali associati
     # LEFT JOIN tra orders e product_serials per trovare ordini senza seriali
     
-    orders_without_serials = db.query(func.count(Order.id)).select_from(
+    orders_without_serials = (await db.execute(select(func.count(Order.id)).select_from(
         Order
     ).outerjoin(
         ProductSerial, Order.order_number == ProductSerial.order_number
-    ).filter(
+    ).where(
         and_(
             Order.is_completed == False,
             Order.is_archived == False,
             Order.is_cancelled == False,
             ProductSerial.id.is_(None)  # Nessun record trovato in product_serials
         )
-    ).scalar() or 0
+    ))).scalar() or 0
     
     return {"count": orders_without_serials}
\ No newline at end of file
@@ -3,146 +3,183 @@ Middleware di autenticazione centralizzato per FastAPI
 Gestisce automaticamente l'autenticazione JWT per tutte le route protette
 """
 from fastapi import Request, HTTPException, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import RedirectResponse, JSONResponse
 from sqlalchemy.orm import Session
-from typing import Optional, Callable, Any
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Optional, Iterable
 import logging
-from wms_app.database.database import get_db
+import re
+from wms_app.database.database import get_request_session, close_request_session
 from wms_app.services.jwt_service import JWTService
 from wms_app.services.auth_service import AuthService
+from wms_app.services.auth_cache import AuthenticatedUser, authenticated_user_cache
 from wms_app.models.auth import User
 
 logger = logging.getLogger(__name__)
 
 class AuthMiddleware:
-    """Middleware centralizzato per autenticazione JWT"""
+    """
+    Middleware ASGI centralizzato per autenticazione JWT.
+    Non usa BaseHTTPMiddleware/call_next: le route pubbliche, i file statici e le
+    StreamingResponse passano direttamente all'applicazione senza wrapping del body.
+    """
     
-    def __init__(self):
-        self.security = HTTPBearer(auto_error=False)
-        
-        # Route che NON richiedono autenticazione
-        self.public_routes = {
-            "/",
-            "/login",
-            "/api/auth/login", 
-            "/api/auth/refresh",
-            "/api/auth/logout",
-            "/static",
-            "/favicon.ico",
-            "/docs",
-            "/redoc",
-            "/openapi.json"
-        }
+    # Route che NON richiedono autenticazione (la route e i suoi sotto-percorsi, "/" solo esatta)
+    # /api/stats: statistiche della home, chiamate dalla dashboard senza token
+    PUBLIC_ROUTES = (
+        "/",
+        "/login",
+        "/api/auth/login",
+        "/api/auth/refresh",
+        "/api/auth/logout",
+        "/api/stats",
+        "/static",
+        "/favicon.ico",
+        "/docs",
+        "/redoc",
+        "/openapi.json"
+    )
+    
+    def __init__(self, app: ASGIApp, public_routes: Optional[Iterable[str]] = None):
+        self.app = app
+        self.public_routes = set(public_routes or self.PUBLIC_ROUTES)
+        self._public_route_pattern = self.compile_public_routes(self.public_routes)
+    
+    @staticmethod
+    def compile_public_routes(public_routes: Iterable[str]):
+        """Compila le route pubbliche in un'unica regex: match esatto o sotto-percorso"""
+        prefixes = sorted((route.rstrip("/") for route in public_routes if route != "/"), key=len, reverse=True)
+        alternatives = []
+        if "/" in public_routes:
+            alternatives.append(r"/")
+        if prefixes:
+            alternatives.append("(?:" + "|".join(re.escape(prefix) for prefix in prefixes) + ")(?:/.*)?")
+        return re.compile("(?:" + "|".join(alternatives) + ")" if alternatives else "(?!)", re.DOTALL)
     
     def is_public_route(self, path: str) -> bool:
         """Controlla se una route è pubblica"""
-        # Exact match
-        if path in self.public_routes:
-            return True
-        
-        # Prefix match per static files
-        for public_route in self.public_routes:
-            if path.startswith(public_route + "/") or path.startswith(public_route):
-                return True
-        
-        return False
+        return self._public_route_pattern.fullmatch(path) is not None
     
-    async def __call__(self, request: Request, call_next: Callable) -> Any:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """Middleware principale"""
-        path = request.url.path
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        path = scope["path"]
         
         # Skip autenticazione per route pubbliche
         if self.is_public_route(path):
-            response = await call_next(request)
-            return response
+            await self.app(scope, receive, send)
+            return
         
         # Per API routes, usa autenticazione JWT
         if path.startswith("/api/"):
-            return await self.handle_api_auth(request, call_next)
+            await self.handle_api_auth(scope, receive, send)
+            return
         
-        # Per HTML pages, usa autenticazione con redirect
-        return await self.handle_page_auth(request, call_next)
+        # Per HTML pages, l'autenticazione è gestita dal frontend
+        await self.handle_page_auth(scope, receive, send)
     
-    async def handle_api_auth(self, request: Request, call_next: Callable) -> Any:
+    async def handle_api_auth(self, scope: Scope, receive: Receive, send: Send):
         """Gestisce autenticazione per API endpoints"""
+        request = Request(scope)
         try:
-            logger.info(f"🔐 API Auth middleware per: {request.url.path}")
+            logger.debug(f"🔐 API Auth middleware per: {request.url.path}")
             
             # Ottieni token dall'header Authorization
             auth_header = request.headers.get("authorization")
-            logger.info(f"📡 Auth header presente: {bool(auth_header)}")
             
             if not auth_header or not auth_header.startswith("Bearer "):
                 logger.warning(f"❌ Token mancante per {request.url.path}")
-                return JSONResponse(
+                response = JSONResponse(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     content={"detail": "Token di accesso richiesto"},
                     headers={"WWW-Authenticate": "Bearer"}
                 )
+                await response(scope, receive, send)
+                return
             
             token = auth_header.split(" ")[1]
             
             # Verifica token JWT
             payload = JWTService.verify_access_token(token)
             if not payload:
-                return JSONResponse(
+                response = JSONResponse(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     content={"detail": "Token non valido o scaduto"},
                     headers={"WWW-Authenticate": "Bearer"}
                 )
+                await response(scope, receive, send)
+                return
             
-            # Ottieni utente dal database
-            db: Session = next(get_db())
-            try:
-                user = JWTService.get_user_from_token(db, token)
+            # Ottieni utente dalla cache (stesso token) o, alla prima chiamata, dal database
+            user = authenticated_user_cache.get(token)
+            if user is None:
+                user = self.load_authenticated_user(request, payload)
                 if not user:
-                    return JSONResponse(
+                    close_request_session(request)
+                    response = JSONResponse(
                         status_code=status.HTTP_401_UNAUTHORIZED,
                         content={"detail": "Utente non trovato o disattivato"}
                     )
-                
-                # Aggiungi utente alla request per uso nei dependency
-                request.state.current_user = user
-                request.state.jwt_payload = payload
-                
-            finally:
-                db.close()
+                    await response(scope, receive, send)
+                    return
+                authenticated_user_cache.set(token, user, payload.get("exp"))
             
-            # Procedi con la richiesta
-            response = await call_next(request)
-            return response
+            # Aggiungi utente alla request per uso nei dependency
+            request.state.current_user = user
+            request.state.jwt_payload = payload
             
         except Exception as e:
             logger.error(f"Errore in API auth middleware: {e}")
-            return JSONResponse(
+            close_request_session(request)
+            response = JSONResponse(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 content={"detail": "Errore interno del server"}
             )
+            await response(scope, receive, send)
+            return
+        
+        # Procedi con la richiesta
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # Chiude la sessione della richiesta se aperta qui (get_db la riusa senza chiuderla)
+            close_request_session(request)
+    
+    @staticmethod
+    def load_authenticated_user(request: Request, payload: dict) -> Optional[AuthenticatedUser]:
+        """
+        Carica l'utente del token già verificato (senza decodificarlo di nuovo) nella
+        sessione della richiesta: la rotta lo ritrova nell'identity map senza altre query
+        """
+        username = payload.get("sub")
+        if not username:
+            return None
+        
+        db: Session = get_request_session(request)
+        user = db.query(User).filter(User.username == username).first()
+        if not user or not user.is_active:
+            return None
+        return AuthenticatedUser.from_user(user)
     
-    async def handle_page_auth(self, request: Request, call_next: Callable) -> Any:
+    async def handle_page_auth(self, scope: Scope, receive: Receive, send: Send):
         """Gestisce autenticazione per pagine HTML"""
-        try:
-            # Per le pagine HTML, controlliamo prima se c'è un token valido
-            # Il frontend JavaScript gestirà l'autenticazione dettagliata
-            
-            # Se non c'è autenticazione, lasciamo che il frontend gestisca
-            # Questo elimina il flash bianco permettendo al JS di controllare
-            response = await call_next(request)
-            
-            # Aggiungi header per indicare che l'autenticazione è richiesta
-            if path not in self.public_routes:
-                response.headers["X-Auth-Required"] = "true"
-            
-            return response
-            
-        except Exception as e:
-            logger.error(f"Errore in page auth middleware: {e}")
-            # In caso di errore, procedi comunque
-            return await call_next(request)
+        # Per le pagine HTML il frontend JavaScript gestisce l'autenticazione dettagliata:
+        # la pagina viene servita comunque (niente flash bianco) e si aggiunge solo l'header
+        # che indica che l'autenticazione è richiesta, sul messaggio di inizio risposta
+        async def send_with_auth_header(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-Auth-Required"] = "true"
+            await send(message)
+        
+        await self.app(scope, receive, send_with_auth_header)
 
 # Dependency per ottenere l'utente corrente dalle API
-def get_current_user_from_middleware(request: Request) -> User:
+def get_current_user_from_middleware(request: Request) -> AuthenticatedUser:
     """Dependency per ottenere l'utente corrente dal middleware"""
     if not hasattr(request.state, 'current_user'):
         raise HTTPException(
@@ -157,16 +194,13 @@ def require_permission(permission_name: str):
     """Dependency factory per controllare permessi specifici"""
     def permission_checker(request: Request):
         current_user = get_current_user_from_middleware(request)
-        db: Session = next(get_db())
-        try:
-            if not AuthService.user_has_permission(db, current_user, permission_name):
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail=f"Permesso richiesto: {permission_name}"
-                )
-            return current_user
-        finally:
-            db.close()
+        # Ruoli dall'istantanea in cache e permessi dalla mappa precompilata: nessuna query
+        if not AuthService.user_has_permission(None, current_user, permission_name):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Permesso richiesto: {permission_name}"
+            )
+        return current_user
     
     return permission_checker
 
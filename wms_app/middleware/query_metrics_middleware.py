@@ -0,0 +1,62 @@
+"""
+Middleware di strumentazione SQL per richiesta
+Aggiunge l'header Server-Timing (tempo database e numero di query) e alimenta la tabella
+per endpoint consultabile da /admin/api/database/request-metrics
+"""
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from wms_app.database.instrumentation import (
+    endpoint_metrics,
+    endpoint_name,
+    get_request_stats,
+    install_query_instrumentation,
+    report_nplus1,
+    reset_request_stats,
+    start_request_stats,
+)
+
+
+class QueryMetricsMiddleware:
+    """
+    Conta statement e tempo database di ogni richiesta (middleware ASGI puro).
+    Server-Timing riporta le query eseguite fino all'invio degli header; la tabella per
+    endpoint le conta tutte, comprese quelle di eventuali StreamingResponse.
+    """
+
+    # Percorsi esclusi dalla tabella per endpoint (nessuna query, solo rumore)
+    EXCLUDED_PREFIXES = ("/static", "/favicon.ico")
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        install_query_instrumentation()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"].startswith(self.EXCLUDED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        token = start_request_stats(scope)
+        request_stats = get_request_stats()
+        started = time.perf_counter()
+
+        async def send_with_server_timing(message: Message):
+            if message["type"] == "http.response.start":
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                headers = MutableHeaders(scope=message)
+                headers["Server-Timing"] = (
+                    f'db;dur={request_stats.db_time_ms:.1f};desc="{request_stats.statement_count} query", '
+                    f'app;dur={elapsed_ms:.1f}'
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            reset_request_stats(token)
+            total_time_ms = (time.perf_counter() - started) * 1000
+            endpoint = endpoint_name(scope)
+            nplus1_detected = report_nplus1(endpoint, request_stats)
+            endpoint_metrics.record(endpoint, request_stats, total_time_ms, nplus1_detected)
@@ -1,5 +1,5 @@
 from .products import Product, EanCode
-from .inventory import Location, Inventory
+from .inventory import Location, Inventory, StockMovement, StockSnapshot
 from .orders import Order, OrderLine, OutgoingStock
 from .serials import ProductSerial, SerialValidationReport
 from .reservations import InventoryReservation
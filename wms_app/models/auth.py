@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from wms_app.database.database import Base
@@ -59,10 +59,15 @@ class UserSession(Base):
     __tablename__ = "user_sessions"
     
     id = Column(Integer, primary_key=True, index=True)
+    # SHA-256 del refresh token: il token in chiaro resta solo al client
     token = Column(String(255), unique=True, nullable=False, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # max 1 sessione per utente
     expires_at = Column(DateTime, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relazione con User
-    user = relationship("User")
\ No newline at end of file
+    user = relationship("User")
+
+# Una sessione per utente (upsert al login) e indice per lo sweep delle sessioni scadute
+Index('uq_user_sessions_user_id', UserSession.user_id, unique=True)
+Index('ix_user_sessions_expires_at', UserSession.expires_at)
@@ -1,23 +1,133 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+import re
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import Column, String, Integer, ForeignKey, Boolean, DateTime, Index
+from sqlalchemy.orm import column_property, relationship, validates
 from wms_app.database.database import Base
 
+# Tipi di ubicazione (colonna Location.kind)
+LOCATION_KIND_SHELF = "SCAFFALE"  # formato [FILA][CAMPATA][PIANO]P[POSIZIONE], es. 1A1P1
+LOCATION_KIND_GROUND = "TERRA"    # area a terra multi-SKU
+LOCATION_KIND_OTHER = "ALTRO"     # nomi fuori formato
+
+_SHELF_PATTERN = re.compile(r'^(\d+)([A-Z]+)(\d+)P(\d+)$')
+# Nomi fuori formato che iniziano comunque con il numero di fila (es. 12, 3B)
+_ROW_PREFIX_PATTERN = re.compile(r'^(\d+)([A-Z]*)')
+
+
+def parse_location_name(name: Optional[str]) -> Dict:
+    """
+    Coordinate strutturate di un nome ubicazione: fila, campata, piano, posizione e kind.
+    Le coordinate che il nome non contiene restano None.
+    """
+    normalized = (name or "").upper()
+    match = _SHELF_PATTERN.match(normalized)
+    if match:
+        return {
+            'fila': int(match.group(1)),
+            'campata': match.group(2),
+            'piano': int(match.group(3)),
+            'posizione': int(match.group(4)),
+            'kind': LOCATION_KIND_SHELF,
+        }
+    prefix = _ROW_PREFIX_PATTERN.match(normalized)
+    return {
+        'fila': int(prefix.group(1)) if prefix else None,
+        'campata': (prefix.group(2) or None) if prefix else None,
+        'piano': None,
+        'posizione': None,
+        'kind': LOCATION_KIND_GROUND if normalized == LOCATION_KIND_GROUND else LOCATION_KIND_OTHER,
+    }
+
+
 class Location(Base):
     __tablename__ = "locations"
 
     name = Column(String, primary_key=True, index=True)
     available = Column(Boolean, default=True, nullable=False)  # True = disponibile, False = non disponibile
-    # In futuro potremmo aggiungere dettagli come tipo_ubicazione (scaffale, terra), capacità, etc.
+    # Coordinate ricavate dal nome alla creazione (vedi parse_location_name): le query per
+    # fila, piano e distanza usano queste colonne indicizzate invece di regex/LIKE sul nome
+    fila = Column(Integer)
+    campata = Column(String(10))
+    piano = Column(Integer)
+    posizione = Column(Integer)
+    kind = Column(String(20), nullable=False, default=LOCATION_KIND_OTHER, server_default=LOCATION_KIND_OTHER)
 
     inventory_items = relationship("Inventory", back_populates="location")
 
+    @validates("name")
+    def _fill_coordinates(self, key, name):
+        for column, value in parse_location_name(name).items():
+            setattr(self, column, value)
+        return name
+
 class Inventory(Base):
     __tablename__ = "inventory"
 
     id = Column(Integer, primary_key=True, index=True)
     location_name = Column(String, ForeignKey("locations.name"))
-    product_sku = Column(String, ForeignKey("products.sku"))
-    quantity = Column(Integer, default=0)
+    product_sku = Column(String, ForeignKey("products.sku"), index=True)
+    # active_history: il valore precedente resta disponibile al flush anche dopo un
+    # assegnamento su attributo scaduto (serve al registro dei movimenti)
+    quantity = column_property(Column(Integer, default=0), active_history=True)
+    # Concorrenza ottimistica: UPDATE/DELETE ... WHERE id = ? AND version = ? (vedi services/optimistic_lock.py)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     location = relationship("Location", back_populates="inventory_items")
     product = relationship("Product")
+
+    __mapper_args__ = {"version_id_col": version}
+
+# Ubicazioni per fila (e campata/piano/posizione, ordine di percorso) e per piano
+Index('ix_locations_fila_campata_piano_posizione', Location.fila, Location.campata, Location.piano, Location.posizione)
+Index('ix_locations_piano', Location.piano)
+Index('ix_locations_kind', Location.kind)
+
+# Una sola riga per coppia ubicazione-SKU: l'indice copre anche le ricerche per sola ubicazione
+Index('uq_inventory_location_sku', Inventory.location_name, Inventory.product_sku, unique=True)
+
+
+class StockMovement(Base):
+    """
+    Registro append-only delle variazioni di giacenza, scritto nella stessa transazione
+    della modifica di inventory. Senza chiavi esterne: lo storico sopravvive a prodotti e
+    ubicazioni eliminati. location_from vuota = entrata, location_to vuota = uscita.
+    """
+    __tablename__ = "stock_movements"
+
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    product_sku = Column(String, nullable=False)
+    location_from = Column(String)
+    location_to = Column(String)
+    quantity = Column(Integer, nullable=False)  # sempre positiva
+    reason = Column(String(100), nullable=False)  # OperationType o endpoint di origine
+    order_number = Column(String)
+    batch_id = Column(String(36))  # uguale per tutti i movimenti dello stesso commit
+    user_id = Column(String(50))
+
+
+class StockSnapshot(Base):
+    """
+    Fotografia notturna delle giacenze per ubicazione. last_movement_id è l'ultimo movimento
+    già compreso nella fotografia: la giacenza a una data si ottiene dalla fotografia
+    precedente più i movimenti successivi.
+    """
+    __tablename__ = "stock_snapshots"
+
+    id = Column(Integer, primary_key=True)
+    taken_at = Column(DateTime, nullable=False)
+    last_movement_id = Column(Integer, nullable=False, default=0)
+    location_name = Column(String, nullable=False)
+    product_sku = Column(String, nullable=False)
+    quantity = Column(Integer, nullable=False)
+
+
+# Storico per SKU, per ubicazione (entrate e uscite), per ordine e per intervallo di date
+Index('ix_stock_movements_sku_timestamp', StockMovement.product_sku, StockMovement.timestamp)
+Index('ix_stock_movements_from_timestamp', StockMovement.location_from, StockMovement.timestamp)
+Index('ix_stock_movements_to_timestamp', StockMovement.location_to, StockMovement.timestamp)
+Index('ix_stock_movements_order_number', StockMovement.order_number)
+Index('ix_stock_movements_timestamp', StockMovement.timestamp)
+Index('ix_stock_snapshots_taken_at_location', StockSnapshot.taken_at, StockSnapshot.location_name)
@@ -71,6 +71,7 @@ class OperationType:
     SCARICO_FILE = "SCARICO_FILE"
     SPOSTAMENTO_FILE = "SPOSTAMENTO_FILE"
     RIALLINEAMENTO_FILE = "RIALLINEAMENTO_FILE"
+    RIPRISTINO_GIACENZE = "RIPRISTINO_GIACENZE"
     
     # Operazioni Container/Terra
     SCARICO_CONTAINER_MANUALE = "SCARICO_CONTAINER_MANUALE"
@@ -24,19 +24,23 @@ class OrderLine(Base):
     __tablename__ = "order_lines"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)
     product_sku = Column(String, ForeignKey("products.sku"))
     requested_quantity = Column(Integer)
     picked_quantity = Column(Integer, default=0)
+    # Concorrenza ottimistica sui prelievi paralleli della stessa riga (vedi services/optimistic_lock.py)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     order = relationship("Order", back_populates="lines")
     product = relationship("Product")
 
+    __mapper_args__ = {"version_id_col": version}
+
 class OutgoingStock(Base):
     __tablename__ = "outgoing_stock"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_line_id = Column(Integer, ForeignKey("order_lines.id"))
+    order_line_id = Column(Integer, ForeignKey("order_lines.id"), index=True)
     product_sku = Column(String, ForeignKey("products.sku"))
     quantity = Column(Integer)
     # Potremmo aggiungere qui l'ubicazione da cui è stato prelevato, se necessario per tracciabilità
@@ -18,6 +18,6 @@ class EanCode(Base):
     __tablename__ = "ean_codes"
 
     ean = Column(String, primary_key=True, index=True)
-    product_sku = Column(String, ForeignKey("products.sku"))
+    product_sku = Column(String, ForeignKey("products.sku"), index=True)
 
     product = relationship("Product", back_populates="eans")
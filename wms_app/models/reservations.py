@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from wms_app.database.database import Base
@@ -20,4 +20,7 @@ class InventoryReservation(Base):
     product = relationship("Product")
     
     def __repr__(self):
-        return f"<Reservation(order={self.order_id}, sku={self.product_sku}, loc={self.location_name}, qty={self.reserved_quantity})>"
\ No newline at end of file
+        return f"<Reservation(order={self.order_id}, sku={self.product_sku}, loc={self.location_name}, qty={self.reserved_quantity})>"
+
+# Indice per la ricerca delle prenotazioni attive e non scadute di uno SKU
+Index('ix_reservations_sku_status_expires', InventoryReservation.product_sku, InventoryReservation.status, InventoryReservation.expires_at)
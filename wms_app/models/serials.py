@@ -15,7 +15,7 @@ class ProductSerial(Base):
     order_number = Column(String, nullable=False, index=True)  # Numero ordine (1-10 cifre)
     product_sku = Column(String, ForeignKey("products.sku"), nullable=False)  # SKU del prodotto
     ean_code = Column(String, nullable=False, index=True)  # EAN code originale dal file
-    serial_number = Column(String, nullable=False)  # Numero seriale del prodotto
+    serial_number = Column(String, nullable=False, index=True)  # Numero seriale del prodotto
     
     # Timestamps
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -1,13 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 from typing import List
 from wms_app.database.database import get_db
+from wms_app.database.query_plans import check_hot_queries
+from wms_app.database.instrumentation import endpoint_metrics, QUERY_METRICS_ENABLED, QUERY_METRICS_WINDOW, QUERY_NPLUS1_THRESHOLD
+from wms_app.database.slow_query_log import slow_query_log, SLOW_QUERY_THRESHOLD_MS
 from wms_app.routers.auth import require_role, get_current_user
 from wms_app.models.auth import User, Role, Permission
 from wms_app.schemas.auth import UserCreate, UserUpdate, User as UserSchema, RoleCreate, Role as RoleSchema
 from wms_app.services.auth_service import AuthService
+from wms_app.services.auth_cache import authenticated_user_cache
+from wms_app.services.password_hasher import PasswordHasherBusy, password_hasher
+from wms_app.services.permission_registry import permission_registry
+from wms_app.services.barcode_resolver import barcode_resolver
+from wms_app.services.location_occupancy import occupancy_index
 from wms_app.services.backup_service import BackupService
 
 router = APIRouter(prefix="/admin", tags=["admin"])
@@ -75,16 +84,25 @@ async def get_all_roles(current_user = Depends(require_role("admin")), db: Sessi
 async def create_user(user_data: UserCreate, current_user = Depends(require_role("admin")), db: Session = Depends(get_db)):
     """Crea un nuovo utente - solo per admin"""
     try:
+        # Controlli di unicità prima dell'hash: le richieste duplicate non occupano il pool del KDF
+        AuthService.ensure_user_is_new(db, user_data.username, user_data.email)
         user = AuthService.create_user(
             db=db,
             username=user_data.username,
             email=user_data.email,
-            password=user_data.password,
-            role_names=user_data.role_names
+            password=None,
+            role_names=user_data.role_names,
+            password_hash=await password_hasher.hash_async(user_data.password)
         )
         return user
     except HTTPException as e:
         raise e
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Troppe operazioni sulle password in corso, riprova tra qualche secondo",
+            headers={"Retry-After": "2"},
+        )
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -119,6 +137,7 @@ async def update_user(user_id: int, user_data: UserUpdate, current_user = Depend
         user.roles = roles
     
     db.commit()
+    authenticated_user_cache.invalidate_user(user_id)
     db.refresh(user)
     return user
 
@@ -135,6 +154,7 @@ async def delete_user(user_id: int, current_user = Depends(require_role("admin")
     
     db.delete(user)
     db.commit()
+    authenticated_user_cache.invalidate_user(user_id)
     return {"message": "Utente eliminato con successo"}
 
 
@@ -157,6 +177,7 @@ async def create_role(role_data: RoleCreate, current_user = Depends(require_role
         role.permissions = permissions
     
     db.commit()
+    permission_registry.bump_version()
     db.refresh(role)
     return role
 
@@ -190,6 +211,8 @@ async def update_role(role_id: int, role_data: dict, current_user = Depends(requ
         role.permissions = permissions
     
     db.commit()
+    authenticated_user_cache.clear()
+    permission_registry.bump_version()
     db.refresh(role)
     return {"message": "Ruolo aggiornato con successo", "role": role}
 
@@ -210,6 +233,8 @@ async def delete_role(role_id: int, current_user = Depends(require_role("admin")
     
     db.delete(role)
     db.commit()
+    authenticated_user_cache.clear()
+    permission_registry.bump_version()
     return {"message": "Ruolo eliminato con successo"}
 
 @router.get("/api/permissions", response_model=List[dict])
@@ -275,6 +300,11 @@ async def restore_backup(
     try:
         backup_service = BackupService(db)
         result = backup_service.restore_backup(backup_id, user_id=current_user.username)
+        # Utenti, ruoli e catalogo del backup possono differire da quelli in cache
+        authenticated_user_cache.clear()
+        permission_registry.bump_version()
+        barcode_resolver.bump_version()
+        occupancy_index.invalidate()
         return result
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -337,4 +367,69 @@ async def cleanup_old_backups(
         result = backup_service.cleanup_old_backups()
         return result
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante pulizia backup: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Errore durante pulizia backup: {str(e)}")
+
+# ==================== DATABASE ENDPOINTS ====================
+
+@router.get("/api/database/index-report")
+async def get_index_report(
+    current_user = Depends(require_role("admin")), 
+    db: Session = Depends(get_db)
+):
+    """Riporta quali query hot path usano un indice e quali fanno scansioni complete - solo per admin"""
+    try:
+        return check_hot_queries(db.connection())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore durante analisi indici: {str(e)}")
+
+@router.get("/api/database/occupancy-audit")
+async def get_occupancy_audit(
+    current_user = Depends(require_role("admin")),
+    db: Session = Depends(get_db)
+):
+    """Confronta l'indice di occupazione delle ubicazioni con la tabella inventory - solo per admin"""
+    try:
+        return await run_in_threadpool(occupancy_index.audit, db)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore durante verifica indice di occupazione: {str(e)}")
+
+@router.get("/api/database/request-metrics")
+async def get_request_metrics(current_user = Depends(require_role("admin"))):
+    """Query e tempo database per endpoint sulle ultime richieste - solo per admin"""
+    return {
+        "enabled": QUERY_METRICS_ENABLED,
+        "window": QUERY_METRICS_WINDOW,
+        "nplus1_threshold": QUERY_NPLUS1_THRESHOLD,
+        "endpoints": endpoint_metrics.snapshot()
+    }
+
+@router.delete("/api/database/request-metrics")
+async def reset_request_metrics(current_user = Depends(require_role("admin"))):
+    """Azzera la tabella delle metriche per endpoint - solo per admin"""
+    endpoint_metrics.clear()
+    return {"message": "Metriche azzerate"}
+
+@router.get("/api/database/slow-queries")
+async def get_slow_queries(
+    limit: int = 50,
+    order_by: str = "max_ms",
+    current_user = Depends(require_role("admin"))
+):
+    """Query più lente con piano di esecuzione (order_by: max_ms, total_ms, avg_ms, count) - solo per admin"""
+    if slow_query_log is None:
+        return {"enabled": False, "threshold_ms": SLOW_QUERY_THRESHOLD_MS, "queries": []}
+    queries = slow_query_log.worst(limit=max(1, min(limit, 500)), order_by=order_by)
+    return {
+        "enabled": True,
+        "threshold_ms": slow_query_log.threshold_ms,
+        "total_shapes": len(queries),
+        "full_scans": sum(1 for query in queries if query["uses_index"] is False),
+        "queries": queries
+    }
+
+@router.delete("/api/database/slow-queries")
+async def reset_slow_queries(current_user = Depends(require_role("admin"))):
+    """Svuota lo slow query log in memoria (il file a rotazione resta) - solo per admin"""
+    if slow_query_log is not None:
+        slow_query_log.clear()
+    return {"message": "Slow query log azzerato"}
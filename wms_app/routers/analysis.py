@@ -17,7 +17,7 @@ from wms_app.models.products import Product
 from wms_app.models.inventory import Inventory, Location
 from wms_app.models.orders import OutgoingStock, Order, OrderLine
 from wms_app.schemas import analysis as analysis_schemas
-from wms_app.database import get_db
+from wms_app.database import get_read_db
 from wms_app.routers.auth import require_permission
 from fastapi.templating import Jinja2Templates
 
@@ -35,7 +35,7 @@ async def test_endpoint():
     return {"status": "OK", "message": "Server funziona correttamente"}
 
 @router.get("/orders-statistics")
-def get_orders_statistics(db: Session = Depends(get_db), current_user = Depends(require_permission("analysis_dashboard"))):
+def get_orders_statistics(db: Session = Depends(get_read_db), current_user = Depends(require_permission("analysis_dashboard"))):
     """Get orders statistics for current and previous month."""
     
     # Get current date
@@ -163,7 +163,7 @@ async def get_analysis_dashboard(request: Request):
     return templates.TemplateResponse("analysis.html", {"request": request, "active_page": "analysis"})
 
 @router.get("/data", response_model=analysis_schemas.AnalysisPageData)
-def get_analysis_data(db: Session = Depends(get_db)):
+def get_analysis_data(db: Session = Depends(get_read_db)):
     """Endpoint per recuperare tutti i dati aggregati per la dashboard di analisi."""
 
     # 1. Calcolo dei KPI delle ubicazioni
@@ -175,8 +175,10 @@ def get_analysis_data(db: Session = Depends(get_db)):
     )
     occupied_locations = occupied_locations_query.scalar() or 0
     
-    ground_floor_locations = db.query(func.count(Location.name)).filter(Location.name.like('%1P%')).scalar() or 0
-    occupied_ground_floor_locations = occupied_locations_query.filter(Inventory.location_name.like('%1P%')).scalar() or 0
+    ground_floor_locations = db.query(func.count(Location.name)).filter(Location.piano == 1).scalar() or 0
+    occupied_ground_floor_locations = occupied_locations_query.join(
+        Location, Location.name == Inventory.location_name
+    ).filter(Location.piano == 1).scalar() or 0
     free_ground_floor_locations = ground_floor_locations - occupied_ground_floor_locations
 
     # 2. Calcolo dei KPI di inventario
@@ -275,13 +277,13 @@ def get_analysis_data(db: Session = Depends(get_db)):
     return analysis_schemas.AnalysisPageData(kpis=kpis, total_stock_by_product=total_stock_list)
 
 @router.get("/outgoing-stock-total")
-def get_outgoing_stock_total(db: Session = Depends(get_db)):
+def get_outgoing_stock_total(db: Session = Depends(get_read_db)):
     """Endpoint per ottenere il totale della giacenza in uscita"""
     total_pieces_outgoing = db.query(func.sum(OutgoingStock.quantity)).scalar() or 0
     return {"total": total_pieces_outgoing}
 
 @router.get("/critical-stock-details")
-def get_critical_stock_details(db: Session = Depends(get_db)):
+def get_critical_stock_details(db: Session = Depends(get_read_db)):
     """Endpoint per ottenere la lista dettagliata degli SKU con giacenza critica (≤ 20 pezzi)"""
     # Calcoliamo la giacenza totale per ogni SKU (come nel main endpoint)
     
@@ -376,13 +378,13 @@ def _get_product_locations_data(sku: str, db: Session):
     return [analysis_schemas.ProductLocationItem(location_name=item.location_name, quantity=item.quantity) for item in locations]
 
 @router.get("/product-locations/{sku:path}", response_model=List[analysis_schemas.ProductLocationItem])
-def get_product_locations(sku: str, db: Session = Depends(get_db)):
+def get_product_locations(sku: str, db: Session = Depends(get_read_db)):
     """Dato uno SKU, restituisce tutte le ubicazioni che lo contengono."""
     return _get_product_locations_data(sku, db)
 
 
 @router.get("/export-product-locations/{sku:path}")
-async def export_product_locations_csv(sku: str, db: Session = Depends(get_db)):
+async def export_product_locations_csv(sku: str, db: Session = Depends(get_read_db)):
     """Esporta le ubicazioni di un prodotto in formato CSV."""
     locations = _get_product_locations_data(sku, db) # Riusiamo la logica dell'endpoint precedente
 
@@ -400,7 +402,7 @@ async def export_product_locations_csv(sku: str, db: Session = Depends(get_db)):
     )
 
 @router.get("/export-product-locations-pdf/{sku:path}")
-async def export_product_locations_pdf(sku: str, db: Session = Depends(get_db)):
+async def export_product_locations_pdf(sku: str, db: Session = Depends(get_read_db)):
     """Esporta le ubicazioni di un prodotto in formato PDF."""
     try:
         # Ottieni direttamente i dati
@@ -534,31 +536,19 @@ async def export_product_locations_pdf(sku: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Errore nella generazione PDF: {str(e)}")
 
 @router.get("/products-by-row/{fila}", response_model=List[analysis_schemas.ProductInRowItem])
-def get_products_by_row(fila: int, db: Session = Depends(get_db)):
+def get_products_by_row(fila: int, db: Session = Depends(get_read_db)):
     """Restituisce tutti i prodotti e le loro ubicazioni per una data fila."""
-    # Filtra le ubicazioni che iniziano ESATTAMENTE con il numero della fila seguito da una lettera
-    # Formato ubicazioni: {FILA}{LETTERA}{RESTO} (es. 2A1P1, 21A1P1)
-    # Uso LIKE con controllo che il carattere dopo il numero sia una lettera
-    
+    # Fila dalla colonna indicizzata Location.fila (es. fila 2 = 2A1P1, non 21A1P1)
     products_query = db.query(
         Inventory.location_name,
         Inventory.product_sku,
         Product.description,
         Inventory.quantity
-    ).join(Product, Inventory.product_sku == Product.sku)
+    ).join(Product, Inventory.product_sku == Product.sku).join(
+        Location, Location.name == Inventory.location_name
+    )
 
-    # Pattern per matchare esattamente la fila: inizia con il numero + almeno una lettera
-    fila_pattern = f"{fila}A%"
-    
-    # Query che filtra ubicazioni che iniziano con {fila}A, {fila}B, {fila}C, etc.
-    # ma NON {fila}1, {fila}2, etc. (che sarebbero altre file)
-    from sqlalchemy import or_
-    
-    letter_patterns = [f"{fila}{letter}%" for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
-    
-    filtered_products = products_query.filter(
-        or_(*[Inventory.location_name.like(pattern) for pattern in letter_patterns])
-    ).filter(Inventory.quantity > 0)
+    filtered_products = products_query.filter(Location.fila == fila).filter(Inventory.quantity > 0)
     
     products_in_row = filtered_products.order_by(Inventory.location_name, Inventory.product_sku).all()
 
@@ -573,7 +563,7 @@ def get_products_by_row(fila: int, db: Session = Depends(get_db)):
     ) for item in products_in_row]
 
 @router.get("/export-products-by-row/{fila}")
-async def export_products_by_row_csv(fila: int, db: Session = Depends(get_db)):
+async def export_products_by_row_csv(fila: int, db: Session = Depends(get_read_db)):
     """Esporta i prodotti di una fila in formato CSV."""
     products_data = get_products_by_row(fila, db) # Riusiamo la logica dell'endpoint precedente
     
@@ -591,7 +581,7 @@ async def export_products_by_row_csv(fila: int, db: Session = Depends(get_db)):
     )
 
 @router.get("/export-products-by-row-pdf/{fila}")
-async def export_products_by_row_pdf(fila: int, db: Session = Depends(get_db)):
+async def export_products_by_row_pdf(fila: int, db: Session = Depends(get_read_db)):
     """Esporta i prodotti di una fila in formato PDF."""
     # Query diretta per evitare problemi di caching
     
@@ -600,13 +590,11 @@ async def export_products_by_row_pdf(fila: int, db: Session = Depends(get_db)):
         Inventory.product_sku,
         Product.description,
         Inventory.quantity
-    ).join(Product, Inventory.product_sku == Product.sku)
+    ).join(Product, Inventory.product_sku == Product.sku).join(
+        Location, Location.name == Inventory.location_name
+    )
 
-    letter_patterns = [f"{fila}{letter}%" for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
-    
-    filtered_products = products_query.filter(
-        or_(*[Inventory.location_name.like(pattern) for pattern in letter_patterns])
-    ).filter(Inventory.quantity > 0)
+    filtered_products = products_query.filter(Location.fila == fila).filter(Inventory.quantity > 0)
     
     products_in_row = filtered_products.order_by(Inventory.location_name, Inventory.product_sku).all()
 
@@ -726,7 +714,7 @@ async def export_products_by_row_pdf(fila: int, db: Session = Depends(get_db)):
     )
 
 @router.get("/pallet-summary", response_model=analysis_schemas.PalletSummary)
-def get_pallet_summary(db: Session = Depends(get_db)):
+def get_pallet_summary(db: Session = Depends(get_read_db)):
     """Calcola il totale pallet nel magazzino. 
     Scaffali: 1 pallet per ubicazione occupata.
     Terra: CEIL(quantità / pallet_quantity)."""
@@ -770,7 +758,7 @@ def get_pallet_summary(db: Session = Depends(get_db)):
     )
 
 @router.get("/pallet-details", response_model=analysis_schemas.PalletDetails)
-def get_pallet_details(db: Session = Depends(get_db)):
+def get_pallet_details(db: Session = Depends(get_read_db)):
     """Ottiene il dettaglio completo dei pallet per prodotto.
     Scaffali: conta ubicazioni occupate per SKU.
     Terra: CEIL(quantità / pallet_quantity)."""
@@ -881,7 +869,7 @@ def get_pallet_details(db: Session = Depends(get_db)):
     )
 
 @router.get("/debug-location-count")
-def debug_location_count(db: Session = Depends(get_db)):
+def debug_location_count(db: Session = Depends(get_read_db)):
     """Debug endpoint per confrontare i due conteggi ubicazioni."""
     
     # Query 1: Dashboard KPI (distinct location_name)
@@ -919,7 +907,7 @@ def debug_location_count(db: Session = Depends(get_db)):
     }
 
 @router.get("/products-on-ground", response_model=List[analysis_schemas.ProductInRowItem])
-def get_products_on_ground(db: Session = Depends(get_db)):
+def get_products_on_ground(db: Session = Depends(get_read_db)):
     """Restituisce tutti i prodotti a TERRA."""
     products_query = db.query(
         Inventory.location_name,
@@ -944,7 +932,7 @@ def get_products_on_ground(db: Session = Depends(get_db)):
     ) for item in products_on_ground]
 
 @router.get("/export-products-on-ground-csv")
-async def export_products_on_ground_csv(db: Session = Depends(get_db)):
+async def export_products_on_ground_csv(db: Session = Depends(get_read_db)):
     """Esporta i prodotti a TERRA in formato CSV."""
     products_data = get_products_on_ground(db)
     
@@ -965,7 +953,7 @@ async def export_products_on_ground_csv(db: Session = Depends(get_db)):
     )
 
 @router.get("/export-products-on-ground-pdf")
-async def export_products_on_ground_pdf(db: Session = Depends(get_db)):
+async def export_products_on_ground_pdf(db: Session = Depends(get_read_db)):
     """Esporta i prodotti a TERRA in formato PDF."""
     # Query diretta per prodotti a TERRA
     products_query = db.query(
@@ -1107,7 +1095,7 @@ async def export_products_on_ground_pdf(db: Session = Depends(get_db)):
     )
 
 @router.get("/export-total-stock-csv")
-async def export_total_stock_csv(db: Session = Depends(get_db)):
+async def export_total_stock_csv(db: Session = Depends(get_read_db)):
     """Esporta tutta la giacenza del magazzino in formato CSV."""
     from datetime import datetime
     
@@ -6,6 +6,7 @@ from sqlalchemy.orm import Session
 from wms_app.database.database import get_db
 from wms_app.services.auth_service import AuthService
 from wms_app.services.jwt_service import JWTService, ACCESS_TOKEN_EXPIRE_MINUTES
+from wms_app.services.password_hasher import PasswordHasherBusy
 from wms_app.schemas.auth import UserLogin, Token, User, UserWithPermissions, RefreshTokenRequest
 from wms_app.models.auth import User as UserModel
 from wms_app.middleware.auth_middleware import get_current_user_from_middleware
@@ -16,7 +17,14 @@ security = HTTPBearer()
 @router.post("/login", response_model=dict)
 async def login(user_login: UserLogin, db: Session = Depends(get_db)):
     """Endpoint per il login utente con JWT e refresh token"""
-    user = AuthService.authenticate_user(db, user_login.username, user_login.password)
+    try:
+        user = await AuthService.authenticate_user_async(db, user_login.username, user_login.password)
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Troppi accessi contemporanei, riprova tra qualche secondo",
+            headers={"Retry-After": "2"},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -44,7 +52,7 @@ async def logout(refresh_token_data: RefreshTokenRequest, db: Session = Depends(
     else:
         return {"message": "Logout effettuato (token già scaduto)"}
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
     """Dependency legacy per ottenere l'utente corrente dal token JWT"""
     if not credentials:
         raise HTTPException(
@@ -53,6 +61,13 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    authenticated_user = getattr(request.state, "current_user", None)
+    if authenticated_user is not None:
+        # Token già verificato dal middleware: l'utente è nella sessione della richiesta
+        user = db.get(UserModel, authenticated_user.id)
+        if user and user.is_active:
+            return user
+    
     token = credentials.credentials
     user = AuthService.get_user_from_token(db, token)
     
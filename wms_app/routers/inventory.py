@@ -1,15 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response
 from fastapi.responses import HTMLResponse, JSONResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, joinedload
-from typing import Dict
+from typing import Dict, Optional
+from datetime import datetime, timezone
 from collections import defaultdict
 
 from wms_app import models
 from wms_app.schemas import inventory as inventory_schemas
-from wms_app.database import get_db
+from wms_app.database import get_db, get_async_db, get_write_lock
 from wms_app.routers.auth import require_permission
 from wms_app.services.logging_service import LoggingService
+from wms_app.services.barcode_resolver import barcode_resolver
+from wms_app.services.consolidation_planner import ConsolidationPlanner
+from wms_app.services.inventory_mutation_service import BULK_CHUNK_SIZE, InventoryMutationService
+from wms_app.services.location_occupancy import OccupancySnapshot
+from wms_app.services.optimistic_lock import run_with_retry, run_with_retry_async
+from wms_app.services.stock_ledger import StockLedgerService, set_ledger_context
+from wms_app.services.upload_reader import iter_file_lines, iter_upload_lines, read_upload_tokens
 from wms_app.models.logs import OperationType, OperationCategory, OperationStatus
 from fastapi.templating import Jinja2Templates
 
@@ -21,19 +32,16 @@ router = APIRouter(
 )
 
 async def _parse_movement_file(file: UploadFile, db: Session) -> Dict[str, Dict[str, int]]:
-    content = await file.read()
-    try:
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
-
-    lines = text_content.splitlines()
     parsed_data = defaultdict(lambda: defaultdict(int))
     current_location = None
     errors = []
     all_locations = {loc.name for loc in db.query(models.Location).all()}
+    barcode_resolver.ensure_loaded(db)
 
-    for i, line_content in enumerate(lines):
+    # Righe lette a blocchi dal file caricato: il corpo non viene mai tenuto tutto in memoria
+    line_number = 0
+    async for line_content in iter_upload_lines(file):
+        line_number += 1
         line = line_content.strip()
         if not line:
             continue
@@ -43,7 +51,7 @@ async def _parse_movement_file(file: UploadFile, db: Session) -> Dict[str, Dict[
             continue
         
         if not current_location:
-            errors.append(f"Riga {i+1}: Trovato EAN/SKU '{line}' senza un'ubicazione valida che lo preceda.")
+            errors.append(f"Riga {line_number}: Trovato EAN/SKU '{line}' senza un'ubicazione valida che lo preceda.")
             continue
 
         ean_or_sku = line
@@ -55,23 +63,15 @@ async def _parse_movement_file(file: UploadFile, db: Session) -> Dict[str, Dict[
                 ean_or_sku = parts[0]
                 quantity = int(parts[1])
             else:
-                errors.append(f"Riga {i+1}: Formato EAN/SKU_Quantità non valido: '{line}'")
+                errors.append(f"Riga {line_number}: Formato EAN/SKU_Quantità non valido: '{line}'")
                 continue
 
-        sku_found = None
-
-        ean_code = db.query(models.EanCode).filter(models.EanCode.ean == ean_or_sku).first()
-        if ean_code:
-            sku_found = ean_code.product_sku
-        else:
-            product = db.query(models.Product).filter(models.Product.sku == ean_or_sku).first()
-            if product:
-                sku_found = product.sku
+        sku_found = await barcode_resolver.resolve_sku_async(ean_or_sku)
 
         if sku_found:
             parsed_data[current_location][sku_found] += quantity
         else:
-            errors.append(f"Riga {i+1}: EAN/SKU '{ean_or_sku}' non trovato nel database.")
+            errors.append(f"Riga {line_number}: EAN/SKU '{ean_or_sku}' non trovato nel database.")
 
     if errors:
         raise HTTPException(status_code=400, detail="\n".join(errors))
@@ -84,23 +84,24 @@ async def parse_add_stock_file(file: UploadFile = File(...), db: Session = Depen
     """
     Analizza un file di carico e restituisce un recap delle operazioni da effettuare con validazioni.
     """
-    content = await file.read()
-    try:
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
+    # L'analisi gira nel threadpool: un file grande non blocca l'event loop
+    # e gli altri terminali continuano a essere serviti. Le righe sono lette a blocchi
+    # dal file temporaneo dell'upload durante l'analisi stessa.
+    return await run_in_threadpool(_build_add_stock_recap, iter_file_lines(file.file), db)
 
-    lines = text_content.splitlines()
-    recap_items = []
+
+def _tokenize_stock_file(lines, all_locations):
+    """
+    Prima passata di un file di carico/scarico, senza query: riconosce ubicazioni e codici,
+    risolve EAN/SKU dal catalogo in memoria e consolida le quantità per (ubicazione, SKU)
+    """
     errors = []
-    warnings = []
-    current_location = None
-    locations_with_content = set()  # Traccia ubicazioni che hanno EAN/SKU
-    all_locations = {loc.name for loc in db.query(models.Location).all()}
     found_locations = []  # Traccia tutte le ubicazioni trovate nel file
-    
+    locations_with_content = set()  # Traccia ubicazioni che hanno EAN/SKU
+    scanned_lines = []  # (riga, ubicazione, sku, codice, quantità) nell'ordine del file
     # CORREZIONE BUG: Dizionario per consolidare quantità per (ubicazione, sku)
     consolidated_operations = {}  # {(location, sku): {'quantity': total, 'lines': [line_numbers], 'input_codes': [codes]}}
+    current_location = None
 
     for i, line_content in enumerate(lines):
         line = line_content.strip()
@@ -112,7 +113,7 @@ async def parse_add_stock_file(file: UploadFile = File(...), db: Session = Depen
             current_location = line
             found_locations.append({"location": line, "line": i+1})
             continue
-        
+
         if not current_location:
             errors.append({
                 "line": i+1,
@@ -147,20 +148,8 @@ async def parse_add_stock_file(file: UploadFile = File(...), db: Session = Depen
                 })
                 continue
 
-        # Trova SKU dal database
-        sku_found = None
-        product_description = ""
-
-        ean_code = db.query(models.EanCode).filter(models.EanCode.ean == ean_or_sku).first()
-        if ean_code:
-            sku_found = ean_code.product_sku
-            product = db.query(models.Product).filter(models.Product.sku == sku_found).first()
-            product_description = product.description if product else ""
-        else:
-            product = db.query(models.Product).filter(models.Product.sku == ean_or_sku).first()
-            if product:
-                sku_found = product.sku
-                product_description = product.description
+        # Trova SKU dal catalogo in memoria
+        sku_found = barcode_resolver.resolve_sku(ean_or_sku)
 
         if not sku_found:
             errors.append({
@@ -173,26 +162,9 @@ async def parse_add_stock_file(file: UploadFile = File(...), db: Session = Depen
             })
             continue
 
-        # Controlla unicità SKU per ubicazione (ECCEZIONE: TERRA può contenere SKU multipli)
-        existing_inventory = None
-        if current_location != "TERRA":
-            existing_inventory = db.query(models.Inventory).filter(
-                models.Inventory.location_name == current_location,
-                models.Inventory.product_sku != sku_found,
-                models.Inventory.quantity > 0
-            ).first()
-
-        current_inventory = db.query(models.Inventory).filter(
-            models.Inventory.location_name == current_location,
-            models.Inventory.product_sku == sku_found
-        ).first()
-
-        current_qty = current_inventory.quantity if current_inventory else 0
-        new_qty = current_qty + quantity
-
-        # CORREZIONE BUG: Consolida quantità invece di creare entry duplicate
+        scanned_lines.append((i+1, current_location, sku_found, ean_or_sku, quantity))
+
         operation_key = (current_location, sku_found)
-        
         if operation_key in consolidated_operations:
             # Aggiungi alla quantità esistente
             consolidated_operations[operation_key]['quantity'] += quantity
@@ -200,41 +172,93 @@ async def parse_add_stock_file(file: UploadFile = File(...), db: Session = Depen
             consolidated_operations[operation_key]['input_codes'].append(ean_or_sku)
         else:
             # Crea nuova entry consolidata
+            product = barcode_resolver.get_product(sku_found)
             consolidated_operations[operation_key] = {
                 'quantity': quantity,
                 'lines': [i+1],
                 'input_codes': [ean_or_sku],
                 'location': current_location,
                 'sku': sku_found,
-                'description': product_description,
-                'existing_inventory': existing_inventory
+                'description': product.description if product else ""
             }
 
+    return {
+        "errors": errors,
+        "found_locations": found_locations,
+        "locations_with_content": locations_with_content,
+        "scanned_lines": scanned_lines,
+        "consolidated_operations": consolidated_operations,
+    }
+
+
+def _manual_input_entries(parsed: dict, quantity_field: str):
+    """Warning e righe di recap per le ubicazioni senza EAN/SKU (inserimento manuale)"""
+    warnings = []
+    recap_items = []
+    for loc_info in parsed["found_locations"]:
+        location = loc_info["location"]
+        if location not in parsed["locations_with_content"]:
+            warnings.append({
+                "line": loc_info["line"],
+                "type": "empty_location",
+                "message": f"Ubicazione '{location}' trovata senza EAN/SKU. Inserisci manualmente i dati nel recap.",
+                "ean_sku": "",
+                "location": location,
+                "quantity": 0
+            })
+
+            # Aggiungi entry nel recap per inserimento manuale
+            recap_items.append({
+                "line": loc_info["line"],
+                "location": location,
+                "sku": "",  # Vuoto per inserimento manuale
+                "description": "",
+                "input_code": "",
+                quantity_field: 0,  # Sarà inserito manualmente
+                "current_quantity": 0,
+                "new_quantity": 0,
+                "status": "manual_input",  # Nuovo stato per inserimento manuale
+                "needs_input": True  # Flag per identificare righe che necessitano input
+            })
+    return warnings, recap_items
+
+
+def _build_add_stock_recap(lines, db: Session):
+    """
+    Costruisce recap, errori e warning di un file di carico (sincrono, eseguito nel threadpool).
+    Analisi del file in memoria; giacenze attuali e conflitti vengono letti dal database per le
+    sole ubicazioni del file (query IN a blocchi), non dall'indice di occupazione del processo.
+    """
+    all_locations = {name for (name,) in db.query(models.Location.name).all()}
+    barcode_resolver.ensure_loaded(db)
+    parsed = _tokenize_stock_file(lines, all_locations)
+    consolidated_operations = parsed["consolidated_operations"]
+    occupancy = OccupancySnapshot.load(db, (location for location, _ in consolidated_operations))
+
+    recap_items = []
+    errors = parsed["errors"]
+    warnings = []
+
     # CORREZIONE BUG: Converti operazioni consolidate in recap_items
     for (location, sku), operation_data in consolidated_operations.items():
-        # Ricalcola giacenze con quantità consolidata
-        current_inventory = db.query(models.Inventory).filter(
-            models.Inventory.location_name == location,
-            models.Inventory.product_sku == sku
-        ).first()
-        
-        current_qty = current_inventory.quantity if current_inventory else 0
+        current_qty = occupancy.quantity(location, sku)
         consolidated_quantity = operation_data['quantity']
         new_qty = current_qty + consolidated_quantity
-        
-        # Controlla conflitti per l'operazione consolidata
-        existing_inventory = operation_data['existing_inventory']
-        if existing_inventory:
+
+        # Controlla unicità SKU per ubicazione (ECCEZIONE: TERRA può contenere SKU multipli)
+        conflict = occupancy.conflicting_sku(location, sku)
+        conflicting_sku = conflict[0] if conflict else None
+        if conflicting_sku:
             warnings.append({
                 "line": operation_data['lines'][0],  # Prima riga che ha causato il conflitto
                 "type": "location_conflict", 
-                "message": f"CONFLITTO: Ubicazione '{location}' contiene già '{existing_inventory.product_sku}'. Una ubicazione può contenere solo un tipo di prodotto.",
+                "message": f"CONFLITTO: Ubicazione '{location}' contiene già '{conflicting_sku}'. Una ubicazione può contenere solo un tipo di prodotto.",
                 "ean_sku": operation_data['input_codes'][0],
                 "location": location,
                 "quantity": consolidated_quantity,
-                "conflicting_sku": existing_inventory.product_sku
+                "conflicting_sku": conflicting_sku
             })
-        
+
         # Crea recap item consolidato
         recap_items.append({
             "line": operation_data['lines'][0],  # Prima riga per riferimento
@@ -245,37 +269,15 @@ async def parse_add_stock_file(file: UploadFile = File(...), db: Session = Depen
             "quantity_to_add": consolidated_quantity,
             "current_quantity": current_qty,
             "new_quantity": new_qty,
-            "status": "warning" if existing_inventory else "ok",
+            "status": "warning" if conflicting_sku else "ok",
             "consolidated_from_lines": operation_data['lines'],  # Per debug
             "consolidated_quantity": consolidated_quantity  # Per evidenziare il consolidamento
         })
 
     # Aggiungi ubicazioni senza EAN/SKU come operazioni manuali
-    for loc_info in found_locations:
-        location = loc_info["location"]
-        if location not in locations_with_content:
-            warnings.append({
-                "line": loc_info["line"],
-                "type": "empty_location",
-                "message": f"Ubicazione '{location}' trovata senza EAN/SKU. Inserisci manualmente i dati nel recap.",
-                "ean_sku": "",
-                "location": location,
-                "quantity": 0
-            })
-            
-            # Aggiungi entry nel recap per inserimento manuale
-            recap_items.append({
-                "line": loc_info["line"],
-                "location": location,
-                "sku": "",  # Vuoto per inserimento manuale
-                "description": "",
-                "input_code": "",
-                "quantity_to_add": 0,  # Sarà inserito manualmente
-                "current_quantity": 0,
-                "new_quantity": 0,
-                "status": "manual_input",  # Nuovo stato per inserimento manuale
-                "needs_input": True  # Flag per identificare righe che necessitano input
-            })
+    manual_warnings, manual_items = _manual_input_entries(parsed, "quantity_to_add")
+    warnings.extend(manual_warnings)
+    recap_items.extend(manual_items)
 
     return {
         "recap_items": recap_items,
@@ -294,28 +296,20 @@ async def add_stock_from_file(file: UploadFile = File(...), db: Session = Depend
     if not movements:
         return JSONResponse(status_code=400, content={"detail": "Il file è vuoto o non contiene dati validi da elaborare."})
 
-    processed_items = 0
-    for location, skus in movements.items():
-        # AUTO-DISPONIBILITÀ: Rendi disponibile l'ubicazione se stiamo aggiungendo stock
-        location_obj = db.query(models.Location).filter(models.Location.name == location).first()
-        if location_obj and not location_obj.available:
-            location_obj.available = True
-        
-        for sku, qty_to_add in skus.items():
-            inventory_item = db.query(models.Inventory).filter(
-                models.Inventory.location_name == location,
-                models.Inventory.product_sku == sku
-            ).first()
-
-            if inventory_item:
-                inventory_item.quantity += qty_to_add
-            else:
-                new_item = models.Inventory(location_name=location, product_sku=sku, quantity=qty_to_add)
-                db.add(new_item)
-            processed_items += 1
-    
-    db.commit()
-    return {"message": f"Carico completato con successo. Elaborati {processed_items} movimenti."}
+    def apply_add():
+        # AUTO-DISPONIBILITÀ: le ubicazioni che ricevono stock vengono rese disponibili dal batch
+        batch = InventoryMutationService.batch(db, OperationType.CARICO_FILE)
+        batch.prefetch((location, sku) for location, skus in movements.items() for sku in skus)
+        processed_items = 0
+        for location, skus in movements.items():
+            for sku, qty_to_add in skus.items():
+                batch.adjust(location, sku, qty_to_add)
+                processed_items += 1
+        batch.apply()
+        db.commit()
+        return {"message": f"Carico completato con successo. Elaborati {processed_items} movimenti."}
+
+    return await run_in_threadpool(run_with_retry, db, apply_add)
 
 # Nuovo endpoint per parsing scarico con recap e validazioni
 @router.post("/parse-subtract-stock-file")
@@ -323,154 +317,50 @@ async def parse_subtract_stock_file(file: UploadFile = File(...), db: Session =
     """
     Analizza un file di scarico e restituisce un recap delle operazioni da effettuare con validazioni.
     """
-    content = await file.read()
-    try:
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
-
-    lines = text_content.splitlines()
-    recap_items = []
-    errors = []
-    warnings = []
-    current_location = None
-    locations_with_content = set()  # Traccia ubicazioni che hanno EAN/SKU
-    all_locations = {loc.name for loc in db.query(models.Location).all()}
-    found_locations = []  # Traccia tutte le ubicazioni trovate nel file
-    
-    # CORREZIONE BUG: Dizionario per consolidare quantità per (ubicazione, sku)
-    consolidated_operations = {}  # {(location, sku): {'quantity': total, 'lines': [line_numbers], 'input_codes': [codes]}}
-
-    for i, line_content in enumerate(lines):
-        line = line_content.strip()
-        if not line:
-            continue
-
-        # Controlla se è una ubicazione
-        if line in all_locations:
-            current_location = line
-            found_locations.append({"location": line, "line": i+1})
-            continue
-        
-        if not current_location:
-            errors.append({
-                "line": i+1,
-                "type": "missing_location",
-                "message": f"Riga {i+1}: Trovato EAN/SKU '{line}' senza un'ubicazione valida che lo preceda.",
-                "ean_sku": line,
-                "location": "",
-                "quantity": 1
-            })
-            continue
-
-        # Marca che questa ubicazione ha contenuto
-        locations_with_content.add(current_location)
-
-        # Parse EAN/SKU e quantità
-        ean_or_sku = line
-        quantity = 1
-
-        if '_' in ean_or_sku:
-            parts = ean_or_sku.rsplit('_', 1)
-            if len(parts) == 2 and parts[1].isdigit():
-                ean_or_sku = parts[0]
-                quantity = int(parts[1])
-            else:
-                errors.append({
-                    "line": i+1,
-                    "type": "invalid_format",
-                    "message": f"Riga {i+1}: Formato EAN/SKU_Quantità non valido: '{line}'",
-                    "ean_sku": ean_or_sku,
-                    "location": current_location,
-                    "quantity": quantity
-                })
-                continue
-
-        # Trova SKU dal database
-        sku_found = None
-        product_description = ""
+    # L'analisi gira nel threadpool: un file grande non blocca l'event loop
+    # e gli altri terminali continuano a essere serviti. Le righe sono lette a blocchi
+    # dal file temporaneo dell'upload durante l'analisi stessa.
+    return await run_in_threadpool(_build_subtract_stock_recap, iter_file_lines(file.file), db)
 
-        ean_code = db.query(models.EanCode).filter(models.EanCode.ean == ean_or_sku).first()
-        if ean_code:
-            sku_found = ean_code.product_sku
-            product = db.query(models.Product).filter(models.Product.sku == sku_found).first()
-            product_description = product.description if product else ""
-        else:
-            product = db.query(models.Product).filter(models.Product.sku == ean_or_sku).first()
-            if product:
-                sku_found = product.sku
-                product_description = product.description
 
-        if not sku_found:
-            errors.append({
-                "line": i+1,
-                "type": "product_not_found",
-                "message": f"Riga {i+1}: EAN/SKU '{ean_or_sku}' non trovato nel database.",
-                "ean_sku": ean_or_sku,
-                "location": current_location,
-                "quantity": quantity
-            })
-            continue
-
-        # Controlla giacenza disponibile
-        current_inventory = db.query(models.Inventory).filter(
-            models.Inventory.location_name == current_location,
-            models.Inventory.product_sku == sku_found
-        ).first()
+def _build_subtract_stock_recap(lines, db: Session):
+    """
+    Costruisce recap, errori e warning di un file di scarico (sincrono, eseguito nel threadpool).
+    Come il carico: analisi in memoria, giacenze lette per le sole ubicazioni del file.
+    """
+    all_locations = {name for (name,) in db.query(models.Location.name).all()}
+    barcode_resolver.ensure_loaded(db)
+    parsed = _tokenize_stock_file(lines, all_locations)
+    consolidated_operations = parsed["consolidated_operations"]
+    occupancy = OccupancySnapshot.load(db, (location for location, _ in consolidated_operations))
 
-        current_qty = current_inventory.quantity if current_inventory else 0
-        new_qty = current_qty - quantity
+    recap_items = []
+    errors = parsed["errors"]
+    warnings = []
 
-        status = "ok"
+    # Controlla giacenza disponibile riga per riga (nell'ordine del file)
+    for line_number, location, sku, ean_or_sku, quantity in parsed["scanned_lines"]:
+        current_qty = occupancy.quantity(location, sku)
         if current_qty < quantity:
             warnings.append({
-                "line": i+1,
+                "line": line_number,
                 "type": "insufficient_stock",
-                "message": f"GIACENZA INSUFFICIENTE: Tentativo di scaricare {quantity} pz di '{sku_found}' da '{current_location}'. Disponibile: {current_qty}",
+                "message": f"GIACENZA INSUFFICIENTE: Tentativo di scaricare {quantity} pz di '{sku}' da '{location}'. Disponibile: {current_qty}",
                 "ean_sku": ean_or_sku,
-                "location": current_location,
+                "location": location,
                 "quantity": quantity,
                 "available": current_qty
             })
-            status = "error"
-
-        # CORREZIONE BUG: Consolida quantità invece di creare entry duplicate per scarico
-        operation_key = (current_location, sku_found)
-        
-        if operation_key in consolidated_operations:
-            # Aggiungi alla quantità esistente
-            consolidated_operations[operation_key]['quantity'] += quantity
-            consolidated_operations[operation_key]['lines'].append(i+1)
-            consolidated_operations[operation_key]['input_codes'].append(ean_or_sku)
-            # Aggiorna status se c'è un errore
-            if status == "error":
-                consolidated_operations[operation_key]['status'] = status
-        else:
-            # Crea nuova entry consolidata
-            consolidated_operations[operation_key] = {
-                'quantity': quantity,
-                'lines': [i+1],
-                'input_codes': [ean_or_sku],
-                'location': current_location,
-                'sku': sku_found,
-                'description': product_description,
-                'status': status
-            }
+            consolidated_operations[(location, sku)]['status'] = "error"
 
     # CORREZIONE BUG: Converti operazioni consolidate in recap_items per scarico
     for (location, sku), operation_data in consolidated_operations.items():
-        # Ricalcola giacenze con quantità consolidata
-        current_inventory = db.query(models.Inventory).filter(
-            models.Inventory.location_name == location,
-            models.Inventory.product_sku == sku
-        ).first()
-        
-        current_qty = current_inventory.quantity if current_inventory else 0
+        current_qty = occupancy.quantity(location, sku)
         consolidated_quantity = operation_data['quantity']
         new_qty = max(0, current_qty - consolidated_quantity)
-        
+
         # Verifica se la quantità consolidata supera la giacenza disponibile
-        status = operation_data['status']
+        status = operation_data.get('status', "ok")
         if current_qty < consolidated_quantity:
             errors.append({
                 "line": operation_data['lines'][0],  # Prima riga che ha causato l'errore
@@ -482,7 +372,7 @@ async def parse_subtract_stock_file(file: UploadFile = File(...), db: Session =
                 "available": current_qty
             })
             status = "error"
-        
+
         # Crea recap item consolidato per scarico
         recap_items.append({
             "line": operation_data['lines'][0],  # Prima riga per riferimento
@@ -499,31 +389,9 @@ async def parse_subtract_stock_file(file: UploadFile = File(...), db: Session =
         })
 
     # Aggiungi ubicazioni senza EAN/SKU come operazioni manuali
-    for loc_info in found_locations:
-        location = loc_info["location"]
-        if location not in locations_with_content:
-            warnings.append({
-                "line": loc_info["line"],
-                "type": "empty_location",
-                "message": f"Ubicazione '{location}' trovata senza EAN/SKU. Inserisci manualmente i dati nel recap.",
-                "ean_sku": "",
-                "location": location,
-                "quantity": 0
-            })
-            
-            # Aggiungi entry nel recap per inserimento manuale
-            recap_items.append({
-                "line": loc_info["line"],
-                "location": location,
-                "sku": "",  # Vuoto per inserimento manuale
-                "description": "",
-                "input_code": "",
-                "quantity_to_subtract": 0,  # Sarà inserito manualmente
-                "current_quantity": 0,
-                "new_quantity": 0,
-                "status": "manual_input",  # Nuovo stato per inserimento manuale
-                "needs_input": True  # Flag per identificare righe che necessitano input
-            })
+    manual_warnings, manual_items = _manual_input_entries(parsed, "quantity_to_subtract")
+    warnings.extend(manual_warnings)
+    recap_items.extend(manual_items)
 
     return {
         "recap_items": recap_items,
@@ -533,7 +401,7 @@ async def parse_subtract_stock_file(file: UploadFile = File(...), db: Session =
     }
 
 # Endpoint di commit per operazioni validate
-@router.post("/commit-file-operations")
+@router.post("/commit-file-operations", dependencies=[Depends(get_write_lock)])
 async def commit_file_operations(operations_data: dict, db: Session = Depends(get_db)):
     """
     Esegue le operazioni validate dal recap con controlli finali di sicurezza.
@@ -567,129 +435,121 @@ async def commit_file_operations(operations_data: dict, db: Session = Depends(ge
                    "\n\nUna ubicazione può contenere solo un tipo di prodotto. Correggi i conflitti e riprova."
         )
     
-    # VALIDAZIONE FINALE: Controlla anche conflitti con giacenze esistenti per il carico
-    if operation_type == "add":
-        for op in operations:
-            location = op.get("location")
-            sku = op.get("sku")
-            
-            # Controlla se l'ubicazione contiene già un SKU diverso (ECCEZIONE: TERRA può contenere SKU multipli)
-            if location != "TERRA":
-                existing_inventory = db.query(models.Inventory).filter(
-                    models.Inventory.location_name == location,
-                    models.Inventory.product_sku != sku,
-                    models.Inventory.quantity > 0
-                ).first()
-                
-                if existing_inventory:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"❌ CONFLITTO RILEVATO: Ubicazione '{location}' contiene già il prodotto '{existing_inventory.product_sku}'. "
-                               f"Non è possibile aggiungere '{sku}' nella stessa ubicazione."
-                    )
-        
-    processed_items = 0
-    errors = []
-    
+    # Le query e le scritture girano nel threadpool: il write lock è tenuto solo per il tempo
+    # di poche istruzioni SQL in blocco e l'event loop resta libero
+    return await run_in_threadpool(_apply_file_operations, operations_data, db)
+
+
+def _apply_file_operations(operations_data: dict, db: Session):
+    """
+    Commit set-based delle operazioni di carico/scarico: una query per le giacenze (per il
+    carico tutte le righe delle ubicazioni, per il controllo dei conflitti dentro la
+    transazione), scritture in blocco di InventoryMutationService (righe azzerate eliminate,
+    ubicazioni caricate rese disponibili).
+    """
     try:
-        for op in operations:
-            if op.get("status") == "error":
-                continue  # Salta operazioni con errori
-                
-            location = op.get("location")
-            sku = op.get("sku")
-            quantity = op.get("quantity_to_add" if operation_type == "add" else "quantity_to_subtract")
-            
-            if operation_type == "add":
-                # AUTO-DISPONIBILITÀ per carico
-                location_obj = db.query(models.Location).filter(models.Location.name == location).first()
-                if location_obj and not location_obj.available:
-                    location_obj.available = True
-                
-                inventory_item = db.query(models.Inventory).filter(
-                    models.Inventory.location_name == location,
-                    models.Inventory.product_sku == sku
-                ).first()
-
-                if inventory_item:
-                    inventory_item.quantity += quantity
-                else:
-                    new_item = models.Inventory(location_name=location, product_sku=sku, quantity=quantity)
-                    db.add(new_item)
-                    
-            elif operation_type == "subtract":
-                inventory_item = db.query(models.Inventory).filter(
-                    models.Inventory.location_name == location,
-                    models.Inventory.product_sku == sku
-                ).first()
-
-                if inventory_item and inventory_item.quantity >= quantity:
-                    inventory_item.quantity -= quantity
-                    if inventory_item.quantity == 0:
-                        db.delete(inventory_item)
-                else:
-                    current_qty = inventory_item.quantity if inventory_item else 0
-                    errors.append(f"Impossibile scaricare {quantity} pz di {sku} da {location}. Giacenza attuale: {current_qty}.")
-                    continue
-                    
-            processed_items += 1
-    
-        if errors:
-            db.rollback()
-            raise HTTPException(status_code=400, detail="Operazione parzialmente fallita:\n" + "\n".join(errors))
-        
-        # LOGGING: Registra le operazioni da file come batch
-        logger = LoggingService(db)
-        
-        # Determina tipo operazione per logging
-        log_operation_type = OperationType.CARICO_FILE if operation_type == "add" else OperationType.SCARICO_FILE
-        
-        # Prepara operazioni per batch logging
-        batch_operations = []
-        for op in operations:
-            if op.get("status") != "error":  # Solo operazioni riuscite
-                batch_operations.append({
-                    'product_sku': op.get("sku"),
-                    'location_from': op.get("location") if operation_type == "subtract" else None,
-                    'location_to': op.get("location") if operation_type == "add" else None,
-                    'quantity': op.get("quantity_to_add" if operation_type == "add" else "quantity_to_subtract"),
-                    'status': OperationStatus.SUCCESS,
-                    'line_number': op.get("line", 0),
-                    'details': {
-                        'input_code': op.get("input_code", ""),
-                        'previous_quantity': op.get("current_quantity", 0),
-                        'new_quantity': op.get("new_quantity", 0),
-                        'operation_type': operation_type,
-                        'consolidated_quantity': op.get("consolidated_quantity")
-                    }
-                })
-        
-        # Registra operazioni file senza log batch start/end
-        if batch_operations:
-            # Ottieni nome file dalla prima operazione o usa default più descrittivo
-            file_name = operations_data.get('file_name')
-            if not file_name or file_name == 'uploaded_file.txt':
-                # Genera nome descrittivo basato sul tipo operazione e timestamp
-                from datetime import datetime
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                file_name = f"{operation_type}_operations_{timestamp}.txt"
-            
-            logger.log_file_operations(
-                operation_type=log_operation_type,
-                operation_category=OperationCategory.FILE,
-                operations=batch_operations,
-                file_name=file_name,
-                user_id="file_user"  # TODO: Sostituire con sistema auth reale
-            )
-        
-        db.commit()
-        operation_name = "Carico" if operation_type == "add" else "Scarico"
-        return {"message": f"{operation_name} completato con successo. Elaborate {processed_items} operazioni."}
-        
+        return run_with_retry(db, lambda: _commit_file_operations(operations_data, db))
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Errore durante l'operazione: {str(e)}")
 
+
+def _commit_file_operations(operations_data: dict, db: Session):
+    operations = operations_data.get("operations", [])
+    operation_type = operations_data.get("type")  # "add" o "subtract"
+    quantity_field = "quantity_to_add" if operation_type == "add" else "quantity_to_subtract"
+    processed_items = 0
+    errors = []
+    batch = InventoryMutationService.batch(
+        db, OperationType.CARICO_FILE if operation_type == "add" else OperationType.SCARICO_FILE
+    )
+
+    active_operations = [op for op in operations if op.get("status") != "error"]  # Salta operazioni con errori
+    if operation_type == "add":
+        # VALIDAZIONE FINALE: i conflitti con le giacenze esistenti si controllano sulle righe
+        # lette nella transazione di scrittura, non sull'indice di occupazione del processo
+        batch.prefetch_locations(op.get("location") for op in active_operations)
+    else:
+        batch.prefetch((op.get("location"), op.get("sku")) for op in active_operations)
+
+    for op in active_operations:
+        location = op.get("location")
+        sku = op.get("sku")
+        quantity = int(op.get(quantity_field))
+        if operation_type == "add":
+            # AUTO-DISPONIBILITÀ per carico: ubicazioni rese disponibili dal batch
+            # (ECCEZIONE: TERRA può contenere SKU multipli)
+            result = batch.adjust(location, sku, quantity, check_conflict=True)
+            if result.status == result.CONFLICT:
+                db.rollback()
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"❌ CONFLITTO RILEVATO: Ubicazione '{location}' contiene già il prodotto '{result.conflicting_sku}'. "
+                           f"Non è possibile aggiungere '{sku}' nella stessa ubicazione."
+                )
+        elif operation_type == "subtract":
+            result = batch.adjust(location, sku, -quantity)
+            if not result.ok:
+                errors.append(f"Impossibile scaricare {quantity} pz di {sku} da {location}. Giacenza attuale: {result.previous_quantity}.")
+                continue
+        processed_items += 1
+
+    if errors:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Operazione parzialmente fallita:\n" + "\n".join(errors))
+
+    batch.apply()
+    
+    # LOGGING: Registra le operazioni da file come batch
+    logger = LoggingService(db)
+    
+    # Determina tipo operazione per logging
+    log_operation_type = OperationType.CARICO_FILE if operation_type == "add" else OperationType.SCARICO_FILE
+    
+    # Prepara operazioni per batch logging
+    batch_operations = []
+    for op in operations:
+        if op.get("status") != "error":  # Solo operazioni riuscite
+            batch_operations.append({
+                'product_sku': op.get("sku"),
+                'location_from': op.get("location") if operation_type == "subtract" else None,
+                'location_to': op.get("location") if operation_type == "add" else None,
+                'quantity': op.get("quantity_to_add" if operation_type == "add" else "quantity_to_subtract"),
+                'status': OperationStatus.SUCCESS,
+                'line_number': op.get("line", 0),
+                'details': {
+                    'input_code': op.get("input_code", ""),
+                    'previous_quantity': op.get("current_quantity", 0),
+                    'new_quantity': op.get("new_quantity", 0),
+                    'operation_type': operation_type,
+                    'consolidated_quantity': op.get("consolidated_quantity")
+                }
+            })
+    
+    # Registra operazioni file senza log batch start/end
+    if batch_operations:
+        # Ottieni nome file dalla prima operazione o usa default più descrittivo
+        file_name = operations_data.get('file_name')
+        if not file_name or file_name == 'uploaded_file.txt':
+            # Genera nome descrittivo basato sul tipo operazione e timestamp
+            from datetime import datetime
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            file_name = f"{operation_type}_operations_{timestamp}.txt"
+        
+        logger.log_file_operations(
+            operation_type=log_operation_type,
+            operation_category=OperationCategory.FILE,
+            operations=batch_operations,
+            file_name=file_name,
+            user_id="file_user"  # TODO: Sostituire con sistema auth reale
+        )
+    
+    db.commit()
+    operation_name = "Carico" if operation_type == "add" else "Scarico"
+    return {"message": f"{operation_name} completato con successo. Elaborate {processed_items} operazioni."}
+
 @router.post("/subtract-stock-from-file")
 async def subtract_stock_from_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
     try:
@@ -700,50 +560,45 @@ async def subtract_stock_from_file(file: UploadFile = File(...), db: Session = D
     if not movements:
         return JSONResponse(status_code=400, content={"detail": "Il file è vuoto o non contiene dati validi da elaborare."})
 
-    processed_items = 0
-    errors = []
-    for location, skus in movements.items():
-        for sku, qty_to_subtract in skus.items():
-            inventory_item = db.query(models.Inventory).filter(
-                models.Inventory.location_name == location,
-                models.Inventory.product_sku == sku
-            ).first()
-
-            if not inventory_item or inventory_item.quantity < qty_to_subtract:
-                current_qty = inventory_item.quantity if inventory_item else 0
-                errors.append(f"Impossibile scaricare {qty_to_subtract} pz di {sku} da {location}. Giacenza attuale: {current_qty}.")
-                continue
+    def apply_subtract():
+        batch = InventoryMutationService.batch(db, OperationType.SCARICO_FILE)
+        batch.prefetch((location, sku) for location, skus in movements.items() for sku in skus)
+        processed_items = 0
+        errors = []
+        for location, skus in movements.items():
+            for sku, qty_to_subtract in skus.items():
+                result = batch.adjust(location, sku, -qty_to_subtract)
+                if not result.ok:
+                    errors.append(f"Impossibile scaricare {qty_to_subtract} pz di {sku} da {location}. Giacenza attuale: {result.previous_quantity}.")
+                    continue
+                processed_items += 1
 
-            inventory_item.quantity -= qty_to_subtract
-            processed_items += 1
-    
-    if errors:
-        db.rollback()
-        raise HTTPException(status_code=400, detail="Operazione annullata. Errori di giacenza:\n" + "\n".join(errors))
+        if errors:
+            db.rollback()
+            raise HTTPException(status_code=400, detail="Operazione annullata. Errori di giacenza:\n" + "\n".join(errors))
 
-    db.commit()
-    return {"message": f"Scarico completato con successo. Elaborati {processed_items} movimenti."}
+        batch.apply()
+        db.commit()
+        return {"message": f"Scarico completato con successo. Elaborati {processed_items} movimenti."}
+
+    return await run_in_threadpool(run_with_retry, db, apply_subtract)
 
 @router.post("/parse-realignment-file", response_model=inventory_schemas.StockParseResult)
 async def parse_realignment_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    content = await file.read()
-    try:
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
-
-    lines = text_content.splitlines()
     new_quantities = defaultdict(lambda: defaultdict(int))
     errors = []
     current_location = None
+    # Nomi delle ubicazioni letti una volta: il riconoscimento delle righe avviene in memoria
+    all_locations = {name for (name,) in db.query(models.Location.name).all()}
+    barcode_resolver.ensure_loaded(db)
 
-    for i, line_content in enumerate(lines):
-        line_number = i + 1
+    line_number = 0
+    async for line_content in iter_upload_lines(file):
+        line_number += 1
         line = line_content.strip()
         if not line: continue
 
-        db_location = db.query(models.Location).filter(models.Location.name == line).first()
-        if db_location:
+        if line in all_locations:
             current_location = line
             continue
         
@@ -752,9 +607,7 @@ async def parse_realignment_file(file: UploadFile = File(...), db: Session = Dep
             continue
 
         ean_or_sku = line
-        product = db.query(models.Product).join(models.EanCode, models.Product.sku == models.EanCode.product_sku, isouter=True).filter(
-            (models.Product.sku == ean_or_sku) | (models.EanCode.ean == ean_or_sku)
-        ).first()
+        product = await barcode_resolver.resolve_async(ean_or_sku)
 
         if product:
             new_quantities[current_location][product.sku] += 1
@@ -787,29 +640,17 @@ async def parse_realignment_file(file: UploadFile = File(...), db: Session = Dep
 
 @router.post("/commit-realignment")
 async def commit_realignment(commit_data: inventory_schemas.StockCommitRequest, db: Session = Depends(get_db)):
-    updated_count = 0
-    for item in commit_data.items:
-        if item.status == 'no_change':
-            continue
-
-        inventory_item = db.query(models.Inventory).filter(
-            models.Inventory.product_sku == item.product_sku,
-            models.Inventory.location_name == item.location_name
-        ).first()
-
-        if inventory_item:
-            if item.new_quantity > 0:
-                inventory_item.quantity = item.new_quantity
-            else:
-                db.delete(inventory_item)
-        elif item.new_quantity > 0:
-            inventory_item = models.Inventory(product_sku=item.product_sku, location_name=item.location_name, quantity=item.new_quantity)
-            db.add(inventory_item)
-        
-        updated_count += 1
+    def apply_realignment():
+        items = [item for item in commit_data.items if item.status != 'no_change']
+        batch = InventoryMutationService.batch(db, OperationType.RIALLINEAMENTO_FILE)
+        batch.prefetch((item.location_name, item.product_sku) for item in items)
+        for item in items:
+            batch.set(item.location_name, item.product_sku, max(item.new_quantity, 0))
+        batch.apply()
+        db.commit()
+        return {"message": f"Riallineamento giacenze completato per {len(items)} record."}
 
-    db.commit()
-    return {"message": f"Riallineamento giacenze completato per {updated_count} record."}
+    return await run_in_threadpool(run_with_retry, db, apply_realignment)
 
 from fastapi.responses import StreamingResponse
 import io
@@ -840,13 +681,11 @@ async def restore_stock(file: UploadFile = File(...), db: Session = Depends(get_
     Ripristina la giacenza da un file di backup, sovrascrivendo tutti i dati esistenti.
     """
     try:
+        set_ledger_context(db, OperationType.RIPRISTINO_GIACENZE)
         # Svuota l'inventario attuale
         db.query(models.Inventory).delete()
         
-        content = await file.read()
-        lines = content.decode("utf-8").splitlines()
-        
-        for line in lines:
+        async for line in iter_upload_lines(file):
             line = line.strip()
             if not line:
                 continue
@@ -877,6 +716,7 @@ async def delete_all_stock(db: Session = Depends(get_db)):
     Elimina tutte le giacenze di magazzino.
     """
     try:
+        set_ledger_context(db, OperationType.PULIZIA_DATABASE)
         num_rows_deleted = db.query(models.Inventory).delete()
         db.commit()
         return {"message": f"Tutte le {num_rows_deleted} giacenze sono state eliminate con successo."}
@@ -902,6 +742,7 @@ async def delete_stock_by_row(row_prefix: str, db: Session = Depends(get_db)):
             return {"message": f"Nessuna ubicazione trovata con prefisso '{row_prefix}'."}
 
         # Elimina le giacenze in quelle ubicazioni
+        set_ledger_context(db, OperationType.PULIZIA_DATABASE)
         num_rows_deleted = db.query(models.Inventory).filter(models.Inventory.location_name.in_(location_names)).delete(synchronize_session=False)
         db.commit()
         
@@ -911,8 +752,8 @@ async def delete_stock_by_row(row_prefix: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Errore durante l'eliminazione delle giacenze per fila: {str(e)}")
 
 
-@router.post("/update-stock")
-async def update_stock(update_data: dict, db: Session = Depends(get_db)):
+@router.post("/update-stock", dependencies=[Depends(get_write_lock)])
+async def update_stock(update_data: dict, db: AsyncSession = Depends(get_async_db)):
     """Aggiorna la giacenza di un prodotto in una specifica ubicazione (carico/scarico manuale)."""
     product_sku = update_data.get("product_sku")
     location_name = update_data.get("location_name")
@@ -923,106 +764,95 @@ async def update_stock(update_data: dict, db: Session = Depends(get_db)):
     if not product_sku or not location_name or quantity_change is None:
         raise HTTPException(status_code=400, detail="SKU prodotto, ubicazione e quantità sono obbligatori.")
     
-    # Verifica che il prodotto esista
-    product = db.query(models.Product).filter(models.Product.sku == product_sku).first()
-    if not product:
-        raise HTTPException(status_code=404, detail=f"Prodotto con SKU '{product_sku}' non trovato.")
+    async def apply_update():
+        # Verifica che il prodotto esista
+        product = (await db.execute(select(models.Product).where(models.Product.sku == product_sku))).scalars().first()
+        if not product:
+            raise HTTPException(status_code=404, detail=f"Prodotto con SKU '{product_sku}' non trovato.")
     
-    # Verifica che l'ubicazione esista
-    location = db.query(models.Location).filter(models.Location.name == location_name).first()
-    if not location:
-        raise HTTPException(status_code=404, detail=f"Ubicazione '{location_name}' non trovata.")
-    
-    # CONTROLLO UNICITÀ: Una ubicazione può contenere solo un SKU (ECCEZIONE: TERRA può contenere SKU multipli)
-    if location_name != "TERRA":
-        existing_inventory_in_location = db.query(models.Inventory).filter(
-            models.Inventory.location_name == location_name,
-            models.Inventory.product_sku != product_sku,
-            models.Inventory.quantity > 0
-        ).first()
-        
-        if existing_inventory_in_location:
-            if quantity_change > 0:
-                # Errore per carico in ubicazione occupata da altro prodotto
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Ubicazione '{location_name}' contiene già il prodotto '{existing_inventory_in_location.product_sku}' (quantità: {existing_inventory_in_location.quantity}). Una ubicazione può contenere solo un tipo di prodotto."
-                )
-            elif quantity_change < 0:
-                # Errore per scarico quando si cerca un prodotto diverso da quello presente
-                raise HTTPException(
-                    status_code=400,
-                detail=f"Impossibile scaricare '{product_sku}' dall'ubicazione '{location_name}'. L'ubicazione contiene '{existing_inventory_in_location.product_sku}' (quantità: {existing_inventory_in_location.quantity})."
+        # Verifica che l'ubicazione esista
+        location = (await db.execute(select(models.Location).where(models.Location.name == location_name))).scalars().first()
+        if not location:
+            raise HTTPException(status_code=404, detail=f"Ubicazione '{location_name}' non trovata.")
+    
+        # CONTROLLO UNICITÀ: Una ubicazione può contenere solo un SKU (ECCEZIONE: TERRA può contenere SKU multipli),
+        # sulle righe dell'ubicazione lette nella transazione di scrittura
+        def mutate(session: Session):
+            batch = InventoryMutationService.batch(
+                session, OperationType.CARICO_MANUALE if quantity_change > 0 else OperationType.SCARICO_MANUALE
             )
-    
-    # Trova o crea l'elemento di inventario
-    inventory_item = db.query(models.Inventory).filter(
-        models.Inventory.product_sku == product_sku,
-        models.Inventory.location_name == location_name
-    ).first()
-    
-    if inventory_item:
-        new_quantity = inventory_item.quantity + quantity_change
-        if new_quantity < 0:
-            raise HTTPException(status_code=400, detail=f"Giacenza insufficiente. Attuale: {inventory_item.quantity}, richiesto: {abs(quantity_change)}")
-        
-        if new_quantity == 0:
-            db.delete(inventory_item)
+            conflict = batch.conflicting_sku(location_name, product_sku)
+            if conflict:
+                conflicting_sku, conflicting_quantity = conflict
+                if quantity_change > 0:
+                    # Errore per carico in ubicazione occupata da altro prodotto
+                    raise HTTPException(
+                        status_code=400, 
+                        detail=f"Ubicazione '{location_name}' contiene già il prodotto '{conflicting_sku}' (quantità: {conflicting_quantity}). Una ubicazione può contenere solo un tipo di prodotto."
+                    )
+                elif quantity_change < 0:
+                    # Errore per scarico quando si cerca un prodotto diverso da quello presente
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Impossibile scaricare '{product_sku}' dall'ubicazione '{location_name}'. L'ubicazione contiene '{conflicting_sku}' (quantità: {conflicting_quantity})."
+                    )
+
+            result = batch.adjust(location_name, product_sku, quantity_change)
+            if result.previous_quantity == 0 and quantity_change <= 0:
+                raise HTTPException(status_code=400, detail="Impossibile scaricare da una giacenza inesistente.")
+            if not result.ok:
+                raise HTTPException(status_code=400, detail=f"Giacenza insufficiente. Attuale: {result.previous_quantity}, richiesto: {abs(quantity_change)}")
+            batch.apply()
+            return result
+
+        # Lettura, controlli e scrittura in blocco sulla sessione sincrona sottostante
+        result = await db.run_sync(mutate)
+        previous_quantity, new_quantity = result.previous_quantity, result.new_quantity
+        if previous_quantity == 0:
+            action = f"creato con giacenza {quantity_change}"
+        elif new_quantity == 0:
             action = "eliminato (giacenza zero)"
         else:
-            inventory_item.quantity = new_quantity
             action = f"aggiornato a {new_quantity}"
-    else:
-        if quantity_change <= 0:
-            raise HTTPException(status_code=400, detail="Impossibile scaricare da una giacenza inesistente.")
-        
-        inventory_item = models.Inventory(
-            product_sku=product_sku,
-            location_name=location_name,
-            quantity=quantity_change
-        )
-        db.add(inventory_item)
-        action = f"creato con giacenza {quantity_change}"
     
-    # AUTO-DISPONIBILITÀ: Se stiamo aggiungendo stock (quantity_change > 0) in un'ubicazione
-    # non disponibile, rendila automaticamente disponibile
-    if quantity_change > 0 and not location.available:
-        location.available = True
-        action += " - ubicazione resa automaticamente disponibile"
+        # AUTO-DISPONIBILITÀ: Se stiamo aggiungendo stock (quantity_change > 0) in un'ubicazione
+        # non disponibile, il batch la rende automaticamente disponibile
+        location_made_available = quantity_change > 0 and not location.available
+        if location_made_available:
+            action += " - ubicazione resa automaticamente disponibile"
     
-    # LOGGING: Registra l'operazione prima del commit
-    logger = LoggingService(db)
-    operation_type = OperationType.CARICO_MANUALE if quantity_change > 0 else OperationType.SCARICO_MANUALE
-    
-    # Cattura stato precedente per logging
-    previous_quantity = inventory_item.quantity - quantity_change if inventory_item and hasattr(inventory_item, 'quantity') else 0
-    new_quantity = previous_quantity + quantity_change if previous_quantity + quantity_change >= 0 else 0
-    
-    logger.log_operation(
-        operation_type=operation_type,
-        operation_category=OperationCategory.MANUAL,
-        status=OperationStatus.SUCCESS,
-        product_sku=product_sku,
-        location_to=location_name if quantity_change > 0 else None,
-        location_from=location_name if quantity_change < 0 else None,
-        quantity=abs(quantity_change),
-        user_id="manual_user",  # TODO: Sostituire con sistema auth reale
-        details={
-            "operation": "manual_stock_update",
-            "quantity_change": quantity_change,
-            "previous_quantity": previous_quantity,
-            "new_quantity": new_quantity,
-            "action_performed": action,
-            "location_made_available": quantity_change > 0 and not location.available
-        },
-        api_endpoint="/inventory/update-stock"
-    )
+        # LOGGING: Registra l'operazione prima del commit
+        logger = LoggingService(db)
+        operation_type = OperationType.CARICO_MANUALE if quantity_change > 0 else OperationType.SCARICO_MANUALE
     
-    db.commit()
-    return {"message": f"Inventario {action} per {product_sku} in {location_name}."}
+        logger.log_operation(
+            operation_type=operation_type,
+            operation_category=OperationCategory.MANUAL,
+            status=OperationStatus.SUCCESS,
+            product_sku=product_sku,
+            location_to=location_name if quantity_change > 0 else None,
+            location_from=location_name if quantity_change < 0 else None,
+            quantity=abs(quantity_change),
+            user_id="manual_user",  # TODO: Sostituire con sistema auth reale
+            details={
+                "operation": "manual_stock_update",
+                "quantity_change": quantity_change,
+                "previous_quantity": previous_quantity,
+                "new_quantity": new_quantity,
+                "action_performed": action,
+                "location_made_available": location_made_available
+            },
+            api_endpoint="/inventory/update-stock"
+        )
+    
+        await db.commit()
+        return {"message": f"Inventario {action} per {product_sku} in {location_name}."}
+
+    # Riga di giacenza versionata: se un'altra operazione la modifica nel frattempo si rilegge e si riprova
+    return await run_with_retry_async(db, apply_update)
 
-@router.post("/move-stock")
-async def move_stock(move_data: dict, db: Session = Depends(get_db)):
+@router.post("/move-stock", dependencies=[Depends(get_write_lock)])
+async def move_stock(move_data: dict, db: AsyncSession = Depends(get_async_db)):
     """Sposta giacenza da una ubicazione a un'altra."""
     product_sku = move_data.get("product_sku")
     from_location = move_data.get("from_location")
@@ -1031,7 +861,7 @@ async def move_stock(move_data: dict, db: Session = Depends(get_db)):
     to_location = move_data.get("to_location")
     if to_location:
         to_location = to_location.upper()  # Conversione automatica in maiuscolo
-    quantity_to_move = move_data.get("quantity", 0)
+    requested_quantity = move_data.get("quantity", 0)
     
     if not product_sku or not from_location or not to_location:
         raise HTTPException(status_code=400, detail="SKU prodotto, ubicazione di origine e destinazione sono obbligatori.")
@@ -1039,102 +869,73 @@ async def move_stock(move_data: dict, db: Session = Depends(get_db)):
     if from_location == to_location:
         raise HTTPException(status_code=400, detail="L'ubicazione di origine e destinazione non possono essere uguali.")
     
-    # Verifica che il prodotto esista
-    product = db.query(models.Product).filter(models.Product.sku == product_sku).first()
-    if not product:
-        raise HTTPException(status_code=404, detail=f"Prodotto con SKU '{product_sku}' non trovato.")
-    
-    # Verifica che entrambe le ubicazioni esistano
-    from_loc = db.query(models.Location).filter(models.Location.name == from_location).first()
-    to_loc = db.query(models.Location).filter(models.Location.name == to_location).first()
-    if not from_loc:
-        raise HTTPException(status_code=404, detail=f"Ubicazione di origine '{from_location}' non trovata.")
-    if not to_loc:
-        raise HTTPException(status_code=404, detail=f"Ubicazione di destinazione '{to_location}' non trovata.")
-    
-    # Trova l'elemento di inventario di origine
-    from_inventory = db.query(models.Inventory).filter(
-        models.Inventory.product_sku == product_sku,
-        models.Inventory.location_name == from_location
-    ).first()
-    
-    if not from_inventory or from_inventory.quantity <= 0:
-        raise HTTPException(status_code=400, detail=f"Nessuna giacenza trovata per {product_sku} in {from_location}.")
-    
-    # Determina la quantità da spostare
-    if quantity_to_move <= 0:
-        quantity_to_move = from_inventory.quantity
-    
-    if quantity_to_move > from_inventory.quantity:
-        raise HTTPException(status_code=400, detail=f"Quantità richiesta ({quantity_to_move}) supera la giacenza disponibile ({from_inventory.quantity}).")
-    
-    # Aggiorna l'origine
-    from_inventory.quantity -= quantity_to_move
-    if from_inventory.quantity == 0:
-        db.delete(from_inventory)
-    
-    # CONTROLLO UNICITÀ: Verifica se l'ubicazione di destinazione contiene già un altro SKU (ECCEZIONE: TERRA può contenere SKU multipli)
-    if to_location != "TERRA":
-        existing_inventory_in_destination = db.query(models.Inventory).filter(
-            models.Inventory.location_name == to_location,
-            models.Inventory.product_sku != product_sku,
-            models.Inventory.quantity > 0
-        ).first()
-        
-        if existing_inventory_in_destination:
-            # Rollback della modifica all'origine prima di lanciare l'errore
-            from_inventory.quantity += quantity_to_move
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Ubicazione di destinazione '{to_location}' contiene già il prodotto '{existing_inventory_in_destination.product_sku}'. Una ubicazione può contenere solo un tipo di prodotto."
-            )
+    async def apply_move():
+        # Verifica che il prodotto esista
+        product = (await db.execute(select(models.Product).where(models.Product.sku == product_sku))).scalars().first()
+        if not product:
+            raise HTTPException(status_code=404, detail=f"Prodotto con SKU '{product_sku}' non trovato.")
     
-    # Trova o crea l'elemento di inventario di destinazione
-    to_inventory = db.query(models.Inventory).filter(
-        models.Inventory.product_sku == product_sku,
-        models.Inventory.location_name == to_location
-    ).first()
+        # Verifica che entrambe le ubicazioni esistano
+        from_loc = (await db.execute(select(models.Location).where(models.Location.name == from_location))).scalars().first()
+        to_loc = (await db.execute(select(models.Location).where(models.Location.name == to_location))).scalars().first()
+        if not from_loc:
+            raise HTTPException(status_code=404, detail=f"Ubicazione di origine '{from_location}' non trovata.")
+        if not to_loc:
+            raise HTTPException(status_code=404, detail=f"Ubicazione di destinazione '{to_location}' non trovata.")
+    
+        # CONTROLLO UNICITÀ sulla destinazione (ECCEZIONE: TERRA può contenere SKU multipli),
+        # sulle righe della destinazione lette nella transazione di scrittura
+        def mutate(session: Session):
+            batch = InventoryMutationService.batch(session, OperationType.SPOSTAMENTO_MANUALE)
+            batch.prefetch([(from_location, product_sku), (to_location, product_sku)])
+            available = batch.quantity(from_location, product_sku)
+            if available <= 0:
+                raise HTTPException(status_code=400, detail=f"Nessuna giacenza trovata per {product_sku} in {from_location}.")
+
+            # Determina la quantità da spostare (0 = tutta la giacenza, riletta a ogni tentativo)
+            quantity_to_move = requested_quantity if requested_quantity > 0 else available
+            if quantity_to_move > available:
+                raise HTTPException(status_code=400, detail=f"Quantità richiesta ({quantity_to_move}) supera la giacenza disponibile ({available}).")
+
+            source, destination = batch.move(product_sku, from_location, to_location, quantity_to_move)
+            if source.status == source.CONFLICT:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Ubicazione di destinazione '{to_location}' contiene già il prodotto '{source.conflicting_sku}'. Una ubicazione può contenere solo un tipo di prodotto."
+                )
+            batch.apply()
+            return quantity_to_move, source, destination
+
+        quantity_to_move, source, destination = await db.run_sync(mutate)
     
-    if to_inventory:
-        to_inventory.quantity += quantity_to_move
-    else:
-        to_inventory = models.Inventory(
+        # LOGGING: Registra l'operazione di spostamento
+        logger = LoggingService(db)
+        logger.log_operation(
+            operation_type=OperationType.SPOSTAMENTO_MANUALE,
+            operation_category=OperationCategory.MANUAL,
+            status=OperationStatus.SUCCESS,
             product_sku=product_sku,
-            location_name=to_location,
-            quantity=quantity_to_move
+            location_from=from_location,
+            location_to=to_location,
+            quantity=quantity_to_move,
+            user_id="manual_user",  # TODO: Sostituire con sistema auth reale
+            details={
+                "operation": "manual_stock_movement",
+                "from_previous_quantity": source.previous_quantity,
+                "from_new_quantity": source.new_quantity,
+                "to_previous_quantity": destination.previous_quantity,
+                "to_new_quantity": destination.new_quantity,
+                "from_location_cleared": source.new_quantity == 0,
+                "to_location_created": destination.previous_quantity == 0
+            },
+            api_endpoint="/inventory/move-stock"
         )
-        db.add(to_inventory)
-    
-    # LOGGING: Registra l'operazione di spostamento
-    logger = LoggingService(db)
     
-    # Calcola quantità precedenti per logging
-    from_previous_quantity = from_inventory.quantity + quantity_to_move  # Quantità prima dello spostamento
-    to_previous_quantity = to_inventory.quantity - quantity_to_move if to_inventory and hasattr(to_inventory, 'quantity') else 0
-    
-    logger.log_operation(
-        operation_type=OperationType.SPOSTAMENTO_MANUALE,
-        operation_category=OperationCategory.MANUAL,
-        status=OperationStatus.SUCCESS,
-        product_sku=product_sku,
-        location_from=from_location,
-        location_to=to_location,
-        quantity=quantity_to_move,
-        user_id="manual_user",  # TODO: Sostituire con sistema auth reale
-        details={
-            "operation": "manual_stock_movement",
-            "from_previous_quantity": from_previous_quantity,
-            "from_new_quantity": from_inventory.quantity if from_inventory in db else 0,
-            "to_previous_quantity": to_previous_quantity,
-            "to_new_quantity": to_inventory.quantity,
-            "from_location_cleared": from_inventory.quantity == 0,
-            "to_location_created": to_previous_quantity == 0
-        },
-        api_endpoint="/inventory/move-stock"
-    )
-    
-    db.commit()
-    return {"message": f"Spostati {quantity_to_move} pz di {product_sku} da {from_location} a {to_location}."}
+        await db.commit()
+        return {"message": f"Spostati {quantity_to_move} pz di {product_sku} da {from_location} a {to_location}."}
+
+    # Righe di origine e destinazione versionate: in caso di modifica concorrente si rilegge e si riprova
+    return await run_with_retry_async(db, apply_move)
 
 @router.post("/parse-movements-file")
 async def parse_movements_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
@@ -1142,13 +943,7 @@ async def parse_movements_file(file: UploadFile = File(...), db: Session = Depen
     Analizza un file di spostamenti e restituisce un recap delle operazioni da effettuare con validazioni.
     Il file contiene ubicazioni alternate: origine, destinazione, origine, destinazione...
     """
-    content = await file.read()
-    try:
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
-
-    lines = [line.strip() for line in text_content.splitlines() if line.strip()]
+    lines = await read_upload_tokens(file)
     recap_items = []
     errors = []
     warnings = []
@@ -1291,31 +1086,31 @@ async def commit_movements(movements_data: dict, db: Session = Depends(get_db)):
     if not movements:
         raise HTTPException(status_code=400, detail="Nessuno spostamento da eseguire.")
     
-    processed_movements = 0
-    errors = []
-    batch_operations = []  # Per logging
-    
-    try:
+    def apply_movements():
+        processed_movements = 0
+        errors = []
+        batch_operations = []  # Per logging
+
+        active_movements = [movement for movement in movements if movement.get("status") != "error"]  # Salta movimenti con errori
+        batch = InventoryMutationService.batch(db, OperationType.SPOSTAMENTO_FILE)
+        # Una sola lettura per tutte le ubicazioni coinvolte; i movimenti successivi vedono quelli precedenti
+        batch.prefetch_locations(
+            location for movement in active_movements
+            for location in (movement.get("from_location"), movement.get("to_location"))
+        )
+
         # Processa i movimenti in ordine
-        for movement in movements:
-            if movement.get("status") == "error":
-                continue  # Salta movimenti con errori
-                
+        for movement in active_movements:
             from_location = movement.get("from_location")
             to_location = movement.get("to_location")
             
             # Trova l'inventario di origine
-            from_inventory = db.query(models.Inventory).filter(
-                models.Inventory.location_name == from_location,
-                models.Inventory.quantity > 0
-            ).first()
-            
-            if not from_inventory:
+            stocked = batch.stocked_skus(from_location)
+            if not stocked:
                 errors.append(f"Spostamento {movement.get('move_number')}: Nessuna giacenza trovata in '{from_location}'")
                 continue
             
-            product_sku = from_inventory.product_sku
-            quantity_to_move = from_inventory.quantity
+            product_sku, quantity_to_move = stocked[0]
             
             # Raccogli dati per logging PRIMA di modificare l'inventario
             batch_operations.append({
@@ -1332,42 +1127,22 @@ async def commit_movements(movements_data: dict, db: Session = Depends(get_db)):
                 }
             })
             
-            # Verifica conflitti nella destinazione (controllo finale)
-            existing_in_destination = db.query(models.Inventory).filter(
-                models.Inventory.location_name == to_location,
-                models.Inventory.product_sku != product_sku,
-                models.Inventory.quantity > 0
-            ).first()
-            
-            if existing_in_destination:
-                # Se c'è un conflitto ma l'utente ha confermato, sovrascriviamo
-                # Elimina il contenuto esistente nella destinazione
-                db.delete(existing_in_destination)
-            
-            # Rimuovi dall'origine
-            db.delete(from_inventory)
-            
-            # Trova o crea nella destinazione
-            to_inventory = db.query(models.Inventory).filter(
-                models.Inventory.location_name == to_location,
-                models.Inventory.product_sku == product_sku
-            ).first()
-            
-            if to_inventory:
-                to_inventory.quantity += quantity_to_move
-            else:
-                to_inventory = models.Inventory(
-                    location_name=to_location,
-                    product_sku=product_sku,
-                    quantity=quantity_to_move
-                )
-                db.add(to_inventory)
+            # Verifica conflitti nella destinazione (controllo finale): se c'è un conflitto ma
+            # l'utente ha confermato, il contenuto esistente nella destinazione viene eliminato
+            conflict = batch.conflicting_sku(to_location, product_sku)
+            while conflict:
+                batch.set(to_location, conflict[0], 0)
+                conflict = batch.conflicting_sku(to_location, product_sku)
             
+            # Svuota l'origine e carica la destinazione
+            batch.move(product_sku, from_location, to_location, quantity_to_move, check_conflict=False)
             processed_movements += 1
         
         if errors:
             db.rollback()
             raise HTTPException(status_code=400, detail="Operazione fallita:\\n" + "\\n".join(errors))
+
+        batch.apply()
         
         # LOGGING: Registra le operazioni di spostamento
         logger = LoggingService(db)
@@ -1385,7 +1160,11 @@ async def commit_movements(movements_data: dict, db: Session = Depends(get_db)):
         
         db.commit()
         return {"message": f"Spostamenti completati con successo. Elaborati {processed_movements} movimenti."}
-        
+    
+    try:
+        return await run_in_threadpool(run_with_retry, db, apply_movements)
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Errore durante gli spostamenti: {str(e)}")
@@ -1406,6 +1185,76 @@ async def get_current_quantity(sku: str, location: str, db: Session = Depends(ge
         "current_quantity": current_quantity
     }
 
+def _parse_ledger_date(value: str, field: str) -> datetime:
+    """Data ISO dei parametri del registro movimenti (orari UTC, senza fuso)"""
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Formato data non valido per '{field}': usare ISO 8601 (es. 2025-01-31T18:00).")
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+
+@router.get("/stock-at")
+async def get_stock_at(
+    at: str = Query(...),
+    location: Optional[str] = Query(None),
+    sku: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """Giacenze alla data indicata: ultima fotografia notturna più i movimenti successivi."""
+    at_datetime = _parse_ledger_date(at, "at")
+    result = StockLedgerService.stock_at(db, at_datetime, location=location.upper() if location else None, sku=sku)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Nessuna fotografia delle giacenze anteriore al {at_datetime.isoformat()}.")
+    return result
+
+@router.get("/movements")
+async def get_stock_movements(
+    page: int = Query(1, ge=1),
+    page_size: int = Query(100, ge=1, le=1000),
+    sku: Optional[str] = Query(None),
+    location: Optional[str] = Query(None),
+    order_number: Optional[str] = Query(None),
+    reason: Optional[str] = Query(None),
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """Storico dei movimenti di giacenza dal registro stock_movements, dal più recente."""
+    movements, total_count = StockLedgerService.movements(
+        db,
+        sku=sku,
+        location=location.upper() if location else None,
+        order_number=order_number,
+        reason=reason,
+        start_date=_parse_ledger_date(start_date, "start_date") if start_date else None,
+        end_date=_parse_ledger_date(end_date, "end_date") if end_date else None,
+        limit=page_size,
+        offset=(page - 1) * page_size
+    )
+    return {
+        "movements": [
+            {
+                "id": movement.id,
+                "timestamp": movement.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                "product_sku": movement.product_sku,
+                "location_from": movement.location_from,
+                "location_to": movement.location_to,
+                "quantity": movement.quantity,
+                "reason": movement.reason,
+                "order_number": movement.order_number,
+                "batch_id": movement.batch_id,
+                "user_id": movement.user_id
+            }
+            for movement in movements
+        ],
+        "pagination": {
+            "current_page": page,
+            "page_size": page_size,
+            "total_pages": (total_count + page_size - 1) // page_size,
+            "total_count": total_count
+        }
+    }
+
 @router.get("/manage", response_class=HTMLResponse)
 async def get_inventory_management_page(request: Request, db: Session = Depends(get_db)):
     inventory = db.query(models.Inventory).filter(models.Inventory.quantity > 0).options(joinedload(models.Inventory.product)).order_by(models.Inventory.location_name).all()
@@ -1431,59 +1280,36 @@ async def unload_container_manual(unload_data: dict, db: Session = Depends(get_d
     if not product:
         raise HTTPException(status_code=404, detail=f"Prodotto con SKU '{sku}' non trovato")
     
-    # Trova o crea l'inventario a TERRA (auto-consolida se esistono record multipli)
-    existing_ground_records = db.query(models.Inventory).filter(
-        models.Inventory.product_sku == sku,
-        models.Inventory.location_name == "TERRA"
-    ).all()
+    def apply_unload():
+        # Una sola riga per SKU a TERRA (vincolo uq_inventory_location_sku): niente da consolidare
+        batch = InventoryMutationService.batch(db, OperationType.SCARICO_CONTAINER_MANUALE)
+        result = batch.adjust("TERRA", sku, quantity)
+        batch.apply()
     
-    if existing_ground_records:
-        # Se esistono record, consolida tutto nel primo e rimuovi gli altri
-        primary_record = existing_ground_records[0]
-        total_existing = sum(record.quantity for record in existing_ground_records)
-        
-        # Aggiorna il primo record con la quantità totale + nuova quantità
-        primary_record.quantity = total_existing + quantity
-        
-        # Rimuovi tutti gli altri record duplicati
-        for record in existing_ground_records[1:]:
-            db.delete(record)
-    else:
-        # Crea nuovo record
-        ground_inventory = models.Inventory(
+        # LOGGING: Registra l'operazione di scarico container
+        logger = LoggingService(db)
+        logger.log_operation(
+            operation_type=OperationType.SCARICO_CONTAINER_MANUALE,
+            operation_category=OperationCategory.MANUAL,
+            status=OperationStatus.SUCCESS,
             product_sku=sku,
-            location_name="TERRA",
-            quantity=quantity
+            location_to="TERRA",
+            quantity=quantity,
+            user_id="manual_user",  # TODO: Sostituire con sistema auth reale
+            details={
+                "operation": "manual_container_unload",
+                "previous_quantity_at_terra": result.previous_quantity,
+                "new_quantity_at_terra": result.new_quantity,
+                "records_consolidated": int(result.previous_quantity > 0),
+                "auto_consolidation_performed": False
+            },
+            api_endpoint="/inventory/unload-container-manual"
         )
-        db.add(ground_inventory)
-    
-    # LOGGING: Registra l'operazione di scarico container
-    logger = LoggingService(db)
-    
-    # Calcola quantità precedente
-    previous_quantity = sum(record.quantity for record in existing_ground_records) if existing_ground_records else 0
-    new_quantity = previous_quantity + quantity
-    
-    logger.log_operation(
-        operation_type=OperationType.SCARICO_CONTAINER_MANUALE,
-        operation_category=OperationCategory.MANUAL,
-        status=OperationStatus.SUCCESS,
-        product_sku=sku,
-        location_to="TERRA",
-        quantity=quantity,
-        user_id="manual_user",  # TODO: Sostituire con sistema auth reale
-        details={
-            "operation": "manual_container_unload",
-            "previous_quantity_at_terra": previous_quantity,
-            "new_quantity_at_terra": new_quantity,
-            "records_consolidated": len(existing_ground_records) if existing_ground_records else 0,
-            "auto_consolidation_performed": len(existing_ground_records) > 1
-        },
-        api_endpoint="/inventory/unload-container-manual"
-    )
     
-    db.commit()
-    return {"message": f"Scaricati {quantity} pz di '{sku}' a TERRA dal container."}
+        db.commit()
+        return {"message": f"Scaricati {quantity} pz di '{sku}' a TERRA dal container."}
+
+    return await run_in_threadpool(run_with_retry, db, apply_unload)
 
 @router.post("/parse-unload-container-file")
 async def parse_unload_container_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
@@ -1491,28 +1317,21 @@ async def parse_unload_container_file(file: UploadFile = File(...), db: Session
     Analizza il file di scarico container e restituisce un recap per conferma utente.
     Formato: SKU (1 pezzo) o SKU_QTY (QTY pezzi)
     """
-    try:
-        content = await file.read()
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
-    except Exception as e:
-        print(f"DEBUG: Error reading file: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Errore lettura file: {str(e)}")
-
-    lines = [line.strip() for line in text_content.splitlines() if line.strip()]
-    
-    if not lines:
-        raise HTTPException(status_code=400, detail="Il file è vuoto.")
-    
-    # ANALISI FILE: Consolida le quantità per SKU
+    # ANALISI FILE: Consolida le quantità per SKU, leggendo le righe a blocchi dall'upload
     sku_quantities = {}
     sku_original_codes = {}  # Mappa SKU -> primo codice originale trovato
     errors = []
     warnings = []
     recap_items = []
+    barcode_resolver.ensure_loaded(db)
     
-    for line_num, line in enumerate(lines, 1):
+    line_num = 0
+    async for raw_line in iter_upload_lines(file):
+        line = raw_line.strip()
+        if not line:
+            continue
+        line_num += 1
+
         # Parse SKU e quantità
         if '_' in line:
             parts = line.rsplit('_', 1)
@@ -1534,21 +1353,10 @@ async def parse_unload_container_file(file: UploadFile = File(...), db: Session
             })
             continue
         
-        # Verifica che il prodotto esista - supporta sia EAN code che SKU
-        sku_found = None
-        product = None
+        # Verifica che il prodotto esista - supporta sia EAN code che SKU (prima come EAN)
         input_code = sku  # Conserva il codice originale dal file per il logging
-        
-        # Prima prova a cercare come EAN code
-        ean_code = db.query(models.EanCode).filter(models.EanCode.ean == sku).first()
-        if ean_code:
-            sku_found = ean_code.product_sku
-            product = db.query(models.Product).filter(models.Product.sku == sku_found).first()
-        else:
-            # Altrimenti prova a cercare come SKU diretto
-            product = db.query(models.Product).filter(models.Product.sku == sku).first()
-            if product:
-                sku_found = product.sku
+        product = await barcode_resolver.resolve_async(sku)
+        sku_found = product.sku if product else None
         
         if not product or not sku_found:
             errors.append({
@@ -1568,10 +1376,13 @@ async def parse_unload_container_file(file: UploadFile = File(...), db: Session
         # Accumula quantità per SKU
         sku_quantities[sku] = sku_quantities.get(sku, 0) + quantity
 
+    if not line_num:
+        raise HTTPException(status_code=400, detail="Il file è vuoto.")
+
     # Crea recap items per ogni SKU consolidato
     for sku, total_quantity in sku_quantities.items():
         # Trova descrizione prodotto
-        product = db.query(models.Product).filter(models.Product.sku == sku).first()
+        product = barcode_resolver.get_product(sku, refresh=False)
         description = product.description if product else "Descrizione non disponibile"
         
         # Trova giacenza attuale a TERRA
@@ -1611,8 +1422,8 @@ async def parse_unload_container_file(file: UploadFile = File(...), db: Session
         'total_items': len(recap_items),
         'total_pieces': sum(sku_quantities.values()) if sku_quantities else 0,
         'file_analysis': {
-            'total_lines': len(lines),
-            'valid_lines': len(lines) - len(errors),
+            'total_lines': line_num,
+            'valid_lines': line_num - len(errors),
             'unique_skus': len(sku_quantities),
             'consolidated_items': len(recap_items)
         }
@@ -1630,48 +1441,14 @@ async def commit_unload_container_operations(operations_data: dict, db: Session
     if not operations:
         raise HTTPException(status_code=400, detail="Nessuna operazione da eseguire.")
     
-    processed_items = 0
-    errors = []
-    
-    try:
-        for op in operations:
-            if op.get("status") == "error":
-                continue  # Salta operazioni con errori
-                
-            sku = op.get("sku")
-            quantity_to_add = op.get("quantity_to_add")
-            
-            # Trova tutti i record esistenti a TERRA per questo SKU
-            existing_ground_records = db.query(models.Inventory).filter(
-                models.Inventory.product_sku == sku,
-                models.Inventory.location_name == "TERRA"
-            ).all()
-            
-            if existing_ground_records:
-                # Consolida tutti i record esistenti + nuova quantità nel primo record
-                primary_record = existing_ground_records[0]
-                total_existing = sum(record.quantity for record in existing_ground_records)
-                
-                # Aggiorna il primo record con la quantità totale esistente + nuova quantità
-                primary_record.quantity = total_existing + quantity_to_add
-                
-                # Rimuovi tutti gli altri record duplicati
-                for record in existing_ground_records[1:]:
-                    db.delete(record)
-            else:
-                # Crea nuovo record con quantità consolidata
-                ground_inventory = models.Inventory(
-                    product_sku=sku,
-                    location_name="TERRA",
-                    quantity=quantity_to_add
-                )
-                db.add(ground_inventory)
-            
-            processed_items += 1
-        
-        if errors:
-            db.rollback()
-            raise HTTPException(status_code=400, detail="Operazione parzialmente fallita:\\n" + "\\n".join(errors))
+    def apply_unload_operations():
+        active_operations = [op for op in operations if op.get("status") != "error"]  # Salta operazioni con errori
+        batch = InventoryMutationService.batch(db, OperationType.SCARICO_CONTAINER_FILE)
+        batch.prefetch(("TERRA", op.get("sku")) for op in active_operations)
+        for op in active_operations:
+            batch.adjust("TERRA", op.get("sku"), op.get("quantity_to_add"))
+        batch.apply()
+        processed_items = len(active_operations)
         
         # LOGGING: Registra le operazioni di scarico container da file
         logger = LoggingService(db)
@@ -1707,7 +1484,11 @@ async def commit_unload_container_operations(operations_data: dict, db: Session
         db.commit()
         total_pieces = sum(op.get("quantity_to_add", 0) for op in operations if op.get("status") != "error")
         return {"message": f"Scarico container completato. Processati {processed_items} SKU per un totale di {total_pieces} pezzi a TERRA."}
-        
+    
+    try:
+        return await run_in_threadpool(run_with_retry, db, apply_unload_operations)
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Errore durante l'operazione: {str(e)}")
@@ -1732,85 +1513,48 @@ async def relocate_from_ground_manual(relocate_data: dict, db: Session = Depends
         raise HTTPException(status_code=404, detail=f"Ubicazione '{location}' non trovata")
     
     
-    # Trova TUTTI i record dello stesso SKU a TERRA e calcola il totale
-    ground_inventory_records = db.query(models.Inventory).filter(
-        models.Inventory.product_sku == sku,
-        models.Inventory.location_name == "TERRA"
-    ).all()
-    
-    total_available = sum(record.quantity for record in ground_inventory_records)
+    def apply_relocate():
+        batch = InventoryMutationService.batch(db, OperationType.UBICAZIONE_DA_TERRA_MANUALE)
+        batch.prefetch([("TERRA", sku), (location, sku)])
+        total_available = batch.quantity("TERRA", sku)
     
-    if total_available < quantity:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Giacenza insufficiente a TERRA per '{sku}'. Richiesti: {quantity}, Disponibili: {total_available}"
-        )
+        if total_available < quantity:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Giacenza insufficiente a TERRA per '{sku}'. Richiesti: {quantity}, Disponibili: {total_available}"
+            )
     
-    # Verifica che l'ubicazione di destinazione non contenga già un altro prodotto (ECCEZIONE: TERRA può contenere SKU multipli)
-    if location != "TERRA":
-        existing_inventory = db.query(models.Inventory).filter(
-            models.Inventory.location_name == location,
-            models.Inventory.product_sku != sku,
-            models.Inventory.quantity > 0
-        ).first()
-        
-        if existing_inventory:
+        # Verifica che l'ubicazione di destinazione non contenga già un altro prodotto (ECCEZIONE: TERRA può contenere SKU multipli)
+        source, _ = batch.move(sku, "TERRA", location, quantity)
+        if source.status == source.CONFLICT:
             raise HTTPException(
                 status_code=400,
-                detail=f"L'ubicazione '{location}' contiene già il prodotto '{existing_inventory.product_sku}'. Una ubicazione può contenere solo un tipo di prodotto."
+                detail=f"L'ubicazione '{location}' contiene già il prodotto '{source.conflicting_sku}'. Una ubicazione può contenere solo un tipo di prodotto."
             )
+        batch.apply()
     
-    # Rimuovi dalla TERRA - gestisce record multipli dello stesso SKU
-    remaining_to_remove = quantity
-    for record in ground_inventory_records:
-        if remaining_to_remove <= 0:
-            break
-        
-        if record.quantity <= remaining_to_remove:
-            # Rimuovi tutto il record
-            remaining_to_remove -= record.quantity
-            db.delete(record)
-        else:
-            # Rimuovi parzialmente
-            record.quantity -= remaining_to_remove
-            remaining_to_remove = 0
-    
-    # Trova o crea nell'ubicazione di destinazione
-    destination_inventory = db.query(models.Inventory).filter(
-        models.Inventory.product_sku == sku,
-        models.Inventory.location_name == location
-    ).first()
-    
-    if destination_inventory:
-        destination_inventory.quantity += quantity
-    else:
-        destination_inventory = models.Inventory(
+        # LOGGING: Registra lo spostamento da TERRA
+        logger = LoggingService(db)
+        logger.log_operation(
+            operation_type=OperationType.SPOSTAMENTO_MANUALE,
+            operation_category=OperationCategory.MANUAL,
+            status=OperationStatus.SUCCESS,
             product_sku=sku,
-            location_name=location,
-            quantity=quantity
+            location_from="TERRA",
+            location_to=location,
+            quantity=quantity,
+            user_id="manual_user",
+            details={
+                'operation_description': f"Ubicazione da TERRA: {sku} ({quantity} pz) da TERRA a {location}",
+                'total_available': total_available,
+                'movement_type': 'ground_to_location'
+            }
         )
-        db.add(destination_inventory)
-    
-    # LOGGING: Registra lo spostamento da TERRA
-    logger = LoggingService(db)
-    logger.log_operation(
-        operation_type=OperationType.SPOSTAMENTO_MANUALE,
-        operation_category=OperationCategory.MANUAL,
-        status=OperationStatus.SUCCESS,
-        product_sku=sku,
-        location_from="TERRA",
-        location_to=location,
-        quantity=quantity,
-        user_id="manual_user",
-        details={
-            'operation_description': f"Ubicazione da TERRA: {sku} ({quantity} pz) da TERRA a {location}",
-            'total_available': total_available,
-            'movement_type': 'ground_to_location'
-        }
-    )
     
-    db.commit()
-    return {"message": f"Spostati {quantity} pz di '{sku}' da TERRA a '{location}'."}
+        db.commit()
+        return {"message": f"Spostati {quantity} pz di '{sku}' da TERRA a '{location}'."}
+
+    return await run_in_threadpool(run_with_retry, db, apply_relocate)
 
 @router.post("/parse-relocate-from-ground-file")
 async def parse_relocate_from_ground_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
@@ -1826,16 +1570,29 @@ async def parse_relocate_from_ground_file(file: UploadFile = File(...), db: Sess
     if not movements:
         raise HTTPException(status_code=400, detail="Il file è vuoto o non contiene dati validi da elaborare.")
 
-    # ANALISI MOVIMENTI: Verifica e prepara recap
+    return await run_in_threadpool(_build_relocate_from_ground_recap, movements, db)
+
+
+def _build_relocate_from_ground_recap(movements: Dict[str, Dict[str, int]], db: Session):
+    """
+    Recap dell'ubicazione da terra (sincrono, eseguito nel threadpool): ubicazioni esistenti
+    con una query IN, giacenze delle destinazioni e di TERRA lette dal database per le sole
+    ubicazioni del file, prodotti dal catalogo in memoria.
+    """
     recap_items = []
     errors = []
     warnings = []
     total_operations = 0
-    
+    destinations = list(movements.keys())
+    existing_locations = set()
+    for start in range(0, len(destinations), BULK_CHUNK_SIZE):
+        chunk = destinations[start:start + BULK_CHUNK_SIZE]
+        existing_locations.update(name for (name,) in db.query(models.Location.name).filter(models.Location.name.in_(chunk)))
+    occupancy = OccupancySnapshot.load(db, [*destinations, "TERRA"])
+
     for location, skus in movements.items():
         # Verifica che l'ubicazione esista
-        location_exists = db.query(models.Location).filter(models.Location.name == location).first()
-        if not location_exists:
+        if location not in existing_locations:
             for sku in skus.keys():
                 errors.append({
                     'line': total_operations + 1,
@@ -1847,13 +1604,9 @@ async def parse_relocate_from_ground_file(file: UploadFile = File(...), db: Sess
             
         # Verifica conflitti ubicazione (non può contenere SKU diversi)
         if location != "TERRA":
-            existing_inventory = db.query(models.Inventory).filter(
-                models.Inventory.location_name == location,
-                models.Inventory.quantity > 0
-            ).all()
+            existing_skus = [stocked_sku for stocked_sku, _ in occupancy.stocked_skus(location)]
             
-            if existing_inventory:
-                existing_skus = [inv.product_sku for inv in existing_inventory]
+            if existing_skus:
                 new_skus = list(skus.keys())
                 
                 # Se l'ubicazione contiene già prodotti diversi da quelli che vogliamo inserire
@@ -1872,7 +1625,7 @@ async def parse_relocate_from_ground_file(file: UploadFile = File(...), db: Sess
             total_operations += 1
             
             # Verifica che il prodotto esista
-            product = db.query(models.Product).filter(models.Product.sku == sku).first()
+            product = barcode_resolver.get_product(sku, refresh=False)
             if not product:
                 errors.append({
                     'line': total_operations,
@@ -1881,13 +1634,8 @@ async def parse_relocate_from_ground_file(file: UploadFile = File(...), db: Sess
                 })
                 continue
             
-            # Verifica giacenza a TERRA
-            ground_inventory_records = db.query(models.Inventory).filter(
-                models.Inventory.product_sku == sku,
-                models.Inventory.location_name == "TERRA"
-            ).all()
-            
-            ground_quantity = sum(record.quantity for record in ground_inventory_records)
+            # Verifica giacenza a TERRA (una riga per SKU: indice unico su ubicazione e SKU)
+            ground_quantity = occupancy.quantity("TERRA", sku)
             
             if ground_quantity < quantity:
                 errors.append({
@@ -1898,23 +1646,10 @@ async def parse_relocate_from_ground_file(file: UploadFile = File(...), db: Sess
                 continue
             
             # Verifica giacenza destinazione
-            destination_inventory = db.query(models.Inventory).filter(
-                models.Inventory.product_sku == sku,
-                models.Inventory.location_name == location
-            ).first()
-            
-            current_destination_qty = destination_inventory.quantity if destination_inventory else 0
+            current_destination_qty = occupancy.quantity(location, sku)
             new_destination_qty = current_destination_qty + quantity
             new_ground_qty = ground_quantity - quantity
             
-            # Warning se ci sono record TERRA duplicati
-            if len(ground_inventory_records) > 1:
-                warnings.append({
-                    'message': f"TERRA contiene {len(ground_inventory_records)} record duplicati per '{sku}' (verranno consolidati automaticamente)",
-                    'sku': sku,
-                    'location': 'TERRA'
-                })
-            
             recap_items.append({
                 'line': total_operations,
                 'input_code': f"{location} -> {sku}{'_' + str(quantity) if quantity > 1 else ''}",
@@ -1954,66 +1689,32 @@ async def commit_relocate_from_ground_operations(operations_data: dict, db: Sess
     if not operations:
         raise HTTPException(status_code=400, detail="Nessuna operazione da eseguire.")
     
-    processed_items = 0
-    errors = []
-    
-    try:
-        for op in operations:
-            if op.get("status") == "error":
-                continue  # Salta operazioni con errori
-                
+    def apply_relocate_operations():
+        processed_items = 0
+        errors = []
+        active_operations = [op for op in operations if op.get("status") != "error"]  # Salta operazioni con errori
+        batch = InventoryMutationService.batch(db, OperationType.UBICAZIONE_DA_TERRA_FILE)
+        batch.prefetch(
+            key for op in active_operations
+            for key in (("TERRA", op.get("sku")), (op.get("location_to"), op.get("sku")))
+        )
+        for op in active_operations:
             sku = op.get("sku")
-            location_to = op.get("location_to")
             quantity_to_move = op.get("quantity_to_move")
             
-            # Trova e consolida TUTTI i record dello stesso SKU a TERRA
-            ground_inventory_records = db.query(models.Inventory).filter(
-                models.Inventory.product_sku == sku,
-                models.Inventory.location_name == "TERRA"
-            ).all()
-            
-            total_ground_quantity = sum(record.quantity for record in ground_inventory_records)
-            
-            if total_ground_quantity < quantity_to_move:
-                errors.append(f"Giacenza insufficiente a TERRA per '{sku}'. Richiesti: {quantity_to_move}, Disponibili: {total_ground_quantity}")
+            # Conflitti di ubicazione già confermati dall'utente nel recap: nessun controllo qui
+            source, _ = batch.move(sku, "TERRA", op.get("location_to"), quantity_to_move, check_conflict=False)
+            if not source.ok:
+                errors.append(f"Giacenza insufficiente a TERRA per '{sku}'. Richiesti: {quantity_to_move}, Disponibili: {source.previous_quantity}")
                 continue
             
-            # Rimuovi dalla TERRA - gestisce record multipli dello stesso SKU
-            remaining_to_remove = quantity_to_move
-            for record in ground_inventory_records:
-                if remaining_to_remove <= 0:
-                    break
-                
-                if record.quantity <= remaining_to_remove:
-                    # Rimuovi tutto il record
-                    remaining_to_remove -= record.quantity
-                    db.delete(record)
-                else:
-                    # Rimuovi parzialmente
-                    record.quantity -= remaining_to_remove
-                    remaining_to_remove = 0
-            
-            # Trova o crea nell'ubicazione di destinazione
-            destination_inventory = db.query(models.Inventory).filter(
-                models.Inventory.product_sku == sku,
-                models.Inventory.location_name == location_to
-            ).first()
-            
-            if destination_inventory:
-                destination_inventory.quantity += quantity_to_move
-            else:
-                destination_inventory = models.Inventory(
-                    product_sku=sku,
-                    location_name=location_to,
-                    quantity=quantity_to_move
-                )
-                db.add(destination_inventory)
-            
             processed_items += 1
         
         if errors:
             db.rollback()
             raise HTTPException(status_code=400, detail="Operazione parzialmente fallita:\\n" + "\\n".join(errors))
+
+        batch.apply()
         
         # LOGGING: Registra le operazioni di ubicazione da terra da file
         logger = LoggingService(db)
@@ -2048,7 +1749,11 @@ async def commit_relocate_from_ground_operations(operations_data: dict, db: Sess
         
         db.commit()
         return {"message": f"Ubicazione da terra completata. Processati {processed_items} movimenti."}
-        
+    
+    try:
+        return await run_in_threadpool(run_with_retry, db, apply_relocate_operations)
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Errore durante l'operazione: {str(e)}")
@@ -2059,6 +1764,7 @@ async def consolidate_ground_inventory(db: Session = Depends(get_db)):
     Consolida i record duplicati dello stesso SKU in TERRA.
     """
     try:
+        set_ledger_context(db, OperationType.CONSOLIDAMENTO_TERRA)
         # Trova tutti i record a TERRA
         ground_records = db.query(models.Inventory).filter(
             models.Inventory.location_name == "TERRA"
@@ -2105,77 +1811,40 @@ async def get_consolidation_suggestions(db: Session = Depends(get_db)):
     Criteri:
     - Solo prodotti con pallettizzazione definita (pallet_quantity > 0)
     - Esclude ubicazioni TERRA
-    - Combina ubicazioni con stesso SKU se totale <= pallet_quantity
-    - Suggerisce spostamento da ubicazione più piccola a più grande
+    - Per ogni SKU trova il numero minimo di pallet che contengono tutte le sue ubicazioni
+      (bin packing, vedi services/consolidation_planner.py): un suggerimento per pallet
+    - Suggerisce spostamento dalle ubicazioni più piccole alla più piena del pallet
+    - Ordina per ubicazioni liberate per unità di percorso
     """
     try:
-        suggestions = []
-        
-        # 1. Ottieni prodotti con pallettizzazione definita
-        products_with_pallet = db.query(models.Product).filter(
+        products_with_palletization = db.query(func.count(models.Product.sku)).filter(
             models.Product.pallet_quantity > 0
-        ).all()
-        
-        products_analyzed = 0
-        products_with_palletization = len(products_with_pallet)
-        
-        for product in products_with_pallet:
-            products_analyzed += 1
-            
-            # 2. Trova tutte le ubicazioni per questo SKU (esclusa TERRA)
-            locations = db.query(models.Inventory).filter(
-                models.Inventory.product_sku == product.sku,
-                models.Inventory.quantity > 0,
-                models.Inventory.location_name != "TERRA"
-            ).order_by(models.Inventory.quantity.desc()).all()  # Ordina per quantità decrescente
-            
-            # 3. Se ci sono almeno 2 ubicazioni, calcola il consolidamento ottimale
-            if len(locations) < 2:
-                continue
-            
-            # 4. Algoritmo di consolidamento ottimale
-            optimal_consolidation = _find_optimal_consolidation(locations, product.pallet_quantity)
-            
-            if optimal_consolidation:
-                # Crea un unico suggerimento per questo SKU
-                from_locations = []
-                total_from_quantity = 0
-                
-                for loc in optimal_consolidation['from_locations']:
-                    from_locations.append(f"{loc['location']} ({loc['quantity']}pz)")
-                    total_from_quantity += loc['quantity']
-                
-                target_location = optimal_consolidation['to_location']
-                target_quantity = optimal_consolidation['to_quantity']
-                final_quantity = total_from_quantity + target_quantity
-                
-                locations_freed = len(optimal_consolidation['from_locations'])
-                efficiency_gain = f"Libera {locations_freed} ubicazione{'i' if locations_freed > 1 else ''} ({final_quantity}/{product.pallet_quantity})"
-                
-                suggestions.append(inventory_schemas.ConsolidationSuggestion(
-                    sku=product.sku,
-                    description="",  # Rimuovo la descrizione superflua come richiesto
-                    pallet_quantity=product.pallet_quantity,
-                    from_location=" + ".join(from_locations),  # Mostra tutte le ubicazioni di origine
-                    from_quantity=total_from_quantity,
-                    to_location=f"{target_location['location']} ({target_location['quantity']}pz)",
-                    to_quantity=target_quantity,
-                    combined_quantity=final_quantity,
-                    efficiency_gain=efficiency_gain
-                ))
-        
-        # 7. Calcola statistiche
-        total_suggestions = len(suggestions)
-        locations_saveable = sum([
-            len(suggestion.from_location.split(" + ")) 
-            for suggestion in suggestions
-        ])  # Conta tutte le ubicazioni che verranno liberate
-        
+        ).scalar() or 0
+
+        suggestions = []
+        for move in await run_in_threadpool(ConsolidationPlanner.plan, db):
+            locations_freed = move.locations_freed
+            efficiency_gain = f"Libera {locations_freed} ubicazione{'i' if locations_freed > 1 else ''} ({move.combined_quantity}/{move.pallet_quantity})"
+
+            suggestions.append(inventory_schemas.ConsolidationSuggestion(
+                sku=move.sku,
+                description="",  # Rimuovo la descrizione superflua come richiesto
+                pallet_quantity=move.pallet_quantity,
+                from_location=" + ".join(f"{source.location} ({source.quantity}pz)" for source in move.sources),  # Mostra tutte le ubicazioni di origine
+                from_quantity=move.moved_quantity,
+                to_location=f"{move.target.location} ({move.target.quantity}pz)",
+                to_quantity=move.target.quantity,
+                combined_quantity=move.combined_quantity,
+                efficiency_gain=efficiency_gain,
+                locations_freed=locations_freed,
+                travel_distance=move.travel
+            ))
+
         return inventory_schemas.ConsolidationSuggestionsResponse(
             suggestions=suggestions,
-            total_suggestions=total_suggestions,
-            locations_saveable=locations_saveable,
-            products_analyzed=products_analyzed,
+            total_suggestions=len(suggestions),
+            locations_saveable=sum(suggestion.locations_freed for suggestion in suggestions),
+            products_analyzed=products_with_palletization,
             products_with_palletization=products_with_palletization
         )
         
@@ -2183,71 +1852,6 @@ async def get_consolidation_suggestions(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Errore durante l'analisi consolidamenti: {str(e)}")
 
 
-def _find_optimal_consolidation(locations, pallet_quantity):
-    """
-    Trova il consolidamento ottimale per un SKU.
-    
-    Strategia migliorata:
-    1. Prova diverse combinazioni per trovare quella che libera più ubicazioni
-    2. Considera qualsiasi ubicazione come potenziale target
-    3. Verifica che il totale non superi pallet_quantity
-    
-    Args:
-        locations: Lista di record Inventory ordinata per quantità decrescente
-        pallet_quantity: Capacità massima del pallet
-        
-    Returns:
-        Dict con from_locations, to_location, to_quantity oppure None
-    """
-    if len(locations) < 2:
-        return None
-    
-    best_consolidation = None
-    max_locations_freed = 0
-    
-    # Prova ogni ubicazione come potenziale target
-    for i, target in enumerate(locations):
-        remaining_locations = locations[:i] + locations[i+1:]
-        
-        # Calcola spazio disponibile nel target
-        available_space = pallet_quantity - target.quantity
-        
-        if available_space <= 0:
-            continue  # Target già pieno, prova il prossimo
-        
-        # Algoritmo greedy: seleziona ubicazioni da consolidare
-        selected_locations = []
-        total_to_move = 0
-        
-        # Ordina per quantità crescente per ottimizzare lo spazio
-        remaining_sorted = sorted(remaining_locations, key=lambda x: x.quantity)
-        
-        for location in remaining_sorted:
-            if total_to_move + location.quantity <= available_space:
-                selected_locations.append(location)
-                total_to_move += location.quantity
-        
-        # Verifica se questa combinazione è migliore
-        locations_freed = len(selected_locations)
-        if locations_freed > max_locations_freed and locations_freed > 0:
-            max_locations_freed = locations_freed
-            best_consolidation = {
-                'from_locations': [
-                    {'location': loc.location_name, 'quantity': loc.quantity} 
-                    for loc in selected_locations
-                ],
-                'to_location': {
-                    'location': target.location_name,
-                    'quantity': target.quantity
-                },
-                'to_quantity': target.quantity,
-                'total_moved': total_to_move,
-                'locations_freed': locations_freed
-            }
-    
-    return best_consolidation
-
-
 @router.get("/consolidation-suggestions/pdf")
 async def export_consolidation_suggestions_pdf(db: Session = Depends(get_db)):
     """
@@ -6,7 +6,7 @@ from datetime import datetime, timedelta
 import csv
 import io
 
-from wms_app.database import get_db
+from wms_app.database import get_db, get_read_db
 from wms_app.routers.auth import require_permission
 from wms_app.services.logging_service import LoggingService
 from wms_app.models.logs import OperationType, OperationCategory, OperationStatus
@@ -170,7 +170,7 @@ async def logs_dashboard(request: Request):
 
 @router.get("/data")
 async def get_logs_data(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=1, le=500),
     start_date: Optional[str] = Query(None),
@@ -279,7 +279,7 @@ async def get_logs_data(
 
 @router.get("/statistics")
 async def get_logs_statistics(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     days: int = Query(7, ge=1, le=365)
 ):
     """
@@ -301,7 +301,7 @@ async def get_logs_statistics(
 
 @router.get("/export")
 async def export_logs_csv(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     operation_types: Optional[str] = Query(None),
@@ -474,7 +474,7 @@ async def get_operation_types():
 
 @router.get("/recent")
 async def get_recent_logs(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     limit: int = Query(10, ge=1, le=100)
 ):
     """
@@ -1,5 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.sql import func
 from typing import List, Dict, Tuple, Any, Optional
@@ -25,9 +28,14 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, Tabl
 from reportlab.lib.units import inch
 
 from wms_app import models, schemas
-from wms_app.database import database, get_db
+from wms_app.database import database, get_db, get_async_db, get_write_lock
 from wms_app.routers.auth import require_permission
 from wms_app.services.logging_service import LoggingService
+from wms_app.services.barcode_resolver import barcode_resolver
+from wms_app.services.inventory_mutation_service import InventoryMutationService
+from wms_app.services.optimistic_lock import run_with_retry, run_with_retry_async
+from wms_app.services.stock_ledger import StockLedgerService
+from wms_app.services.upload_reader import iter_upload_lines
 from wms_app.models.logs import OperationType, OperationCategory, OperationStatus
 
 # Import templates in modo lazy per evitare import circolari
@@ -452,15 +460,9 @@ def get_archived_orders(db: Session = Depends(get_db)):
 
 @router.post("/import-orders-txt")
 async def import_orders_from_txt(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    content = await file.read()
-    try:
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
-
     orders_in_file = {}
     line_number = 0
-    for line in text_content.splitlines():
+    async for line in iter_upload_lines(file):
         line_number += 1
         if not line.strip():
             continue
@@ -604,8 +606,7 @@ async def validate_picking_from_txt(file: UploadFile = File(...), db: Session =
     
     # Prepara mappe per validazione
     all_orders = {o.order_number: o for o in db.query(models.Order).options(joinedload(models.Order.lines)).all()}
-    all_products = {p.sku: p for p in db.query(models.Product).all()}
-    all_eans = {e.ean: e.product_sku for e in db.query(models.EanCode).all()}
+    barcode_resolver.ensure_loaded(db)
     
     # Aggiungi errori di parsing al recap
     for parse_error in parse_errors:
@@ -717,7 +718,7 @@ async def validate_picking_from_txt(file: UploadFile = File(...), db: Session =
                     
                     if not order_line:
                         # Controlla se è un EAN code che corrisponde a un SKU nell'ordine
-                        actual_sku = all_eans.get(sku)
+                        actual_sku = await barcode_resolver.sku_for_ean_async(sku)
                         if actual_sku:
                             for line in order.lines:
                                 if line.product_sku == actual_sku:
@@ -786,7 +787,7 @@ async def validate_picking_from_txt(file: UploadFile = File(...), db: Session =
                     recap_item["status"] = "error"
                 
                 # Aggiungi descrizione prodotto se disponibile
-                product = all_products.get(recap_item["sku"])
+                product = await barcode_resolver.get_product_async(recap_item["sku"])
                 if product:
                     recap_item["description"] = product.description
                 
@@ -842,124 +843,128 @@ async def commit_picking_from_txt(file: UploadFile = File(...), force: bool = Fa
     if parse_errors and not force:
         raise HTTPException(status_code=400, detail=f"Errori di parsing trovati. Usa force=true per ignorarli: {len(parse_errors)} errori")
     
-    successful_operations = []
-    skipped_operations = []
+    def apply_picking():
+        successful_operations = []
+        skipped_operations = []
     
-    for order_number, locations_data in picking_data.items():
-        # Trova l'ordine
-        order = db.query(models.Order).filter(models.Order.order_number == order_number).first()
-        if not order or order.is_completed:
-            skipped_operations.append(f"Ordine '{order_number}' saltato (non trovato o completato)")
-            continue
-        
-        for location, skus_data in locations_data.items():
-            for sku, quantity in skus_data.items():
-                # Trova la riga ordine
-                order_line = db.query(models.OrderLine).filter(
-                    models.OrderLine.order_id == order.id,
-                    models.OrderLine.product_sku == sku
-                ).first()
-                
-                if not order_line:
-                    skipped_operations.append(f"Prodotto '{sku}' non trovato nell'ordine '{order_number}'")
-                    continue
+        for order_number, locations_data in picking_data.items():
+            # Trova l'ordine
+            order = db.query(models.Order).filter(models.Order.order_number == order_number).first()
+            if not order or order.is_completed:
+                skipped_operations.append(f"Ordine '{order_number}' saltato (non trovato o completato)")
+                continue
+            # Un batch per ordine: i movimenti del registro portano il numero d'ordine
+            batch = InventoryMutationService.batch(db, OperationType.PRELIEVO_FILE, order_number=order.order_number)
+            batch.prefetch((location, sku) for location, skus_data in locations_data.items() for sku in skus_data)
+        
+            for location, skus_data in locations_data.items():
+                for sku, quantity in skus_data.items():
+                    # Trova la riga ordine
+                    order_line = db.query(models.OrderLine).filter(
+                        models.OrderLine.order_id == order.id,
+                        models.OrderLine.product_sku == sku
+                    ).first()
                 
-                # Verifica giacenza disponibile
-                inventory_item = db.query(models.Inventory).filter(
-                    models.Inventory.location_name == location,
-                    models.Inventory.product_sku == sku
-                ).first()
+                    if not order_line:
+                        skipped_operations.append(f"Prodotto '{sku}' non trovato nell'ordine '{order_number}'")
+                        continue
                 
-                if not inventory_item or inventory_item.quantity < quantity:
-                    skipped_operations.append(f"Giacenza insufficiente per {sku} in {location}")
-                    continue
+                    # Verifica giacenza disponibile
+                    if batch.quantity(location, sku) < quantity:
+                        skipped_operations.append(f"Giacenza insufficiente per {sku} in {location}")
+                        continue
                 
-                # Verifica quantità ordine (con tolleranza se force=True)
-                remaining_to_pick = order_line.requested_quantity - order_line.picked_quantity
-                actual_quantity = quantity
+                    # Verifica quantità ordine (con tolleranza se force=True)
+                    remaining_to_pick = order_line.requested_quantity - order_line.picked_quantity
+                    actual_quantity = quantity
                 
-                if quantity > remaining_to_pick:
-                    if force and remaining_to_pick > 0:
-                        actual_quantity = remaining_to_pick  # Preleva solo quello che serve
-                        skipped_operations.append(f"Ridotta quantità per {sku} da {quantity} a {actual_quantity}")
-                    elif remaining_to_pick == 0:
-                        skipped_operations.append(f"Saltato {sku}: già completamente prelevato")
-                        continue
-                    else:
-                        skipped_operations.append(f"Saltato {sku}: quantità eccessiva")
-                        continue
+                    if quantity > remaining_to_pick:
+                        if force and remaining_to_pick > 0:
+                            actual_quantity = remaining_to_pick  # Preleva solo quello che serve
+                            skipped_operations.append(f"Ridotta quantità per {sku} da {quantity} a {actual_quantity}")
+                        elif remaining_to_pick == 0:
+                            skipped_operations.append(f"Saltato {sku}: già completamente prelevato")
+                            continue
+                        else:
+                            skipped_operations.append(f"Saltato {sku}: quantità eccessiva")
+                            continue
                 
-                # Esegui l'operazione di picking
-                inventory_item.quantity -= actual_quantity
-                order_line.picked_quantity += actual_quantity
+                    # Esegui l'operazione di picking
+                    batch.adjust(location, sku, -actual_quantity)
+                    order_line.picked_quantity += actual_quantity
                 
-                # Aggiungi a OutgoingStock
-                outgoing_item = db.query(models.OutgoingStock).filter(
-                    models.OutgoingStock.order_line_id == order_line.id,
-                    models.OutgoingStock.product_sku == sku
-                ).first()
+                    # Aggiungi a OutgoingStock
+                    outgoing_item = db.query(models.OutgoingStock).filter(
+                        models.OutgoingStock.order_line_id == order_line.id,
+                        models.OutgoingStock.product_sku == sku
+                    ).first()
                 
-                if outgoing_item:
-                    outgoing_item.quantity += actual_quantity
-                else:
-                    new_outgoing_item = models.OutgoingStock(
-                        order_line_id=order_line.id,
-                        product_sku=sku,
-                        quantity=actual_quantity
-                    )
-                    db.add(new_outgoing_item)
+                    if outgoing_item:
+                        outgoing_item.quantity += actual_quantity
+                    else:
+                        new_outgoing_item = models.OutgoingStock(
+                            order_line_id=order_line.id,
+                            product_sku=sku,
+                            quantity=actual_quantity
+                        )
+                        db.add(new_outgoing_item)
                 
-                successful_operations.append(f"Prelevato {actual_quantity}x {sku} da {location} per ordine {order_number}")
+                    successful_operations.append(f"Prelevato {actual_quantity}x {sku} da {location} per ordine {order_number}")
+        
+            batch.apply()
     
-    if not successful_operations and not force:
-        db.rollback()
-        raise HTTPException(status_code=400, detail="Nessuna operazione valida da eseguire")
+        if not successful_operations and not force:
+            db.rollback()
+            raise HTTPException(status_code=400, detail="Nessuna operazione valida da eseguire")
     
-    # LOGGING: Registra le operazioni di picking da file
-    logger = LoggingService(db)
+        # LOGGING: Registra le operazioni di picking da file
+        logger = LoggingService(db)
     
-    # Prepara operazioni per logging
-    batch_operations = []
-    for order_number, locations_data in picking_data.items():
-        for location, skus_data in locations_data.items():
-            for sku, quantity in skus_data.items():
-                # Controlla se l'operazione è stata eseguita con successo
-                operation_found = any(f"{quantity}x {sku} da {location} per ordine {order_number}" in op 
-                                    for op in successful_operations)
-                if operation_found:
-                    batch_operations.append({
-                        'product_sku': sku,
-                        'location_from': location,
-                        'location_to': None,  # Picking: scala da inventario
-                        'quantity': quantity,
-                        'status': OperationStatus.SUCCESS,
-                        'details': {
-                            'order_number': order_number,
-                            'operation_description': f"Picking da file: {sku} ({quantity} pz) da {location} per ordine {order_number}",
-                            'source': 'picking_file_scanner',
-                            'picking_type': 'file_picking'
-                        }
-                    })
+        # Prepara operazioni per logging
+        batch_operations = []
+        for order_number, locations_data in picking_data.items():
+            for location, skus_data in locations_data.items():
+                for sku, quantity in skus_data.items():
+                    # Controlla se l'operazione è stata eseguita con successo
+                    operation_found = any(f"{quantity}x {sku} da {location} per ordine {order_number}" in op 
+                                        for op in successful_operations)
+                    if operation_found:
+                        batch_operations.append({
+                            'product_sku': sku,
+                            'location_from': location,
+                            'location_to': None,  # Picking: scala da inventario
+                            'quantity': quantity,
+                            'status': OperationStatus.SUCCESS,
+                            'details': {
+                                'order_number': order_number,
+                                'operation_description': f"Picking da file: {sku} ({quantity} pz) da {location} per ordine {order_number}",
+                                'source': 'picking_file_scanner',
+                                'picking_type': 'file_picking'
+                            }
+                        })
     
-    # Registra operazioni senza log batch start/end
-    if batch_operations:
-        file_name = file.filename if hasattr(file, 'filename') else 'picking_file.txt'
-        logger.log_file_operations(
-            operation_type=OperationType.PRELIEVO_FILE,
-            operation_category=OperationCategory.FILE,
-            operations=batch_operations,
-            file_name=file_name,
-            user_id="file_user"
-        )
+        # Registra operazioni senza log batch start/end
+        if batch_operations:
+            file_name = file.filename if hasattr(file, 'filename') else 'picking_file.txt'
+            logger.log_file_operations(
+                operation_type=OperationType.PRELIEVO_FILE,
+                operation_category=OperationCategory.FILE,
+                operations=batch_operations,
+                file_name=file_name,
+                user_id="file_user"
+            )
     
-    db.commit()
+        db.commit()
     
-    return {
-        "message": f"Picking completato: {len(successful_operations)} operazioni eseguite",
-        "successful_operations": successful_operations,
-        "skipped_operations": skipped_operations,
-        "force_mode": force
-    }
+        return {
+            "message": f"Picking completato: {len(successful_operations)} operazioni eseguite",
+            "successful_operations": successful_operations,
+            "skipped_operations": skipped_operations,
+            "force_mode": force
+        }
+
+    # Righe ordine e giacenze versionate: un prelievo concorrente fa ripetere l'intero file
+    return await run_in_threadpool(run_with_retry, db, apply_picking)
 
 @router.post("/debug-picking-txt")
 async def debug_picking_from_txt(file: UploadFile = File(...), db: Session = Depends(get_db)):
@@ -971,8 +976,9 @@ async def debug_picking_from_txt(file: UploadFile = File(...), db: Session = Dep
         
         # Check database contents
         all_locations = {loc.name for loc in db.query(models.Location).all()}
-        all_products = {p.sku for p in db.query(models.Product).all()}
-        all_eans = {e.ean: e.product_sku for e in db.query(models.EanCode).all()}
+        barcode_resolver.ensure_loaded(db)
+        all_products = barcode_resolver.products()
+        all_eans = barcode_resolver.ean_map()
         
         return {
             "file_name": file.filename,
@@ -1098,99 +1104,102 @@ def get_picking_suggestions(order_id: int, db: Session = Depends(get_db)):
     
     return suggestions
 
-@router.post("/{order_id}/confirm-pick", response_model=schemas.Order)
+@router.post("/{order_id}/confirm-pick", response_model=schemas.Order, dependencies=[Depends(get_write_lock)])
 def confirm_pick(order_id: int, pick_confirmation: schemas.PickConfirmation, db: Session = Depends(get_db)):
     from wms_app.services.reservation_service import ReservationService
     
-    order = db.query(models.Order).filter(models.Order.id == order_id).first()
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
-    if order.is_completed:
-        raise HTTPException(status_code=400, detail="Order is already completed")
+    def apply_pick():
+        order = db.query(models.Order).filter(models.Order.id == order_id).first()
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if order.is_completed:
+            raise HTTPException(status_code=400, detail="Order is already completed")
 
-    reservation_service = ReservationService(db)
+        reservation_service = ReservationService(db)
+        batch = InventoryMutationService.batch(db, OperationType.PICKING_CONFERMATO, order_number=order.order_number)
+        batch.prefetch((picked_item.location_name, picked_item.product_sku) for picked_item in pick_confirmation.picked_items)
 
-    for picked_item in pick_confirmation.picked_items:
-        order_line = db.query(models.OrderLine).filter(
-            models.OrderLine.id == picked_item.order_line_id,
-            models.OrderLine.order_id == order_id
-        ).first()
-        if not order_line:
-            raise HTTPException(status_code=404, detail=f"Order line {picked_item.order_line_id} not found for this order")
-
-        inventory_item = db.query(models.Inventory).filter(
-            models.Inventory.product_sku == picked_item.product_sku,
-            models.Inventory.location_name == picked_item.location_name
-        ).first()
+        for picked_item in pick_confirmation.picked_items:
+            order_line = db.query(models.OrderLine).filter(
+                models.OrderLine.id == picked_item.order_line_id,
+                models.OrderLine.order_id == order_id
+            ).first()
+            if not order_line:
+                raise HTTPException(status_code=404, detail=f"Order line {picked_item.order_line_id} not found for this order")
 
-        if not inventory_item or inventory_item.quantity < picked_item.quantity:
-            raise HTTPException(status_code=400, detail=f"Not enough stock of {picked_item.product_sku} in {picked_item.location_name} to pick {picked_item.quantity}")
+            # Scala dalla giacenza
+            result = batch.adjust(picked_item.location_name, picked_item.product_sku, -picked_item.quantity)
+            if not result.ok:
+                raise HTTPException(status_code=400, detail=f"Not enough stock of {picked_item.product_sku} in {picked_item.location_name} to pick {picked_item.quantity}")
 
-        # Scala dalla giacenza
-        inventory_item.quantity -= picked_item.quantity
-        order_line.picked_quantity += picked_item.quantity
+            order_line.picked_quantity += picked_item.quantity
 
-        # Sposta in OutgoingStock
-        outgoing_item = db.query(models.OutgoingStock).filter(
-            models.OutgoingStock.order_line_id == picked_item.order_line_id,
-            models.OutgoingStock.product_sku == picked_item.product_sku
-        ).first()
+            # Sposta in OutgoingStock
+            outgoing_item = db.query(models.OutgoingStock).filter(
+                models.OutgoingStock.order_line_id == picked_item.order_line_id,
+                models.OutgoingStock.product_sku == picked_item.product_sku
+            ).first()
 
-        if outgoing_item:
-            outgoing_item.quantity += picked_item.quantity
-        else:
-            new_outgoing_item = models.OutgoingStock(
-                order_line_id=picked_item.order_line_id,
-                product_sku=picked_item.product_sku,
-                quantity=picked_item.quantity
-            )
-            db.add(new_outgoing_item)
+            if outgoing_item:
+                outgoing_item.quantity += picked_item.quantity
+            else:
+                new_outgoing_item = models.OutgoingStock(
+                    order_line_id=picked_item.order_line_id,
+                    product_sku=picked_item.product_sku,
+                    quantity=picked_item.quantity
+                )
+                db.add(new_outgoing_item)
         
-        # NUOVO: Completa la prenotazione se present
-        # Cerca prenotazioni attive per questo ordine/prodotto/ubicazione
-        if hasattr(picked_item, 'reservation_id') and picked_item.reservation_id:
-            reservation_service.complete_reservation(picked_item.reservation_id, picked_item.quantity)
-        else:
-            # Fallback: cerca prenotazione per order_number/sku/location
-            from wms_app.models.reservations import InventoryReservation
-            reservation = db.query(InventoryReservation).filter(
-                InventoryReservation.order_id == str(order.order_number),
-                InventoryReservation.product_sku == picked_item.product_sku,
-                InventoryReservation.location_name == picked_item.location_name,
-                InventoryReservation.status == 'active'
-            ).first()
+            # NUOVO: Completa la prenotazione se present
+            # Cerca prenotazioni attive per questo ordine/prodotto/ubicazione
+            if hasattr(picked_item, 'reservation_id') and picked_item.reservation_id:
+                reservation_service.complete_reservation(picked_item.reservation_id, picked_item.quantity, commit=False)
+            else:
+                # Fallback: cerca prenotazione per order_number/sku/location
+                from wms_app.models.reservations import InventoryReservation
+                reservation = db.query(InventoryReservation).filter(
+                    InventoryReservation.order_id == str(order.order_number),
+                    InventoryReservation.product_sku == picked_item.product_sku,
+                    InventoryReservation.location_name == picked_item.location_name,
+                    InventoryReservation.status == 'active'
+                ).first()
             
-            if reservation:
-                reservation_service.complete_reservation(reservation.id, picked_item.quantity)
+                if reservation:
+                    reservation_service.complete_reservation(reservation.id, picked_item.quantity, commit=False)
+
+        batch.apply()
     
-    # LOGGING: Registra le operazioni di picking manuale
-    logger = LoggingService(db)
+        # LOGGING: Registra le operazioni di picking manuale
+        logger = LoggingService(db)
     
-    # Crea operazioni di log per ogni item prelevato
-    for picked_item in pick_confirmation.picked_items:
-        logger.log_operation(
-            operation_type=OperationType.PRELIEVO_MANUALE,
-            operation_category=OperationCategory.MANUAL,
-            status=OperationStatus.SUCCESS,
-            product_sku=picked_item.product_sku,
-            location_from=picked_item.location_name,
-            location_to=None,  # Picking: scala da inventario
-            quantity=picked_item.quantity,
-            user_id="picking_user",  # TODO: Sostituire con sistema auth reale
-            details={
-                'order_number': order.order_number,
-                'order_line_id': picked_item.order_line_id,
-                'operation_description': f"Picking manuale: {picked_item.product_sku} ({picked_item.quantity} pz) da {picked_item.location_name} per ordine {order.order_number}",
-                'picking_type': 'manual_picking',
-                'reservation_id': getattr(picked_item, 'reservation_id', None),
-                'customer_name': order.customer_name
-            },
-            api_endpoint="/orders/{order_id}/confirm-pick"
-        )
+        # Crea operazioni di log per ogni item prelevato
+        for picked_item in pick_confirmation.picked_items:
+            logger.log_operation(
+                operation_type=OperationType.PRELIEVO_MANUALE,
+                operation_category=OperationCategory.MANUAL,
+                status=OperationStatus.SUCCESS,
+                product_sku=picked_item.product_sku,
+                location_from=picked_item.location_name,
+                location_to=None,  # Picking: scala da inventario
+                quantity=picked_item.quantity,
+                user_id="picking_user",  # TODO: Sostituire con sistema auth reale
+                details={
+                    'order_number': order.order_number,
+                    'order_line_id': picked_item.order_line_id,
+                    'operation_description': f"Picking manuale: {picked_item.product_sku} ({picked_item.quantity} pz) da {picked_item.location_name} per ordine {order.order_number}",
+                    'picking_type': 'manual_picking',
+                    'reservation_id': getattr(picked_item, 'reservation_id', None),
+                    'customer_name': order.customer_name
+                },
+                api_endpoint="/orders/{order_id}/confirm-pick"
+            )
     
-    db.commit()
-    db.refresh(order)
-    return order
+        db.commit()
+        db.refresh(order)
+        return order
+
+    # Giacenza e riga ordine versionate: un prelievo concorrente sulle stesse righe fa ripetere tutto
+    return run_with_retry(db, apply_pick)
 
 @router.post("/{order_id}/fulfill", response_model=schemas.Order)
 def fulfill_order(order_id: int, db: Session = Depends(get_db)):
@@ -1281,13 +1290,6 @@ async def _parse_picking_file_scanner(file: UploadFile, db: Session) -> Tuple[Di
     
     Ritorna: (parsed_data, parse_errors)
     """
-    content = await file.read()
-    try:
-        text_content = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Il file non è in formato UTF-8 valido.")
-    
-    lines = [line.strip() for line in text_content.splitlines() if line.strip()]
     parsed_data = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
     parse_errors = []
     
@@ -1297,11 +1299,15 @@ async def _parse_picking_file_scanner(file: UploadFile, db: Session) -> Tuple[Di
     
     # Ottieni le ubicazioni esistenti dal database per confronto
     all_locations = {loc.name for loc in db.query(models.Location).all()}
+    barcode_resolver.ensure_loaded(db)
     
-    for i, line in enumerate(lines):
-        line = line.strip()
+    # Righe lette a blocchi dall'upload; la numerazione conta solo le righe non vuote
+    i = -1
+    async for raw_line in iter_upload_lines(file):
+        line = raw_line.strip()
         if not line:
             continue
+        i += 1
             
         # Verifica se è un numero ordine (numerico o alfanumerico corto)
         if line.replace('-', '').replace('_', '').isalnum() and len(line) <= 10:
@@ -1328,21 +1334,8 @@ async def _parse_picking_file_scanner(file: UploadFile, db: Session) -> Tuple[Di
                     ean_or_sku = parts[0]
                     quantity = int(parts[1])
             
-            # Trova SKU nel database
-            sku_found = None
-            try:
-                # Prova come EAN
-                ean_code = db.query(models.EanCode).filter(models.EanCode.ean == ean_or_sku).first()
-                if ean_code:
-                    sku_found = ean_code.product_sku
-                else:
-                    # Prova come SKU diretto
-                    product = db.query(models.Product).filter(models.Product.sku == ean_or_sku).first()
-                    if product:
-                        sku_found = product.sku
-            except Exception:
-                # Ignora errori di database per evitare hang
-                pass
+            # Trova SKU nel catalogo in memoria (prima come EAN, poi come SKU diretto)
+            sku_found = await barcode_resolver.resolve_sku_async(ean_or_sku)
             
             if sku_found:
                 parsed_data[current_order][current_location][sku_found] += quantity
@@ -1667,7 +1660,7 @@ def archive_order(order_id: int, fulfillment_request: schemas.FulfillmentRequest
 @router.post("/{order_id}/cancel")
 def cancel_order(order_id: int, db: Session = Depends(get_db)):
     """Annulla un ordine e rilascia la giacenza in uscita."""
-    try:
+    def apply_cancel():
         order = db.query(models.Order).filter(models.Order.id == order_id).first()
         if not order:
             raise HTTPException(status_code=404, detail="Order not found")
@@ -1690,6 +1683,8 @@ def cancel_order(order_id: int, db: Session = Depends(get_db)):
         
         released_items = []
         inventory_restored = []
+        batch = InventoryMutationService.batch(db, OperationType.ORDINE_ANNULLATO, order_number=order.order_number)
+        batch.prefetch(("TERRA", stock.product_sku) for stock in outgoing_stocks)
         
         for stock in outgoing_stocks:
             released_items.append({
@@ -1698,22 +1693,7 @@ def cancel_order(order_id: int, db: Session = Depends(get_db)):
             })
             
             # NUOVO: Ripristina giacenza in inventario (ipotesi: location TERRA)
-            # Cerca se esiste già giacenza per questo prodotto in TERRA
-            terra_inventory = db.query(models.Inventory).filter(
-                models.Inventory.product_sku == stock.product_sku,
-                models.Inventory.location_name == "TERRA"
-            ).first()
-            
-            if terra_inventory:
-                terra_inventory.quantity += stock.quantity
-            else:
-                # Crea nuovo record inventario in TERRA
-                new_inventory = models.Inventory(
-                    product_sku=stock.product_sku,
-                    location_name="TERRA",
-                    quantity=stock.quantity
-                )
-                db.add(new_inventory)
+            batch.adjust("TERRA", stock.product_sku, stock.quantity)
             
             inventory_restored.append({
                 "product_sku": stock.product_sku,
@@ -1723,6 +1703,8 @@ def cancel_order(order_id: int, db: Session = Depends(get_db)):
             
             # Rimuovi dalla giacenza in uscita
             db.delete(stock)
+
+        batch.apply()
         
         # Annulla l'ordine
         order.is_cancelled = True
@@ -1768,6 +1750,10 @@ def cancel_order(order_id: int, db: Session = Depends(get_db)):
             "inventory_restored": inventory_restored,
             "note": "I prodotti sono stati automaticamente ripristinati in ubicazione TERRA in attesa di riposizionamento manuale da parte degli operatori"
         }
+
+    try:
+        # Giacenza a TERRA versionata: se un'altra operazione la modifica nel frattempo si riprova
+        return run_with_retry(db, apply_cancel)
     except HTTPException:
         # Re-raise HTTPExceptions as-is
         raise
@@ -2234,10 +2220,16 @@ def delete_order_completely(order_id: int, db: Session = Depends(get_db)):
 
 # === ENDPOINT PER PICKING IN TEMPO REALE ===
 
-@router.post("/real-time-picking/scan-product")
+def _scanned_sku(scanned_code: str):
+    """SKU del codice scansionato (prima come SKU, poi come EAN) senza ricaricare il catalogo"""
+    if barcode_resolver.get_product(scanned_code, refresh=False):
+        return scanned_code
+    return barcode_resolver.sku_for_ean(scanned_code, refresh=False)
+
+@router.post("/real-time-picking/scan-product", dependencies=[Depends(get_write_lock)])
 async def scan_product_real_time(
     request_data: dict,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Endpoint per processare la scansione di un prodotto durante il picking in tempo reale.
@@ -2253,185 +2245,184 @@ async def scan_product_real_time(
         if not all([order_id, location_name, scanned_code, expected_sku]):
             raise HTTPException(status_code=400, detail="Missing required parameters")
         
-        # 1. Verifica che l'ordine esista e non sia completato
-        order = db.query(models.Order).filter(
-            models.Order.id == order_id,
-            models.Order.is_completed == False
-        ).first()
+        async def apply_scan():
+            # 1. Verifica che l'ordine esista e non sia completato
+            order = (await db.execute(select(models.Order).where(
+                models.Order.id == order_id,
+                models.Order.is_completed == False
+            ))).scalars().first()
+        
+            if not order:
+                raise HTTPException(status_code=404, detail="Order not found or already completed")
+        
+            # 2. Trova la riga dell'ordine corrispondente
+            order_line = (await db.execute(select(models.OrderLine).where(
+                models.OrderLine.order_id == order_id,
+                models.OrderLine.product_sku == expected_sku
+            ))).scalars().first()
+        
+            if not order_line:
+                # Log errore prodotto non nell'ordine
+                logger = LoggingService(db)
+                logger.log_error(
+                    operation_type=OperationType.PRELIEVO_TEMPO_REALE,
+                    error=f"Product {expected_sku} not found in order {order.order_number}",
+                    operation_category=OperationCategory.PICKING,
+                    product_sku=expected_sku,
+                    file_name=f"ORDER_{order.order_number}",
+                    details={
+                        'order_number': order.order_number,
+                        'expected_sku': expected_sku,
+                        'scanned_code': scanned_code,
+                        'location_name': location_name,
+                        'error_reason': 'product_not_in_order',
+                        'operation_description': f"Errore picking tempo reale ordine {order.order_number}: prodotto {expected_sku} non presente nell'ordine"
+                    },
+                    api_endpoint="/orders/real-time-picking/scan-product"
+                )
+                return {
+                    "success": False,
+                    "message": f"Prodotto {expected_sku} non trovato in questo ordine"
+                }
         
-        if not order:
-            raise HTTPException(status_code=404, detail="Order not found or already completed")
+            # 3. Controlla se c'è ancora quantità da prelevare
+            remaining_to_pick = order_line.requested_quantity - order_line.picked_quantity
+            if remaining_to_pick <= 0:
+                return {
+                    "success": False,
+                    "message": f"Prodotto {expected_sku} già completamente prelevato"
+                }
         
-        # 2. Trova la riga dell'ordine corrispondente
-        order_line = db.query(models.OrderLine).filter(
-            models.OrderLine.order_id == order_id,
-            models.OrderLine.product_sku == expected_sku
-        ).first()
+            # 4. Validazione barcode: controlla se è un EAN code o direttamente lo SKU
+            await barcode_resolver.ensure_loaded_async(db)
+        
+            # Prima prova a vedere se il codice scansionato è direttamente lo SKU, altrimenti cerca negli EAN codes
+            # Un codice non trovato ricarica il catalogo (senza bloccare il loop) e si riprova
+            product_sku = _scanned_sku(scanned_code)
+            if not product_sku and await barcode_resolver.reload_on_miss_async(db):
+                product_sku = _scanned_sku(scanned_code)
+        
+            if not product_sku:
+                # Log errore barcode non riconosciuto
+                logger = LoggingService(db)
+                logger.log_error(
+                    operation_type=OperationType.PRELIEVO_TEMPO_REALE,
+                    error=f"Barcode '{scanned_code}' not recognized",
+                    operation_category=OperationCategory.PICKING,
+                    product_sku=expected_sku,
+                    location_from=location_name,
+                    file_name=f"ORDER_{order.order_number}",
+                    details={
+                        'order_number': order.order_number,
+                        'expected_sku': expected_sku,
+                        'scanned_code': scanned_code,
+                        'location_name': location_name,
+                        'error_reason': 'barcode_not_recognized',
+                        'operation_description': f"Errore picking tempo reale ordine {order.order_number}: barcode '{scanned_code}' non riconosciuto"
+                    },
+                    api_endpoint="/orders/real-time-picking/scan-product"
+                )
+                return {
+                    "success": False,
+                    "message": f"Codice scansionato '{scanned_code}' non riconosciuto"
+                }
         
-        if not order_line:
-            # Log errore prodotto non nell'ordine
-            logger = LoggingService(db)
-            logger.log_error(
-                operation_type=OperationType.PRELIEVO_TEMPO_REALE,
-                error=f"Product {expected_sku} not found in order {order.order_number}",
-                operation_category=OperationCategory.PICKING,
-                product_sku=expected_sku,
-                file_name=f"ORDER_{order.order_number}",
-                details={
-                    'order_number': order.order_number,
-                    'expected_sku': expected_sku,
-                    'scanned_code': scanned_code,
-                    'location_name': location_name,
-                    'error_reason': 'product_not_in_order',
-                    'operation_description': f"Errore picking tempo reale ordine {order.order_number}: prodotto {expected_sku} non presente nell'ordine"
-                },
-                api_endpoint="/orders/real-time-picking/scan-product"
-            )
-            return {
-                "success": False,
-                "message": f"Prodotto {expected_sku} non trovato in questo ordine"
-            }
+            # 5. Verifica che il prodotto scansionato corrisponda a quello richiesto
+            if product_sku != expected_sku:
+                return {
+                    "success": False,
+                    "message": f"Prodotto errato! Richiesto: {expected_sku}, Scansionato: {product_sku}"
+                }
         
-        # 3. Controlla se c'è ancora quantità da prelevare
-        remaining_to_pick = order_line.requested_quantity - order_line.picked_quantity
-        if remaining_to_pick <= 0:
-            return {
-                "success": False,
-                "message": f"Prodotto {expected_sku} già completamente prelevato"
-            }
+            def pick(session: Session):
+                batch = InventoryMutationService.batch(
+                    session, OperationType.PRELIEVO_TEMPO_REALE, order_number=order.order_number
+                )
+                # 6. Verifica disponibilità nella specifica ubicazione
+                available = batch.quantity(location_name, product_sku)
+                if available <= 0:
+                    return None
+                # 7. Determina la quantità effettiva da prelevare
+                # 8-9. Scala la giacenza in tempo reale (riga eliminata se l'ubicazione rimane vuota)
+                result = batch.adjust(location_name, product_sku, -min(quantity, available, remaining_to_pick))
+                batch.apply()
+                return result
+
+            result = await db.run_sync(pick)
+            if result is None:
+                return {
+                    "success": False,
+                    "message": f"Prodotto {product_sku} non disponibile nell'ubicazione {location_name}"
+                }
+            actual_quantity = -result.quantity
         
-        # 4. Validazione barcode: controlla se è un EAN code o direttamente lo SKU
-        product_sku = None
+            # 10. Aggiorna la quantità prelevata nell'ordine
+            order_line.picked_quantity += actual_quantity
         
-        # Prima prova a vedere se il codice scansionato è direttamente lo SKU
-        product = db.query(models.Product).filter(models.Product.sku == scanned_code).first()
-        if product:
-            product_sku = product.sku
-        else:
-            # Altrimenti cerca negli EAN codes
-            ean_code = db.query(models.EanCode).filter(models.EanCode.ean == scanned_code).first()
-            if ean_code:
-                product_sku = ean_code.product_sku
+            # 11. Sposta in OutgoingStock (come nel picking manuale)
+            outgoing_item = (await db.execute(select(models.OutgoingStock).where(
+                models.OutgoingStock.order_line_id == order_line.id,
+                models.OutgoingStock.product_sku == product_sku
+            ))).scalars().first()
+
+            if outgoing_item:
+                outgoing_item.quantity += actual_quantity
+            else:
+                new_outgoing_item = models.OutgoingStock(
+                    order_line_id=order_line.id,
+                    product_sku=product_sku,
+                    quantity=actual_quantity
+                )
+                db.add(new_outgoing_item)
         
-        if not product_sku:
-            # Log errore barcode non riconosciuto
+            # 12. LOGGING: Registra l'operazione di picking in tempo reale
             logger = LoggingService(db)
-            logger.log_error(
+            logger.log_operation(
                 operation_type=OperationType.PRELIEVO_TEMPO_REALE,
-                error=f"Barcode '{scanned_code}' not recognized",
                 operation_category=OperationCategory.PICKING,
-                product_sku=expected_sku,
+                status=OperationStatus.SUCCESS,
+                product_sku=product_sku,
                 location_from=location_name,
-                file_name=f"ORDER_{order.order_number}",
+                location_to=None,  # Picking: scala da inventario
+                quantity=actual_quantity,
+                user_id="realtime_picker",  # TODO: Sostituire con sistema auth reale
                 details={
                     'order_number': order.order_number,
-                    'expected_sku': expected_sku,
+                    'order_id': order_id,
                     'scanned_code': scanned_code,
-                    'location_name': location_name,
-                    'error_reason': 'barcode_not_recognized',
-                    'operation_description': f"Errore picking tempo reale ordine {order.order_number}: barcode '{scanned_code}' non riconosciuto"
+                    'expected_sku': expected_sku,
+                    'operation_description': f"Picking tempo reale: {product_sku} ({actual_quantity} pz) da {location_name} per ordine {order.order_number}",
+                    'picking_type': 'real_time_picking',
+                    'barcode_validation': 'passed',
+                    'customer_name': order.customer_name,
+                    'remaining_in_location': result.new_quantity,
+                    'remaining_to_pick': order_line.requested_quantity - order_line.picked_quantity - actual_quantity
                 },
                 api_endpoint="/orders/real-time-picking/scan-product"
             )
-            return {
-                "success": False,
-                "message": f"Codice scansionato '{scanned_code}' non riconosciuto"
-            }
         
-        # 5. Verifica che il prodotto scansionato corrisponda a quello richiesto
-        if product_sku != expected_sku:
-            return {
-                "success": False,
-                "message": f"Prodotto errato! Richiesto: {expected_sku}, Scansionato: {product_sku}"
-            }
-        
-        # 6. Verifica disponibilità nella specifica ubicazione
-        inventory_item = db.query(models.Inventory).filter(
-            models.Inventory.product_sku == product_sku,
-            models.Inventory.location_name == location_name,
-            models.Inventory.quantity > 0
-        ).first()
+            # 13. Commit delle modifiche
+            await db.commit()
         
-        if not inventory_item:
+            # 14. Prepara la risposta di successo
             return {
-                "success": False,
-                "message": f"Prodotto {product_sku} non disponibile nell'ubicazione {location_name}"
+                "success": True,
+                "message": f"Prodotto prelevato con successo",
+                "product_sku": product_sku,
+                "location_name": location_name,
+                "quantity_picked": actual_quantity,
+                "remaining_in_location": result.new_quantity,
+                "remaining_to_pick": order_line.requested_quantity - order_line.picked_quantity,
+                "order_line_completed": (order_line.requested_quantity - order_line.picked_quantity) <= 0
             }
-        
-        # 7. Determina la quantità effettiva da prelevare
-        actual_quantity = min(quantity, inventory_item.quantity, remaining_to_pick)
-        
-        # 8. Scala la giacenza in tempo reale
-        inventory_item.quantity -= actual_quantity
-        
-        # 9. Se l'ubicazione rimane vuota, elimina il record di inventario
-        if inventory_item.quantity <= 0:
-            db.delete(inventory_item)
-        
-        # 10. Aggiorna la quantità prelevata nell'ordine
-        order_line.picked_quantity += actual_quantity
-        
-        # 11. Sposta in OutgoingStock (come nel picking manuale)
-        outgoing_item = db.query(models.OutgoingStock).filter(
-            models.OutgoingStock.order_line_id == order_line.id,
-            models.OutgoingStock.product_sku == product_sku
-        ).first()
 
-        if outgoing_item:
-            outgoing_item.quantity += actual_quantity
-        else:
-            new_outgoing_item = models.OutgoingStock(
-                order_line_id=order_line.id,
-                product_sku=product_sku,
-                quantity=actual_quantity
-            )
-            db.add(new_outgoing_item)
-        
-        # 12. LOGGING: Registra l'operazione di picking in tempo reale
-        logger = LoggingService(db)
-        logger.log_operation(
-            operation_type=OperationType.PRELIEVO_TEMPO_REALE,
-            operation_category=OperationCategory.PICKING,
-            status=OperationStatus.SUCCESS,
-            product_sku=product_sku,
-            location_from=location_name,
-            location_to=None,  # Picking: scala da inventario
-            quantity=actual_quantity,
-            user_id="realtime_picker",  # TODO: Sostituire con sistema auth reale
-            details={
-                'order_number': order.order_number,
-                'order_id': order_id,
-                'scanned_code': scanned_code,
-                'expected_sku': expected_sku,
-                'operation_description': f"Picking tempo reale: {product_sku} ({actual_quantity} pz) da {location_name} per ordine {order.order_number}",
-                'picking_type': 'real_time_picking',
-                'barcode_validation': 'passed',
-                'customer_name': order.customer_name,
-                'remaining_in_location': inventory_item.quantity if inventory_item.quantity > 0 else 0,
-                'remaining_to_pick': order_line.requested_quantity - order_line.picked_quantity - actual_quantity
-            },
-            api_endpoint="/orders/real-time-picking/scan-product"
-        )
-        
-        # 13. Commit delle modifiche
-        db.commit()
-        
-        # 14. Prepara la risposta di successo
-        return {
-            "success": True,
-            "message": f"Prodotto prelevato con successo",
-            "product_sku": product_sku,
-            "location_name": location_name,
-            "quantity_picked": actual_quantity,
-            "remaining_in_location": inventory_item.quantity if inventory_item.quantity > 0 else 0,
-            "remaining_to_pick": order_line.requested_quantity - order_line.picked_quantity,
-            "order_line_completed": (order_line.requested_quantity - order_line.picked_quantity) <= 0
-        }
+        # Due palmari sulla stessa ubicazione o riga ordine: chi trova la versione cambiata rilegge e riprova
+        return await run_with_retry_async(db, apply_scan)
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error processing real-time picking: {str(e)}")
 
 # === ENDPOINT IMPORT ORDINI DA EXCEL ===
@@ -2987,15 +2978,38 @@ def get_order_pickup_locations(
         if not order:
             raise HTTPException(status_code=404, detail=f"Ordine '{order_number}' non trovato")
         
-        # Recupera i log di prelievo per questo ordine
+        pickup_types = [
+            OperationType.PRELIEVO_MANUALE,
+            OperationType.PRELIEVO_FILE,
+            OperationType.PRELIEVO_TEMPO_REALE,
+            OperationType.PICKING_CONFERMATO
+        ]
+
+        # Prelievi dal registro dei movimenti (scansione sull'indice per numero ordine)
+        pickup_movements = StockLedgerService.order_pickups(db, order_number, pickup_types)
+        if pickup_movements:
+            pickup_details = [
+                {
+                    'product_sku': movement.product_sku,
+                    'location_from': movement.location_from,
+                    'quantity_picked': movement.quantity,
+                    'timestamp': movement.timestamp.strftime('%d/%m/%Y %H:%M'),
+                    'operator': movement.user_id or 'Sistema',
+                    'operation_type': movement.reason,
+                    'details': None
+                }
+                for movement in pickup_movements
+            ]
+            return {
+                "order_number": order_number,
+                "pickup_locations": pickup_details,
+                "total_operations": len(pickup_details)
+            }
+
+        # Ordini prelevati prima del registro: log di prelievo
         logger = LoggingService(db)
         pickup_logs = logger.get_logs(
-            operation_types=[
-                OperationType.PRELIEVO_MANUALE,
-                OperationType.PRELIEVO_FILE,
-                OperationType.PRELIEVO_TEMPO_REALE,
-                OperationType.PICKING_CONFERMATO
-            ],
+            operation_types=pickup_types,
             order_number=order_number,
             limit=1000,  # Recupera tutti i log di prelievo
             order_by="timestamp",
@@ -6,9 +6,11 @@ import io
 
 from wms_app import models
 from wms_app.schemas import products as product_schemas # Aggiornato l'alias
-from wms_app.database import database, get_db
+from wms_app.database import database, get_db, get_read_db
 from wms_app.routers.auth import require_permission
 from wms_app.services.logging_service import LoggingService
+from wms_app.services.barcode_resolver import barcode_resolver
+from wms_app.services.upload_reader import iter_upload_lines
 
 router = APIRouter(
     prefix="/products",
@@ -52,6 +54,7 @@ def create_product(product: product_schemas.ProductCreate, db: Session = Depends
                 db.add(new_ean)
                 
         db.commit()
+        barcode_resolver.bump_version()
         db.refresh(new_product)
         return new_product
         
@@ -134,7 +137,7 @@ def validate_product_deletion(sku: str, db: Session = Depends(database.get_db)):
 @router.get("/{sku}/history")
 def get_product_history(
     sku: str,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user = Depends(require_permission("products_view")),
     page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=1, le=500),
@@ -252,16 +255,15 @@ def get_product(sku: str, db: Session = Depends(database.get_db)):
 
 @router.post("/import-ean-txt")
 async def import_products_ean_from_txt(file: UploadFile = File(...), db: Session = Depends(database.get_db)):
-    content = await file.read()
-    text_content = content.decode("utf-8")
-    
     imported_count = 0
     processed_skus = set()
     processed_eans = set()  # Traccia EAN già processati in questo import
     duplicate_eans = []     # Lista EAN duplicati per report
     error_count = 0
 
-    for line_num, line in enumerate(text_content.splitlines(), 1):
+    line_num = 0
+    async for line in iter_upload_lines(file):
+        line_num += 1
         if not line.strip():
             continue
         parts = line.split(',')
@@ -339,6 +341,7 @@ async def import_products_ean_from_txt(file: UploadFile = File(...), db: Session
             continue
 
     db.commit()
+    barcode_resolver.bump_version()
     
     # Prepara messaggio di risposta
     message = f"Importati o aggiornati {imported_count} prodotti/EAN."
@@ -393,6 +396,7 @@ def update_product(sku: str, product: product_schemas.ProductCreate, db: Session
                 db.add(new_ean)
 
         db.commit()
+        barcode_resolver.bump_version()
         db.refresh(db_product)
         return db_product
         
@@ -462,6 +466,7 @@ def delete_product(sku: str, db: Session = Depends(database.get_db)):
         
         # 3. Commit delle modifiche
         db.commit()
+        barcode_resolver.bump_version()
         
         return {
             "message": f"Prodotto '{sku}' eliminato con successo",
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, Response
 from sqlalchemy.orm import Session
 from typing import List
@@ -22,6 +23,7 @@ from wms_app.database import get_db
 from wms_app.routers.auth import require_permission
 from wms_app.services.serial_service import SerialService
 from wms_app.services.logging_service import LoggingService
+from wms_app.services.upload_reader import read_upload_tokens
 from wms_app.models.logs import OperationType, OperationCategory, OperationStatus
 
 # Import templates in modo lazy per evitare import circolari
@@ -65,13 +67,12 @@ async def upload_serials_file(
         raise HTTPException(status_code=400, detail="Formato file non supportato. Usare .txt o .csv")
     
     try:
-        # Leggi contenuto file
-        content = await file.read()
-        file_content = content.decode('utf-8')
+        # Leggi le righe del file a blocchi (solo i codici restano in memoria)
+        file_content = await read_upload_tokens(file, "Errore codifica file. Usare codifica UTF-8.")
         
-        # Processa con SerialService
+        # Processa con SerialService nel threadpool (un EAN non trovato può ricaricare il catalogo)
         serial_service = SerialService(db)
-        result = serial_service.parse_serial_file(file_content, uploaded_by, file.filename)
+        result = await run_in_threadpool(serial_service.parse_serial_file, file_content, uploaded_by, file.filename)
         
         if not result.success:
             # Non raise HTTPException, restituisci il result per mostrare gli errori
@@ -79,8 +80,8 @@ async def upload_serials_file(
         
         return result
         
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Errore codifica file. Usare codifica UTF-8.")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore durante il caricamento: {str(e)}")
 
@@ -638,18 +639,17 @@ async def parse_serial_file(
         raise HTTPException(status_code=400, detail="Formato file non supportato. Usare .txt o .csv")
     
     try:
-        # Leggi contenuto file
-        content = await file.read()
-        file_content = content.decode('utf-8')
+        # Leggi le righe del file a blocchi (solo i codici restano in memoria)
+        file_content = await read_upload_tokens(file, "Errore codifica file. Usare codifica UTF-8.")
         
-        # Processa con SerialService (solo parsing, no commit)
+        # Processa con SerialService (solo parsing, no commit) nel threadpool
         serial_service = SerialService(db)
-        result = serial_service.parse_serial_file_with_recap(file_content, file.filename)
+        result = await run_in_threadpool(serial_service.parse_serial_file_with_recap, file_content, file.filename)
         
         return result
         
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="Errore codifica file. Usare codifica UTF-8.")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore durante il parsing: {str(e)}")
 
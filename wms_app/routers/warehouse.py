@@ -4,9 +4,10 @@ from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from typing import List
 
-from sqlalchemy import func
+from sqlalchemy import func, insert, select
 
 from wms_app import models
+from wms_app.models.inventory import LOCATION_KIND_SHELF, parse_location_name
 from wms_app.database import get_db
 from wms_app.routers.auth import require_permission
 from wms_app.main import templates
@@ -31,6 +32,40 @@ class LocationsToDelete(BaseModel):
     locations: List[str]
 
 
+def _bay_letters(bay_start: int, bay_end: int) -> List[str]:
+    # Numero della campata in lettera (1=A, 2=B, etc.)
+    return [chr(ord('A') + bay - 1) for bay in range(bay_start, bay_end + 1)]
+
+
+def _range_location_names(row_start, row_end, bay_start, bay_end, level_start, level_end, position_start, position_end):
+    """Nomi [FILA][CAMPATA][PIANO]P[POSIZIONE] del range, nell'ordine di generazione"""
+    for row in range(row_start, row_end + 1):
+        for bay_letter in _bay_letters(bay_start, bay_end):
+            for level in range(level_start, level_end + 1):
+                for position in range(position_start, position_end + 1):
+                    yield f"{row}{bay_letter}{level}P{position}"
+
+
+def _range_size(row_start, row_end, bay_start, bay_end, level_start, level_end, position_start, position_end) -> int:
+    return (max(0, row_end - row_start + 1) * max(0, bay_end - bay_start + 1)
+            * max(0, level_end - level_start + 1) * max(0, position_end - position_start + 1))
+
+
+def _location_range_filter(row_start, row_end, bay_start, bay_end, level_start, level_end, position_start, position_end):
+    """
+    Condizioni sulle coordinate indicizzate di Location per un range di scaffalatura:
+    BETWEEN su fila/piano/posizione e IN sulle poche lettere di campata, invece di un IN
+    con tutti i nomi del range (che supera il limite di variabili di SQLite)
+    """
+    return [
+        models.Location.kind == LOCATION_KIND_SHELF,
+        models.Location.fila.between(row_start, row_end),
+        models.Location.campata.in_(_bay_letters(bay_start, bay_end)),
+        models.Location.piano.between(level_start, level_end),
+        models.Location.posizione.between(position_start, position_end),
+    ]
+
+
 @router.get("/manage", response_class=HTMLResponse)
 async def get_warehouse_management_page(request: Request, db: Session = Depends(get_db)):
     all_locations = db.query(models.Location).order_by(models.Location.name).all()
@@ -51,12 +86,11 @@ async def get_warehouse_management_page(request: Request, db: Session = Depends(
 
     locations_by_row = {}
     for location in all_locations:
-        import re
-        match = re.match(r'^(\d+)', location.name)
-        if not match:
+        # Fila salvata alla creazione dell'ubicazione (None per i nomi senza numero iniziale)
+        if location.fila is None:
             continue
         
-        row_number = int(match.group(1))
+        row_number = location.fila
         
         if row_number not in locations_by_row:
             locations_by_row[row_number] = []
@@ -113,19 +147,20 @@ async def generate_locations(
     if row_start > row_end or bay_start > bay_end or level_start > level_end or position_start > position_end:
         raise HTTPException(status_code=400, detail="Il valore 'Da' non può essere maggiore del valore 'A'.")
 
-    generated_count = 0
-    for r in range(row_start, row_end + 1):
-        for b in range(bay_start, bay_end + 1):
-            for l in range(level_start, level_end + 1):
-                for p in range(position_start, position_end + 1):
-                    bay_char = chr(ord('A') + b - 1)
-                    location_name = f"{r}{bay_char}{l}P{p}"
-                    
-                    existing_location = db.query(models.Location).filter(models.Location.name == location_name).first()
-                    if not existing_location:
-                        new_location = models.Location(name=location_name)
-                        db.add(new_location)
-                        generated_count += 1
+    bounds = (row_start, row_end, bay_start, bay_end, level_start, level_end, position_start, position_end)
+
+    # Una sola query per le ubicazioni già presenti nel range, poi differenza tra insiemi
+    existing_locations = set(
+        db.execute(select(models.Location.name).where(*_location_range_filter(*bounds))).scalars()
+    )
+    missing_locations = [name for name in _range_location_names(*bounds) if name not in existing_locations]
+
+    # Insert massivo: le coordinate vanno passate esplicitamente (niente validator di Location)
+    if missing_locations:
+        db.execute(insert(models.Location), [
+            {"name": name, "available": True, **parse_location_name(name)} for name in missing_locations
+        ])
+    generated_count = len(missing_locations)
     
     db.commit()
     # TODO: Aggiungere un messaggio flash per notificare l'utente del risultato.
@@ -133,22 +168,19 @@ async def generate_locations(
 
 @router.post("/preview-delete-locations")
 async def preview_delete_locations(range_data: LocationRange, db: Session = Depends(get_db)):
-    locations_to_check = []
-    for r in range(range_data.row_start, range_data.row_end + 1):
-        for b in range(range_data.bay_start, range_data.bay_end + 1):
-            for l in range(range_data.level_start, range_data.level_end + 1):
-                for p in range(range_data.position_start, range_data.position_end + 1):
-                    bay_char = chr(ord('A') + b - 1)
-                    location_name = f"{r}{bay_char}{l}P{p}"
-                    locations_to_check.append(location_name)
+    bounds = (
+        range_data.row_start, range_data.row_end, range_data.bay_start, range_data.bay_end,
+        range_data.level_start, range_data.level_end, range_data.position_start, range_data.position_end
+    )
 
     # Ubicazioni che esistono nel DB in base al range fornito
-    existing_locations_q = db.query(models.Location.name).filter(models.Location.name.in_(locations_to_check)).all()
+    existing_locations_q = db.query(models.Location.name).filter(*_location_range_filter(*bounds)).all()
     existing_locations = {loc[0] for loc in existing_locations_q}
 
     # Ubicazioni occupate in quell'intervallo
     occupied_locations_q = db.query(models.Inventory.location_name)\
-        .filter(models.Inventory.location_name.in_(existing_locations))\
+        .join(models.Location, models.Location.name == models.Inventory.location_name)\
+        .filter(*_location_range_filter(*bounds))\
         .filter(models.Inventory.quantity > 0)\
         .distinct().all()
     occupied_locations = {loc[0] for loc in occupied_locations_q}
@@ -198,24 +230,15 @@ async def set_locations_availability(
     Imposta la disponibilità di un range di ubicazioni.
     available=True per renderle disponibili, False per non disponibili.
     """
-    # Genera la lista delle ubicazioni nel range specificato
-    locations_to_update = []
+    bounds = (row_start, row_end, bay_start, bay_end, level_start, level_end, position_start, position_end)
+    total_specified = _range_size(*bounds)
     
-    for row in range(row_start, row_end + 1):
-        for bay_num in range(bay_start, bay_end + 1):
-            # Converti il numero della campata in lettera (1=A, 2=B, etc.)
-            bay_letter = chr(ord('A') + bay_num - 1)
-            for level in range(level_start, level_end + 1):
-                for position in range(position_start, position_end + 1):
-                    location_name = f"{row}{bay_letter}{level}P{position}"
-                    locations_to_update.append(location_name)
-    
-    if not locations_to_update:
+    if not total_specified:
         raise HTTPException(status_code=400, detail="Nessuna ubicazione trovata nel range specificato.")
     
     # Aggiorna la disponibilità delle ubicazioni esistenti
     updated_count = db.query(models.Location).filter(
-        models.Location.name.in_(locations_to_update)
+        *_location_range_filter(*bounds)
     ).update(
         {"available": available}, 
         synchronize_session=False
@@ -227,7 +250,7 @@ async def set_locations_availability(
     return JSONResponse(content={
         "message": f"{updated_count} ubicazioni rese {status_text}",
         "updated_count": updated_count,
-        "total_specified": len(locations_to_update)
+        "total_specified": total_specified
     })
 
 @router.post("/preview-availability-change")
@@ -235,21 +258,14 @@ async def preview_availability_change(range_data: LocationRange, db: Session = D
     """
     Anteprima delle ubicazioni che verrebbero modificate nella disponibilità
     """
-    # Genera la lista delle ubicazioni nel range specificato
-    locations_in_range = []
-    
-    for row in range(range_data.row_start, range_data.row_end + 1):
-        for bay_num in range(range_data.bay_start, range_data.bay_end + 1):
-            # Converti il numero della campata in lettera (1=A, 2=B, etc.)
-            bay_letter = chr(ord('A') + bay_num - 1)
-            for level in range(range_data.level_start, range_data.level_end + 1):
-                for position in range(range_data.position_start, range_data.position_end + 1):
-                    location_name = f"{row}{bay_letter}{level}P{position}"
-                    locations_in_range.append(location_name)
+    bounds = (
+        range_data.row_start, range_data.row_end, range_data.bay_start, range_data.bay_end,
+        range_data.level_start, range_data.level_end, range_data.position_start, range_data.position_end
+    )
     
-    # Verifica quali di queste ubicazioni esistono nel database
+    # Ubicazioni del range che esistono nel database
     existing_locations_q = db.query(models.Location.name, models.Location.available).filter(
-        models.Location.name.in_(locations_in_range)
+        *_location_range_filter(*bounds)
     ).all()
     
     existing_locations = {loc.name: loc.available for loc in existing_locations_q}
@@ -257,10 +273,10 @@ async def preview_availability_change(range_data: LocationRange, db: Session = D
     # Separa per stato attuale
     available_locations = [name for name, avail in existing_locations.items() if avail]
     unavailable_locations = [name for name, avail in existing_locations.items() if not avail]
-    non_existing_locations = [name for name in locations_in_range if name not in existing_locations]
+    non_existing_locations = [name for name in _range_location_names(*bounds) if name not in existing_locations]
     
     return JSONResponse(content={
-        "total_in_range": len(locations_in_range),
+        "total_in_range": _range_size(*bounds),
         "existing_count": len(existing_locations),
         "available_locations": sorted(available_locations),
         "unavailable_locations": sorted(unavailable_locations),
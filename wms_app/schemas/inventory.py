@@ -79,6 +79,8 @@ class ConsolidationSuggestion(BaseModel):
     to_quantity: int
     combined_quantity: int
     efficiency_gain: str
+    locations_freed: int = 0
+    travel_distance: int = 0  # movimentazioni + distanza tra le ubicazioni (vedi consolidation_planner)
 
 class ConsolidationSuggestionsResponse(BaseModel):
     suggestions: List[ConsolidationSuggestion]
@@ -0,0 +1,101 @@
+"""
+Cache degli utenti autenticati per WMS EPM
+Evita la query su User e la seconda decodifica JWT ad ogni chiamata /api/*:
+per ogni access token si conserva un'istantanea dell'utente (id, stato attivo, ruoli)
+fino alla scadenza del TTL o del token.
+
+La cache è per processo: le modifiche fatte da admin.py la invalidano subito nel
+processo corrente, negli altri worker valgono al più dopo AUTH_USER_CACHE_TTL secondi.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import FrozenSet, Optional, Tuple
+
+from wms_app.models.auth import User
+
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", 60))  # secondi
+AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", 1024))  # token conservati
+
+
+class AuthenticatedUser:
+    """Istantanea immutabile dell'utente autenticato, indipendente dalla sessione database"""
+
+    __slots__ = ("id", "username", "email", "is_active", "roles")
+
+    def __init__(self, id: int, username: str, email: str, is_active: bool, roles: FrozenSet[str]):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.is_active = is_active
+        self.roles = roles
+
+    @classmethod
+    def from_user(cls, user: User) -> "AuthenticatedUser":
+        """Da chiamare con la sessione ancora aperta (carica i ruoli)"""
+        return cls(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            is_active=user.is_active,
+            roles=frozenset(role.name for role in user.roles)
+        )
+
+    def has_role(self, role_name: str) -> bool:
+        return role_name in self.roles
+
+
+class AuthenticatedUserCache:
+    """Cache LRU con TTL: access token -> AuthenticatedUser"""
+
+    def __init__(self, ttl: float = AUTH_USER_CACHE_TTL, max_size: int = AUTH_USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, AuthenticatedUser]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[AuthenticatedUser]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return user
+
+    def set(self, token: str, user: AuthenticatedUser, token_exp: Optional[float] = None):
+        """
+        Memorizza l'utente per il token. token_exp è il claim "exp" (epoch):
+        la voce non sopravvive mai al token.
+        """
+        ttl = self.ttl
+        if token_exp is not None:
+            ttl = min(ttl, token_exp - time.time())
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (time.monotonic() + ttl, user)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        """Rimuove tutti i token di un utente (modifica, disattivazione, cambio ruoli)"""
+        with self._lock:
+            for token in [token for token, (_, user) in self._entries.items() if user.id == user_id]:
+                del self._entries[token]
+
+    def clear(self):
+        """Svuota la cache (modifiche a ruoli o permessi, ripristino backup)"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+authenticated_user_cache = AuthenticatedUserCache()
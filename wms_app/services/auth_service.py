@@ -1,11 +1,13 @@
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
-import hashlib
+from typing import Optional, List, Dict, Any, FrozenSet
 import secrets
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 from wms_app.models.auth import User, Role, Permission, UserSession
 from wms_app.services.jwt_service import JWTService
+from wms_app.services.auth_cache import AuthenticatedUser
+from wms_app.services.permission_registry import permission_registry
+from wms_app.services.password_hasher import password_hasher
 
 # Configurazione migliorata
 ACCESS_TOKEN_EXPIRE_MINUTES = 15  # Token JWT breve per sicurezza
@@ -14,15 +16,23 @@ class AuthService:
     
     @staticmethod
     def verify_password(plain_password: str, hashed_password: str) -> bool:
-        """Verifica se la password è corretta (versione semplificata)"""
-        # Semplice hash SHA256 con salt per ora
-        return hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
+        """Verifica se la password è corretta (bcrypt/scrypt, o SHA-256 legacy)"""
+        return password_hasher.verify(plain_password, hashed_password)
     
     @staticmethod
     def get_password_hash(password: str) -> str:
-        """Genera hash della password (versione semplificata)"""
-        # TODO: Implementare bcrypt quando le dipendenze saranno risolte
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Genera hash della password con il KDF configurato"""
+        return password_hasher.hash(password)
+    
+    @staticmethod
+    def _finish_authentication(db: Session, user: User, valid: bool, new_hash: Optional[str]) -> Optional[User]:
+        if not valid or not user.is_active:
+            return None
+        if new_hash:
+            # Rehash trasparente: hash legacy SHA-256 o parametri del KDF cambiati
+            user.password_hash = new_hash
+            db.commit()
+        return user
     
     @staticmethod
     def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
@@ -30,11 +40,20 @@ class AuthService:
         user = db.query(User).filter(User.username == username).first()
         if not user:
             return None
-        if not AuthService.verify_password(password, user.password_hash):
-            return None
-        if not user.is_active:
+        valid, new_hash = password_hasher.verify_and_update(password, user.password_hash)
+        return AuthService._finish_authentication(db, user, valid, new_hash)
+    
+    @staticmethod
+    async def authenticate_user_async(db: Session, username: str, password: str) -> Optional[User]:
+        """
+        Come authenticate_user, ma il KDF gira nel pool dedicato: da usare negli endpoint async.
+        Solleva PasswordHasherBusy se il pool ha già troppi hash in coda.
+        """
+        user = db.query(User).filter(User.username == username).first()
+        if not user:
             return None
-        return user
+        valid, new_hash = await password_hasher.verify_and_update_async(password, user.password_hash)
+        return AuthService._finish_authentication(db, user, valid, new_hash)
     
     @staticmethod
     def create_tokens(db: Session, user: User) -> Dict[str, str]:
@@ -80,37 +99,50 @@ class AuthService:
         """Ottieni utente dal JWT token"""
         return JWTService.get_user_from_token(db, token)
     
+    @staticmethod
+    def get_user_role_names(user: User) -> FrozenSet[str]:
+        """Nomi dei ruoli di un utente (modello User o istantanea AuthenticatedUser)"""
+        if isinstance(user, AuthenticatedUser):
+            return user.roles
+        return frozenset(role.name for role in user.roles)
+    
+    @staticmethod
+    def get_user_effective_permissions(db: Optional[Session], user: User) -> FrozenSet[str]:
+        """Permessi effettivi dell'utente dalla mappa precompilata ruolo -> permessi"""
+        return permission_registry.permissions_for_roles(AuthService.get_user_role_names(user), db)
+    
     @staticmethod
     def get_user_permissions(db: Session, user: User) -> List[str]:
         """Ottiene tutte le permissions di un utente basate sui suoi ruoli"""
-        permissions = set()
-        for role in user.roles:
-            for permission in role.permissions:
-                permissions.add(permission.name)
-        return list(permissions)
+        return list(AuthService.get_user_effective_permissions(db, user))
     
     @staticmethod
-    def user_has_permission(db: Session, user: User, permission_name: str) -> bool:
+    def user_has_permission(db: Optional[Session], user: User, permission_name: str) -> bool:
         """Controlla se un utente ha un permesso specifico"""
-        user_permissions = AuthService.get_user_permissions(db, user)
-        return permission_name in user_permissions
+        return permission_name in AuthService.get_user_effective_permissions(db, user)
     
     @staticmethod
     def user_has_role(user: User, role_name: str) -> bool:
         """Controlla se un utente ha un ruolo specifico"""
-        return any(role.name == role_name for role in user.roles)
+        return role_name in AuthService.get_user_role_names(user)
     
     @staticmethod
-    def create_user(db: Session, username: str, email: str, password: str, role_names: List[str] = None) -> User:
-        """Crea un nuovo utente"""
-        # Verifica che username e email non esistano già
+    def ensure_user_is_new(db: Session, username: str, email: str):
+        """Verifica che username e email non esistano già (da chiamare prima del KDF)"""
         if db.query(User).filter(User.username == username).first():
             raise HTTPException(status_code=400, detail="Username già esistente")
         if db.query(User).filter(User.email == email).first():
             raise HTTPException(status_code=400, detail="Email già esistente")
+    
+    @staticmethod
+    def create_user(db: Session, username: str, email: str, password: Optional[str], role_names: List[str] = None,
+                    password_hash: Optional[str] = None) -> User:
+        """Crea un nuovo utente (password_hash già calcolato evita il KDF nel chiamante async)"""
+        AuthService.ensure_user_is_new(db, username, email)
         
         # Crea l'utente
-        password_hash = AuthService.get_password_hash(password)
+        if password_hash is None:
+            password_hash = AuthService.get_password_hash(password)
         user = User(
             username=username,
             email=email,
@@ -1,5 +1,4 @@
 import os
-import shutil
 import sqlite3
 import json
 from datetime import datetime, timedelta
@@ -8,6 +7,8 @@ from typing import List, Dict, Any, Optional, Tuple
 import uuid
 import hashlib
 
+from wms_app.database.database import dispose_engines, engine
+from wms_app.database.migrations import get_latest_version, upgrade
 from wms_app.services.logging_service import LoggingService
 from wms_app.models.logs import OperationType, OperationCategory
 
@@ -65,6 +66,33 @@ class BackupService:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         return f"wms_{backup_type}_{timestamp}.db"
     
+    def _copy_database(self, source: Path, destination: Path):
+        """
+        Copia un database SQLite con l'API di backup online (sqlite3.Connection.backup).
+        La copia è un'istantanea coerente anche in modalità WAL con scritture in corso, e
+        quando la destinazione è il database attivo la scrittura passa dai lock di SQLite
+        invece di sovrascrivere il file sotto le connessioni aperte.
+        """
+        source_conn = sqlite3.connect(str(source), timeout=30)
+        try:
+            destination_conn = sqlite3.connect(str(destination), timeout=30)
+            try:
+                source_conn.backup(destination_conn)
+            finally:
+                destination_conn.close()
+        finally:
+            source_conn.close()
+    
+    def _read_schema_version(self, db_path: Path) -> int:
+        """Versione dello schema registrata in un file di database (0 se mai migrato)"""
+        with sqlite3.connect(str(db_path)) as conn:
+            has_table = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+            ).fetchone()
+            if not has_table:
+                return 0
+            return conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    
     def _calculate_file_hash(self, file_path: Path) -> str:
         """
         Calcola hash MD5 del file per verifica integrità.
@@ -177,8 +205,8 @@ class BackupService:
         backup_path = self.manual_dir / filename
         
         try:
-            # Copia database
-            shutil.copy2(str(self.db_path), str(backup_path))
+            # Copia database (istantanea coerente, WAL compreso)
+            self._copy_database(self.db_path, backup_path)
             
             # Verifica integrità
             if not self._validate_database_integrity(backup_path):
@@ -242,7 +270,7 @@ class BackupService:
         backup_path = self.daily_dir / filename
         
         try:
-            shutil.copy2(str(self.db_path), str(backup_path))
+            self._copy_database(self.db_path, backup_path)
             
             if not self._validate_database_integrity(backup_path):
                 backup_path.unlink()
@@ -299,7 +327,7 @@ class BackupService:
         backup_path = self.weekly_dir / filename
         
         try:
-            shutil.copy2(str(self.db_path), str(backup_path))
+            self._copy_database(self.db_path, backup_path)
             
             if not self._validate_database_integrity(backup_path):
                 backup_path.unlink()
@@ -462,22 +490,42 @@ class BackupService:
             safety_backup_path = self.manual_dir / safety_backup_name
             
             if self.db_path.exists():
-                shutil.copy2(str(self.db_path), str(safety_backup_path))
+                self._copy_database(self.db_path, safety_backup_path)
             
             # Verifica integrità backup da ripristinare
             if not self._validate_database_integrity(backup_path):
                 raise Exception("Il backup selezionato è corrotto")
             
-            # Ripristina il database
-            shutil.copy2(str(backup_path), str(self.db_path))
+            # Un backup con schema più recente del codice non è utilizzabile da questa versione
+            backup_schema_version = self._read_schema_version(backup_path)
+            if backup_schema_version > get_latest_version():
+                raise Exception(
+                    f"Il backup è alla versione di schema {backup_schema_version}, "
+                    f"più recente del codice ({get_latest_version()})"
+                )
+            
+            # Ripristina il database: le pagine del backup vengono scritte nel database attivo
+            # (file principale e WAL) senza sovrascriverlo sotto le connessioni del pool
+            self._copy_database(backup_path, self.db_path)
+            dispose_engines()
             
             # Verifica che il ripristino sia andato a buon fine
             if not self._validate_database_integrity(self.db_path):
                 # Ripristina backup di sicurezza se qualcosa è andato storto
                 if safety_backup_path.exists():
-                    shutil.copy2(str(safety_backup_path), str(self.db_path))
+                    self._copy_database(safety_backup_path, self.db_path)
+                    dispose_engines()
                 raise Exception("Errore durante ripristino - database principale ripristinato")
             
+            # I backup precedenti alle ultime migrazioni vanno portati alla versione del codice
+            try:
+                upgrade(engine)
+            except Exception:
+                if safety_backup_path.exists():
+                    self._copy_database(safety_backup_path, self.db_path)
+                    dispose_engines()
+                raise
+            
             if self.logger:
                 self.logger.log_operation(
                     operation_type="BACKUP_RESTORE_SUCCESS",
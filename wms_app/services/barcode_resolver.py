@@ -0,0 +1,245 @@
+"""
+Risoluzione EAN/SKU condivisa da tutti i parser di file e dalle scansioni per WMS EPM
+Il catalogo (prodotti e codici EAN) viene caricato in memoria con due query e tenuto
+come mappe EAN -> SKU e SKU -> prodotto: un file da migliaia di righe non esegue
+nessuna query sul catalogo.
+
+Le mappe si ricaricano quando cambia il contatore di versione (incrementato da
+products.py a ogni creazione, modifica, eliminazione o import di prodotti) e comunque
+dopo BARCODE_RESOLVER_TTL secondi. Il contatore è per processo: un codice creato da un
+altro worker non è ancora nelle mappe, quindi un codice non trovato provoca un
+ricaricamento (al massimo uno ogni BARCODE_RESOLVER_MISS_RELOAD_INTERVAL secondi) prima
+di essere dichiarato sconosciuto.
+"""
+import os
+import threading
+import time
+from typing import Dict, Iterator, Mapping, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from wms_app.models.products import EanCode, Product
+
+BARCODE_RESOLVER_TTL = float(os.getenv("BARCODE_RESOLVER_TTL", 300))  # secondi
+# Intervallo minimo tra due ricaricamenti dovuti a codici non trovati
+BARCODE_RESOLVER_MISS_RELOAD_INTERVAL = float(os.getenv("BARCODE_RESOLVER_MISS_RELOAD_INTERVAL", 5))  # secondi
+
+
+class ProductInfo:
+    """Istantanea immutabile di un prodotto del catalogo, indipendente dalla sessione"""
+
+    __slots__ = ("sku", "description", "estimated_value", "weight", "pallet_quantity")
+
+    def __init__(self, sku: str, description: Optional[str], estimated_value: Optional[float],
+                 weight: Optional[float], pallet_quantity: Optional[int]):
+        self.sku = sku
+        self.description = description
+        self.estimated_value = estimated_value
+        self.weight = weight
+        self.pallet_quantity = pallet_quantity
+
+
+class BarcodeResolver:
+    """Mappe EAN -> SKU e SKU -> prodotto, versionate"""
+
+    _PRODUCT_COLUMNS = (Product.sku, Product.description, Product.estimated_value, Product.weight, Product.pallet_quantity)
+
+    def __init__(self, ttl: float = BARCODE_RESOLVER_TTL,
+                 miss_reload_interval: float = BARCODE_RESOLVER_MISS_RELOAD_INTERVAL):
+        self.ttl = ttl
+        self.miss_reload_interval = miss_reload_interval
+        self._version = 0
+        self._loaded_version = -1
+        self._loaded_at = 0.0
+        self._miss_reload_at = 0.0
+        self._products: Dict[str, ProductInfo] = {}
+        self._ean_to_sku: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bump_version(self):
+        """Segnala che il catalogo è cambiato: le mappe verranno ricaricate al prossimo uso"""
+        with self._lock:
+            self._version += 1
+
+    def _is_stale(self) -> bool:
+        return self._loaded_version != self._version or time.monotonic() - self._loaded_at > self.ttl
+
+    def _install(self, version: int, product_rows, ean_rows):
+        products = {row[0]: ProductInfo(*row) for row in product_rows}
+        ean_to_sku = {ean: sku for ean, sku in ean_rows if sku}
+        with self._lock:
+            self._products = products
+            self._ean_to_sku = ean_to_sku
+            self._loaded_version = version
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self, db: Optional[Session] = None):
+        """Ricarica le mappe se obsolete; senza sessione ne apre una dedicata"""
+        if self._is_stale():
+            self._reload(db)
+
+    def _reload(self, db: Optional[Session] = None):
+        if db is None:
+            from wms_app.database.database import SessionLocal
+            own_db = SessionLocal()
+            try:
+                self._reload(own_db)
+            finally:
+                own_db.close()
+            return
+        version = self._version
+        product_rows = db.execute(select(*self._PRODUCT_COLUMNS)).all()
+        ean_rows = db.execute(select(EanCode.ean, EanCode.product_sku)).all()
+        self._install(version, product_rows, ean_rows)
+
+    async def ensure_loaded_async(self, db: AsyncSession):
+        """Come ensure_loaded, per gli endpoint che usano AsyncSession"""
+        if self._is_stale():
+            await self._reload_async(db)
+
+    async def _reload_async(self, db: AsyncSession):
+        version = self._version
+        product_rows = (await db.execute(select(*self._PRODUCT_COLUMNS))).all()
+        ean_rows = (await db.execute(select(EanCode.ean, EanCode.product_sku))).all()
+        self._install(version, product_rows, ean_rows)
+
+    def _miss_reload_due(self, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return now - max(self._loaded_at, self._miss_reload_at) >= self.miss_reload_interval
+
+    def _can_reload_on_miss(self) -> bool:
+        # Il primo thread che trova un codice mancante prenota il ricaricamento: gli altri
+        # mancati dello stesso intervallo (es. i seriali di un file) non ne avviano altri
+        now = time.monotonic()
+        with self._lock:
+            if not self._miss_reload_due(now):
+                return False
+            self._miss_reload_at = now
+            return True
+
+    def reload_on_miss(self, db: Optional[Session] = None) -> bool:
+        """
+        Dopo un codice non trovato ricarica le mappe (il codice può essere stato creato da
+        un altro worker), se l'ultimo caricamento è più vecchio dell'intervallo minimo.
+        Restituisce True se ha ricaricato: la ricerca va ripetuta.
+        """
+        if not self._can_reload_on_miss():
+            return False
+        self._reload(db)
+        return True
+
+    async def reload_on_miss_async(self, db: AsyncSession) -> bool:
+        """Come reload_on_miss, per gli endpoint che usano AsyncSession"""
+        if not self._can_reload_on_miss():
+            return False
+        await self._reload_async(db)
+        return True
+
+    async def _reload_on_miss_threadpool(self) -> bool:
+        # Controllo senza lock prima di passare al threadpool: nell'intervallo minimo un codice
+        # mancante costa solo un confronto
+        if not self._miss_reload_due():
+            return False
+        return await run_in_threadpool(self.reload_on_miss)
+
+    # Le letture non ricaricano per obsolescenza (chi elabora un file chiama ensure_loaded una
+    # volta all'inizio); con refresh=True un codice non trovato tenta reload_on_miss con una
+    # sessione dedicata. Gli endpoint async non ricaricano mai sull'event loop: con AsyncSession
+    # passano refresh=False e usano reload_on_miss_async, con Session sincrona usano le varianti
+    # *_async qui sotto, che eseguono reload_on_miss nel threadpool.
+
+    def sku_for_ean(self, ean: str, refresh: bool = True) -> Optional[str]:
+        sku = self._ean_to_sku.get(ean)
+        if sku is None and refresh and self.reload_on_miss():
+            sku = self._ean_to_sku.get(ean)
+        return sku
+
+    def get_product(self, sku: str, refresh: bool = True) -> Optional[ProductInfo]:
+        product = self._products.get(sku)
+        if product is None and refresh and self.reload_on_miss():
+            product = self._products.get(sku)
+        return product
+
+    def _resolve(self, code: str) -> Optional[ProductInfo]:
+        sku = self._ean_to_sku.get(code)
+        if sku is not None:
+            return self._products.get(sku)
+        return self._products.get(code)
+
+    def resolve(self, code: str, refresh: bool = True) -> Optional[ProductInfo]:
+        """Prodotto per un codice letto (prima come EAN, poi come SKU)"""
+        product = self._resolve(code)
+        if product is None and refresh and self.reload_on_miss():
+            product = self._resolve(code)
+        return product
+
+    def resolve_sku(self, code: str, refresh: bool = True) -> Optional[str]:
+        """SKU per un codice letto (prima come EAN, poi come SKU)"""
+        product = self.resolve(code, refresh)
+        return product.sku if product is not None else None
+
+    async def sku_for_ean_async(self, ean: str) -> Optional[str]:
+        sku = self.sku_for_ean(ean, refresh=False)
+        if sku is None and await self._reload_on_miss_threadpool():
+            sku = self.sku_for_ean(ean, refresh=False)
+        return sku
+
+    async def get_product_async(self, sku: str) -> Optional[ProductInfo]:
+        product = self.get_product(sku, refresh=False)
+        if product is None and await self._reload_on_miss_threadpool():
+            product = self.get_product(sku, refresh=False)
+        return product
+
+    async def resolve_async(self, code: str) -> Optional[ProductInfo]:
+        product = self._resolve(code)
+        if product is None and await self._reload_on_miss_threadpool():
+            product = self._resolve(code)
+        return product
+
+    async def resolve_sku_async(self, code: str) -> Optional[str]:
+        product = await self.resolve_async(code)
+        return product.sku if product is not None else None
+
+    def ean_lookup(self) -> Mapping[str, str]:
+        """Vista EAN -> SKU che su un EAN non trovato tenta reload_on_miss (per i parser)"""
+        return _EanLookup(self)
+
+    def ean_map(self) -> Mapping[str, str]:
+        """Mappa EAN -> SKU corrente (da non modificare)"""
+        return self._ean_to_sku
+
+    def products(self) -> Mapping[str, ProductInfo]:
+        """Mappa SKU -> prodotto corrente (da non modificare)"""
+        return self._products
+
+
+class _EanLookup(Mapping):
+    """Mappa EAN -> SKU sempre allineata all'ultimo caricamento del resolver"""
+
+    def __init__(self, resolver: BarcodeResolver):
+        self._resolver = resolver
+
+    def __getitem__(self, ean: str) -> str:
+        sku = self._resolver.sku_for_ean(ean)
+        if sku is None:
+            raise KeyError(ean)
+        return sku
+
+    def __contains__(self, ean) -> bool:
+        return self._resolver.sku_for_ean(ean) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._resolver.ean_map())
+
+    def __len__(self) -> int:
+        return len(self._resolver.ean_map())
+
+
+barcode_resolver = BarcodeResolver()
@@ -0,0 +1,260 @@
+"""
+Pianificatore dei consolidamenti di ubicazioni per WMS EPM
+Per ogni SKU pallettizzato le giacenze sparse su più ubicazioni (TERRA esclusa) sono un
+problema di bin packing: le ubicazioni sono oggetti di peso pari alla quantità, i pallet
+contenitori di capacità pallet_quantity. Ogni contenitore della soluzione resta in una delle
+sue ubicazioni (la più piena) e le altre vi vengono spostate: le ubicazioni liberate sono
+n - contenitori.
+
+- first-fit decreasing seguito da passate di miglioramento che provano a svuotare i
+  contenitori meno pieni ridistribuendone il contenuto negli altri;
+- se il risultato supera il limite inferiore ceil(totale / pallet_quantity) e
+  n <= CONSOLIDATION_EXACT_LIMIT, programmazione dinamica sui sottoinsiemi (ottimo esatto).
+
+Le giacenze di tutti gli SKU arrivano da una sola query; i consolidamenti sono ordinati per
+ubicazioni liberate per unità di percorso (distanza tra le coordinate delle ubicazioni).
+"""
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from wms_app.models.inventory import Inventory, Location
+from wms_app.models.products import Product
+from wms_app.services.location_occupancy import GROUND_LOCATION
+
+# Oltre questo numero di ubicazioni per SKU la DP esatta (2^n stati) non viene tentata
+CONSOLIDATION_EXACT_LIMIT = 10
+
+# Distanza usata quando una delle due ubicazioni non ha coordinate (nomi fuori formato)
+UNKNOWN_DISTANCE = 10
+
+
+class StockSlot:
+    """Giacenza di uno SKU in un'ubicazione, con le coordinate per il calcolo del percorso"""
+    __slots__ = ("location", "quantity", "fila", "campata", "piano", "posizione")
+
+    def __init__(self, location: str, quantity: int, fila: Optional[int] = None, campata: Optional[str] = None,
+                 piano: Optional[int] = None, posizione: Optional[int] = None):
+        self.location = location
+        self.quantity = quantity
+        self.fila = fila
+        self.campata = campata
+        self.piano = piano
+        self.posizione = posizione
+
+    def distance(self, other: "StockSlot") -> int:
+        """Distanza Manhattan su fila, campata, piano e posizione"""
+        coordinates = (self.fila, self.campata, self.piano, self.posizione,
+                       other.fila, other.campata, other.piano, other.posizione)
+        if any(value is None for value in coordinates):
+            return UNKNOWN_DISTANCE
+        return (abs(self.fila - other.fila) + abs(_bay_index(self.campata) - _bay_index(other.campata))
+                + abs(self.piano - other.piano) + abs(self.posizione - other.posizione))
+
+
+class ConsolidationMove:
+    """Un contenitore della soluzione: ubicazioni da svuotare verso l'ubicazione che resta"""
+    __slots__ = ("sku", "pallet_quantity", "target", "sources")
+
+    def __init__(self, sku: str, pallet_quantity: int, target: StockSlot, sources: List[StockSlot]):
+        self.sku = sku
+        self.pallet_quantity = pallet_quantity
+        self.target = target
+        self.sources = sources
+
+    @property
+    def locations_freed(self) -> int:
+        return len(self.sources)
+
+    @property
+    def moved_quantity(self) -> int:
+        return sum(source.quantity for source in self.sources)
+
+    @property
+    def combined_quantity(self) -> int:
+        return self.target.quantity + self.moved_quantity
+
+    @property
+    def travel(self) -> int:
+        """Percorso del consolidamento: una movimentazione più la distanza per ogni origine"""
+        return sum(1 + source.distance(self.target) for source in self.sources)
+
+    @property
+    def score(self) -> float:
+        """Ubicazioni liberate per unità di percorso"""
+        return self.locations_freed / self.travel
+
+
+def _bay_index(campata: str) -> int:
+    # A=1 ... Z=26, AA=27 ...
+    index = 0
+    for letter in campata:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+
+# ---------- bin packing ----------
+
+def _pack_exact(weights: List[int], capacity: int) -> List[List[int]]:
+    """
+    Numero minimo di contenitori con DP sui sottoinsiemi: per ogni insieme di oggetti già
+    sistemati si tiene la coppia (contenitori usati, riempimento dell'ultimo) minima.
+    """
+    count = len(weights)
+    full = (1 << count) - 1
+    # best[mask] = (contenitori, riempimento ultimo), parent[mask] = ultimo oggetto aggiunto
+    best = [None] * (full + 1)
+    parent = [-1] * (full + 1)
+    best[0] = (1, 0)
+    for mask in range(full + 1):
+        state = best[mask]
+        if state is None:
+            continue
+        bins, fill = state
+        for item in range(count):
+            bit = 1 << item
+            if mask & bit:
+                continue
+            weight = weights[item]
+            candidate = (bins, fill + weight) if fill + weight <= capacity else (bins + 1, weight)
+            next_mask = mask | bit
+            if best[next_mask] is None or candidate < best[next_mask]:
+                best[next_mask] = candidate
+                parent[next_mask] = item
+
+    # Ricostruzione: la sequenza degli oggetti si spezza dove si apre un nuovo contenitore
+    order = []
+    mask = full
+    while mask:
+        item = parent[mask]
+        order.append(item)
+        mask ^= 1 << item
+    order.reverse()
+
+    packing: List[List[int]] = []
+    fill = capacity
+    for item in order:
+        if fill + weights[item] > capacity:
+            packing.append([])
+            fill = 0
+        packing[-1].append(item)
+        fill += weights[item]
+    return packing
+
+
+def _pack_ffd(weights: List[int], capacity: int) -> List[List[int]]:
+    """First-fit decreasing con passate di miglioramento"""
+    lower_bound = -(-sum(weights) // capacity)
+    bins: List[List[int]] = []
+    fills: List[int] = []
+    for item in sorted(range(len(weights)), key=lambda index: -weights[index]):
+        for position, fill in enumerate(fills):
+            if fill + weights[item] <= capacity:
+                bins[position].append(item)
+                fills[position] += weights[item]
+                break
+        else:
+            bins.append([item])
+            fills.append(weights[item])
+
+    # Miglioramento: si prova a svuotare un contenitore (dal meno pieno) spostandone gli
+    # oggetti, dal più grande, nel contenitore con meno spazio residuo che li accoglie
+    improved = True
+    while improved and len(bins) > lower_bound:
+        improved = False
+        for position in sorted(range(len(bins)), key=lambda index: fills[index]):
+            residual = {other: capacity - fills[other] for other in range(len(bins)) if other != position}
+            placement = {}
+            for item in sorted(bins[position], key=lambda index: -weights[index]):
+                fitting = [other for other, space in residual.items() if space >= weights[item]]
+                if not fitting:
+                    break
+                destination = min(fitting, key=lambda other: residual[other])
+                residual[destination] -= weights[item]
+                placement[item] = destination
+            else:
+                for item, destination in placement.items():
+                    bins[destination].append(item)
+                    fills[destination] += weights[item]
+                del bins[position]
+                del fills[position]
+                improved = True
+                break
+    return bins
+
+
+def plan_sku_consolidation(sku: str, pallet_quantity: int, slots: List[StockSlot]) -> List[ConsolidationMove]:
+    """Consolidamenti ottimali di uno SKU: un ConsolidationMove per ogni contenitore con più ubicazioni"""
+    # Le ubicazioni già a pallet pieno non possono né ricevere né essere spostate
+    candidates = [slot for slot in slots if 0 < slot.quantity < pallet_quantity]
+    if len(candidates) < 2:
+        return []
+
+    weights = [slot.quantity for slot in candidates]
+    packing = _pack_ffd(weights, pallet_quantity)
+    # Se FFD raggiunge il limite inferiore è già ottima: la DP serve solo negli altri casi
+    lower_bound = -(-sum(weights) // pallet_quantity)
+    if len(packing) > lower_bound and len(candidates) <= CONSOLIDATION_EXACT_LIMIT:
+        packing = _pack_exact(weights, pallet_quantity)
+
+    moves = []
+    for bin_items in packing:
+        if len(bin_items) < 2:
+            continue
+        members = [candidates[item] for item in bin_items]
+        # Resta l'ubicazione più piena (meno pezzi da spostare); a parità la più vicina alle altre
+        target = min(members, key=lambda slot: (
+            -slot.quantity, sum(other.distance(slot) for other in members), slot.location
+        ))
+        sources = sorted((slot for slot in members if slot is not target), key=lambda slot: (slot.quantity, slot.location))
+        moves.append(ConsolidationMove(sku, pallet_quantity, target, sources))
+    return moves
+
+
+class ConsolidationPlanner:
+    """Piano dei consolidamenti di tutto il magazzino"""
+
+    @staticmethod
+    def load_candidates(db: Session) -> Dict[str, dict]:
+        """
+        Giacenze (esclusa TERRA) degli SKU pallettizzati presenti in almeno due ubicazioni,
+        con le coordinate delle ubicazioni, in una sola query
+        """
+        multi_location_skus = select(Inventory.product_sku).where(
+            Inventory.quantity > 0,
+            Inventory.location_name != GROUND_LOCATION
+        ).group_by(Inventory.product_sku).having(func.count() > 1)
+
+        rows = db.execute(
+            select(
+                Inventory.product_sku, Product.pallet_quantity, Inventory.location_name, Inventory.quantity,
+                Location.fila, Location.campata, Location.piano, Location.posizione
+            )
+            .join(Product, Product.sku == Inventory.product_sku)
+            .outerjoin(Location, Location.name == Inventory.location_name)
+            .where(
+                Product.pallet_quantity > 0,
+                Inventory.quantity > 0,
+                Inventory.location_name != GROUND_LOCATION,
+                Inventory.product_sku.in_(multi_location_skus)
+            )
+            .order_by(Inventory.product_sku, Inventory.quantity.desc(), Inventory.location_name)
+        )
+
+        candidates: Dict[str, dict] = defaultdict(lambda: {"pallet_quantity": 0, "slots": []})
+        for sku, pallet_quantity, location_name, quantity, fila, campata, piano, posizione in rows:
+            entry = candidates[sku]
+            entry["pallet_quantity"] = pallet_quantity
+            entry["slots"].append(StockSlot(location_name, quantity, fila, campata, piano, posizione))
+        return candidates
+
+    @staticmethod
+    def plan(db: Session) -> List[ConsolidationMove]:
+        """Consolidamenti di tutti gli SKU, dal più conveniente (ubicazioni liberate per percorso)"""
+        moves = []
+        for sku, entry in ConsolidationPlanner.load_candidates(db).items():
+            moves.extend(plan_sku_consolidation(sku, entry["pallet_quantity"], entry["slots"]))
+        moves.sort(key=lambda move: (-move.score, -move.locations_freed, move.sku, move.target.location))
+        return moves
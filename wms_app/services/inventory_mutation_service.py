@@ -0,0 +1,385 @@
+"""
+Variazioni di giacenza per WMS EPM
+Carico, scarico, spostamento, scarico container, ubicazione da terra, riallineamento e
+prelievo passano tutti da qui invece di reimplementare ciascuno "trova o crea la riga,
+modificala, eliminala a zero, rendi disponibile l'ubicazione".
+
+Un MutationBatch raccoglie variazioni tipizzate (adjust, set, move) per una causale:
+- le righe interessate si leggono con una sola query (prefetch / prefetch_locations) e
+  ogni variazione viene valutata subito su uno stato di lavoro in memoria, con esito per
+  variazione (applicata, giacenza insufficiente, conflitto di ubicazione);
+- apply() scrive le differenze nette con statement in blocco: UPDATE e DELETE versionati
+  ("... WHERE id = ? AND version = ?", vedi optimistic_lock), INSERT delle righe nuove,
+  un UPDATE della disponibilità delle ubicazioni che ricevono merce; su PostgreSQL ogni
+  blocco è un solo statement (UPDATE ... FROM VALUES, DELETE ... USING VALUES, INSERT
+  multiplo) con RETURNING id, perché psycopg2 non riporta il rowcount di executemany;
+- il registro dei movimenti e l'indice di occupazione vengono alimentati esplicitamente,
+  una volta per batch.
+
+Se una riga letta nel prefetch è stata modificata da un'altra transazione apply() solleva
+StaleDataError: gli endpoint eseguono batch e commit dentro run_with_retry.
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Integer, bindparam, column, delete, insert, select, tuple_, update, values
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
+
+from wms_app.models.inventory import Inventory, Location
+from wms_app.services.location_occupancy import GROUND_LOCATION, mark_locations_touched
+from wms_app.services.stock_ledger import record_deltas, set_ledger_context
+
+# Chiavi (ubicazione, SKU) per statement: sotto il limite di variabili di SQLite
+BULK_CHUNK_SIZE = 500
+
+InventoryKey = Tuple[str, str]
+
+
+def _chunks(items: list, size: int = BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def dialect_insert(db: Session):
+    """insert() con supporto ON CONFLICT per il dialetto della sessione (None se non supportato)"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+class DeltaResult:
+    """Esito di una variazione: quantità prima e dopo, o il motivo del rifiuto"""
+
+    APPLIED = "applied"
+    INSUFFICIENT = "insufficient"
+    CONFLICT = "conflict"
+
+    __slots__ = ("location", "sku", "quantity", "status", "previous_quantity", "new_quantity",
+                 "conflicting_sku", "conflicting_quantity")
+
+    def __init__(self, location: str, sku: str, quantity: int, status: str, previous_quantity: int,
+                 new_quantity: int, conflict: Optional[Tuple[str, int]] = None):
+        self.location = location
+        self.sku = sku
+        self.quantity = quantity
+        self.status = status
+        self.previous_quantity = previous_quantity
+        self.new_quantity = new_quantity
+        self.conflicting_sku, self.conflicting_quantity = conflict or (None, None)
+
+    @property
+    def ok(self) -> bool:
+        return self.status == self.APPLIED
+
+
+class _StoredRow:
+    __slots__ = ("id", "quantity", "version")
+
+    def __init__(self, row_id: int, quantity: int, version: int):
+        self.id = row_id
+        self.quantity = quantity
+        self.version = version
+
+
+class MutationBatch:
+    """
+    Variazioni di giacenza di una causale, valutate in memoria e scritte in blocco.
+    Non esegue il commit; apply() va chiamato una sola volta.
+    """
+
+    def __init__(self, db: Session, reason: str, order_number: Optional[str] = None,
+                 mark_available: bool = True):
+        self.db = db
+        self.mark_available = mark_available
+        set_ledger_context(db, reason, order_number=order_number)
+        self._stored: Dict[InventoryKey, Optional[_StoredRow]] = {}
+        self._working: Dict[InventoryKey, int] = {}
+        self._skus_by_location: Dict[str, "OrderedDict[str, None]"] = {}
+        self._loaded_locations = set()
+        self._touched: "OrderedDict[InventoryKey, None]" = OrderedDict()
+        self._applied = False
+
+    # ---------- lettura ----------
+
+    def _store(self, location_name: str, product_sku: str, row: Optional[_StoredRow]):
+        key = (location_name, product_sku)
+        if key in self._stored:
+            return
+        self._stored[key] = row
+        self._working[key] = row.quantity if row else 0
+        self._skus_by_location.setdefault(location_name, OrderedDict())[product_sku] = None
+
+    def _load(self, condition):
+        query = select(
+            Inventory.id, Inventory.location_name, Inventory.product_sku, Inventory.quantity, Inventory.version
+        ).where(condition).order_by(Inventory.id)
+        for row_id, location_name, product_sku, quantity, version in self.db.execute(query):
+            self._store(location_name, product_sku, _StoredRow(row_id, quantity or 0, version))
+
+    def prefetch(self, keys: Iterable[InventoryKey]):
+        """Legge in blocco le righe (ubicazione, SKU) non ancora note al batch"""
+        missing = list(OrderedDict.fromkeys(key for key in keys if key not in self._stored))
+        # Le ubicazioni già lette per intero non hanno altre righe
+        to_load = [key for key in missing if key[0] not in self._loaded_locations]
+        for chunk in _chunks(to_load):
+            self._load(tuple_(Inventory.location_name, Inventory.product_sku).in_(chunk))
+        for location_name, product_sku in missing:
+            self._store(location_name, product_sku, None)
+
+    def _lock_locations(self, locations: List[str]):
+        """
+        Su PostgreSQL blocca le righe locations prima di leggerne il contenuto: due transazioni
+        non possono vedere la stessa ubicazione libera e caricarvi SKU diversi. SQLite non serve:
+        una transazione che ha letto prima del commit di un'altra non può più scrivere.
+        """
+        if self.db.get_bind().dialect.name == "sqlite":
+            return
+        # TERRA accetta SKU multipli: nessun lock; ordine fisso per evitare deadlock
+        to_lock = sorted(location for location in locations if location != GROUND_LOCATION)
+        for chunk in _chunks(to_lock):
+            self.db.execute(select(Location.name).where(Location.name.in_(chunk)).order_by(Location.name).with_for_update())
+
+    def prefetch_locations(self, locations: Iterable[str]):
+        """Legge in blocco tutte le righe delle ubicazioni indicate"""
+        missing = [location for location in OrderedDict.fromkeys(locations) if location not in self._loaded_locations]
+        self._lock_locations(missing)
+        for chunk in _chunks(missing):
+            self._load(Inventory.location_name.in_(chunk))
+        self._loaded_locations.update(missing)
+
+    def quantity(self, location: str, sku: str) -> int:
+        """Giacenza della coppia tenendo conto delle variazioni già accettate dal batch"""
+        self.prefetch([(location, sku)])
+        return self._working[(location, sku)]
+
+    def stocked_skus(self, location: str) -> List[Tuple[str, int]]:
+        """(SKU, quantità) con giacenza positiva nell'ubicazione, nell'ordine delle righe"""
+        self.prefetch_locations([location])
+        return [
+            (sku, self._working[(location, sku)])
+            for sku in self._skus_by_location.get(location, ())
+            if self._working[(location, sku)] > 0
+        ]
+
+    def conflicting_sku(self, location: str, sku: str) -> Optional[Tuple[str, int]]:
+        """
+        Primo altro SKU con giacenza nell'ubicazione (None se libera o se è TERRA). Le righe
+        dell'ubicazione si leggono sempre dal database (una query IN, nessuna se già lette
+        con prefetch_locations): l'indice di occupazione è per processo e può essere indietro.
+        """
+        if location == GROUND_LOCATION:
+            return None
+        return next(((stocked_sku, quantity) for stocked_sku, quantity in self.stocked_skus(location)
+                     if stocked_sku != sku), None)
+
+    # ---------- variazioni ----------
+
+    def adjust(self, location: str, sku: str, quantity: int, check_conflict: bool = False,
+               allow_negative: bool = False) -> DeltaResult:
+        """
+        Somma quantity (anche negativa) alla giacenza. Rifiutata se la giacenza andrebbe
+        sotto zero o, con check_conflict, se un carico finisce in un'ubicazione occupata
+        da un altro SKU.
+        """
+        if self._applied:
+            raise RuntimeError("MutationBatch già applicato")
+        if check_conflict and quantity > 0 and location != GROUND_LOCATION:
+            # Una sola lettura dell'ubicazione per giacenza e conflitto
+            self.prefetch_locations([location])
+        previous = self.quantity(location, sku)
+        new = previous + quantity
+        if check_conflict and quantity > 0:
+            conflict = self.conflicting_sku(location, sku)
+            if conflict:
+                return DeltaResult(location, sku, quantity, DeltaResult.CONFLICT, previous, previous, conflict)
+        if new < 0 and not allow_negative:
+            return DeltaResult(location, sku, quantity, DeltaResult.INSUFFICIENT, previous, previous)
+        key = (location, sku)
+        self._working[key] = new
+        self._touched[key] = None
+        return DeltaResult(location, sku, quantity, DeltaResult.APPLIED, previous, new)
+
+    def set(self, location: str, sku: str, quantity: int) -> DeltaResult:
+        """Porta la giacenza al valore indicato (0 elimina la riga)"""
+        return self.adjust(location, sku, quantity - self.quantity(location, sku), allow_negative=True)
+
+    def move(self, sku: str, from_location: str, to_location: str, quantity: int,
+             check_conflict: bool = True) -> Tuple[DeltaResult, DeltaResult]:
+        """Sposta quantity pezzi: origine e destinazione vengono applicate entrambe o nessuna"""
+        if check_conflict and to_location != GROUND_LOCATION:
+            self.prefetch_locations([to_location])
+        self.prefetch([(from_location, sku), (to_location, sku)])
+        if check_conflict:
+            conflict = self.conflicting_sku(to_location, sku)
+            if conflict:
+                source_quantity = self.quantity(from_location, sku)
+                destination_quantity = self.quantity(to_location, sku)
+                return (
+                    DeltaResult(from_location, sku, -quantity, DeltaResult.CONFLICT,
+                                source_quantity, source_quantity, conflict),
+                    DeltaResult(to_location, sku, quantity, DeltaResult.CONFLICT,
+                                destination_quantity, destination_quantity, conflict),
+                )
+        source = self.adjust(from_location, sku, -quantity)
+        if not source.ok:
+            destination_quantity = self.quantity(to_location, sku)
+            return source, DeltaResult(to_location, sku, quantity, source.status,
+                                       destination_quantity, destination_quantity)
+        return source, self.adjust(to_location, sku, quantity)
+
+    # ---------- scrittura ----------
+
+    def _execute_checked(self, connection, statement, rows: List[dict]):
+        """Esegue statement versionati e verifica che ogni riga sia stata toccata"""
+        if connection.dialect.supports_sane_multi_rowcount:
+            for chunk in _chunks(rows):
+                if connection.execute(statement, chunk).rowcount != len(chunk):
+                    raise StaleDataError("Giacenza modificata da un'altra transazione")
+        else:
+            for row in rows:
+                if connection.execute(statement, row).rowcount != 1:
+                    raise StaleDataError("Giacenza modificata da un'altra transazione")
+
+    def _execute_returning(self, connection, build_statement, rows: List[dict], id_key: Optional[str] = None):
+        """
+        Variante PostgreSQL: psycopg2 non riporta il rowcount di executemany, quindi ogni blocco
+        è un solo statement con RETURNING id e le righe restituite si confrontano con il blocco
+        (gli id attesi per UPDATE e DELETE, il numero di righe per l'INSERT)
+        """
+        for chunk in _chunks(rows):
+            returned = [row_id for (row_id,) in connection.execute(build_statement(chunk))]
+            if id_key is not None:
+                matched = set(returned) == {row[id_key] for row in chunk}
+            else:
+                matched = len(returned) == len(chunk)
+            if not matched:
+                raise StaleDataError("Giacenza modificata da un'altra transazione")
+
+    @staticmethod
+    def _versioned_rows(chunk: List[dict], with_quantity: bool):
+        """Blocco di righe (id, versione letta[, nuova quantità]) come VALUES da unire alla tabella"""
+        columns = [column("b_id", Integer), column("b_version", Integer)]
+        if with_quantity:
+            columns.append(column("b_quantity", Integer))
+        return values(*columns, name="batch_rows").data(
+            [tuple(row[column_.name] for column_ in columns) for row in chunk]
+        )
+
+    def _write_executemany(self, connection, table, updates: List[dict], deletes: List[dict], inserts: List[dict]):
+        """UPDATE e DELETE versionati e INSERT on-conflict-do-nothing in executemany, verificati col rowcount"""
+        if updates:
+            self._execute_checked(connection, update(table).where(
+                table.c.id == bindparam("b_id"), table.c.version == bindparam("b_version")
+            ).values(quantity=bindparam("b_quantity"), version=table.c.version + 1), updates)
+        if deletes:
+            self._execute_checked(connection, delete(table).where(
+                table.c.id == bindparam("b_id"), table.c.version == bindparam("b_version")
+            ), deletes)
+        if inserts:
+            dialect_insert_fn = dialect_insert(self.db)
+            if dialect_insert_fn is not None:
+                # Riga creata da un'altra transazione dopo il prefetch: nessun inserimento, si riprova
+                self._execute_checked(connection, dialect_insert_fn(table).on_conflict_do_nothing(
+                    index_elements=[table.c.location_name, table.c.product_sku]
+                ), inserts)
+            else:
+                connection.execute(insert(table), inserts)
+
+    def _write_postgresql(self, connection, table, updates: List[dict], deletes: List[dict], inserts: List[dict]):
+        """UPDATE ... FROM (VALUES ...), DELETE ... USING (VALUES ...) e INSERT multiplo, tutti con RETURNING id"""
+        def build_update(chunk):
+            rows = self._versioned_rows(chunk, with_quantity=True)
+            return update(table).where(table.c.id == rows.c.b_id, table.c.version == rows.c.b_version).values(
+                quantity=rows.c.b_quantity, version=table.c.version + 1
+            ).returning(table.c.id)
+
+        def build_delete(chunk):
+            rows = self._versioned_rows(chunk, with_quantity=False)
+            return delete(table).where(
+                table.c.id == rows.c.b_id, table.c.version == rows.c.b_version
+            ).returning(table.c.id)
+
+        def build_insert(chunk):
+            # Riga creata da un'altra transazione dopo il prefetch: nessun inserimento, si riprova
+            return dialect_insert(self.db)(table).values(chunk).on_conflict_do_nothing(
+                index_elements=[table.c.location_name, table.c.product_sku]
+            ).returning(table.c.id)
+
+        if updates:
+            self._execute_returning(connection, build_update, updates, id_key="b_id")
+        if deletes:
+            self._execute_returning(connection, build_delete, deletes, id_key="b_id")
+        if inserts:
+            self._execute_returning(connection, build_insert, inserts)
+
+    def apply(self) -> Dict[InventoryKey, int]:
+        """
+        Scrive le variazioni nette del batch e le accoda al registro dei movimenti.
+        Restituisce {(ubicazione, SKU): variazione}. Non esegue il commit.
+        """
+        if self._applied:
+            raise RuntimeError("MutationBatch già applicato")
+        self._applied = True
+
+        deltas: Dict[InventoryKey, int] = {}
+        updates, deletes, inserts = [], [], []
+        for key in self._touched:
+            stored = self._stored[key]
+            previous = stored.quantity if stored else 0
+            new = self._working[key]
+            if new == previous:
+                continue
+            deltas[key] = new - previous
+            if stored is None:
+                inserts.append({"location_name": key[0], "product_sku": key[1], "quantity": new})
+            elif new == 0:
+                deletes.append({"b_id": stored.id, "b_version": stored.version})
+            else:
+                updates.append({"b_id": stored.id, "b_version": stored.version, "b_quantity": new})
+        if not deltas:
+            return deltas
+
+        # Statement Core sulla connessione: niente hook di sessione, registro e indice sono aggiornati qui sotto
+        table = Inventory.__table__
+        connection = self.db.connection()
+        if connection.dialect.name == "postgresql":
+            self._write_postgresql(connection, table, updates, deletes, inserts)
+        else:
+            self._write_executemany(connection, table, updates, deletes, inserts)
+
+        if self.mark_available:
+            InventoryMutationService.mark_locations_available(
+                self.db, {location for (location, _), delta in deltas.items() if delta > 0}
+            )
+        record_deltas(self.db, deltas)
+        mark_locations_touched(self.db, {location for location, _ in deltas})
+        return deltas
+
+
+class InventoryMutationService:
+    """Punto unico delle scritture di giacenza"""
+
+    @staticmethod
+    def batch(db: Session, reason: str, order_number: Optional[str] = None,
+              mark_available: bool = True) -> MutationBatch:
+        """Nuovo batch di variazioni con la causale (e l'ordine) del registro dei movimenti"""
+        return MutationBatch(db, reason, order_number=order_number, mark_available=mark_available)
+
+    @staticmethod
+    def mark_locations_available(db: Session, location_names: Iterable[str]) -> int:
+        """Rende disponibili le ubicazioni indicate con un solo UPDATE per blocco"""
+        updated = 0
+        for chunk in _chunks(list(set(location_names))):
+            result = db.execute(
+                update(Location.__table__)
+                .where(Location.name.in_(chunk), Location.available.isnot(True))
+                .values(available=True)
+            )
+            updated += result.rowcount or 0
+        return updated
@@ -3,9 +3,12 @@ JWT Service moderno per WMS EPM
 Sistema di autenticazione basato su JWT standard con refresh token
 """
 import jwt
+import hashlib
+import os
 import secrets
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
+from sqlalchemy import delete, select, update
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 from wms_app.models.auth import User, UserSession
@@ -17,6 +20,10 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 15  # Token breve per sicurezza
 REFRESH_TOKEN_EXPIRE_DAYS = 7    # Refresh token più lungo
 
+# Sweep periodico delle sessioni scadute (job APScheduler in main.py)
+REFRESH_TOKEN_SWEEP_MINUTES = int(os.getenv("REFRESH_TOKEN_SWEEP_MINUTES", 60))
+REFRESH_TOKEN_SWEEP_BATCH = int(os.getenv("REFRESH_TOKEN_SWEEP_BATCH", 1000))  # righe per DELETE
+
 class JWTService:
     """Service per gestione JWT moderna e sicura"""
     
@@ -42,26 +49,87 @@ class JWTService:
         encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
         return encoded_jwt
     
+    @staticmethod
+    def hash_refresh_token(refresh_token: str) -> str:
+        """Hash con cui il refresh token viene salvato e cercato (token casuale a 256 bit: basta SHA-256)"""
+        return hashlib.sha256(refresh_token.encode()).hexdigest()
+    
+    @staticmethod
+    def _upsert_session_statement(db: Session, values: Dict[str, Any]):
+        """INSERT ... ON CONFLICT (user_id) DO UPDATE: una sessione per utente in un solo statement"""
+        dialect = db.get_bind().dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return None
+        statement = insert(UserSession).values(**values)
+        return statement.on_conflict_do_update(
+            index_elements=[UserSession.user_id],
+            set_={
+                "token": statement.excluded.token,
+                "expires_at": statement.excluded.expires_at,
+                "created_at": statement.excluded.created_at,
+            }
+        )
+    
     @staticmethod
     def create_refresh_token(db: Session, user_id: int) -> str:
-        """Crea un refresh token e lo salva nel database"""
+        """Crea un refresh token e ne salva l'hash nel database (sostituisce quello precedente)"""
         # Genera token sicuro
         refresh_token = secrets.token_urlsafe(32)
-        expire_time = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+        now = datetime.utcnow()
+        values = {
+            "token": JWTService.hash_refresh_token(refresh_token),
+            "user_id": user_id,
+            "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+            "created_at": now,
+        }
         
-        # Rimuovi vecchi refresh token per questo utente (max 1 per utente)
-        db.query(UserSession).filter(UserSession.user_id == user_id).delete()
+        statement = JWTService._upsert_session_statement(db, values)
+        if statement is not None:
+            db.execute(statement)
+        else:
+            # Dialetti senza upsert: max 1 per utente con delete + insert
+            db.query(UserSession).filter(UserSession.user_id == user_id).delete()
+            db.add(UserSession(**values))
+        db.commit()
         
-        # Salva nuovo refresh token
-        session = UserSession(
-            token=refresh_token,
-            user_id=user_id,
-            expires_at=expire_time
+        return refresh_token
+    
+    @staticmethod
+    def rotate_refresh_token(db: Session, refresh_token: str) -> Optional[tuple]:
+        """
+        Sostituisce un refresh token valido con uno nuovo con un solo UPDATE ... RETURNING.
+        Il vecchio token smette di valere nello stesso statement: due refresh concorrenti
+        con lo stesso token non possono riuscire entrambi.
+        
+        Returns:
+            (user_id, nuovo_refresh_token) oppure None se il token è sconosciuto o scaduto
+        """
+        new_refresh_token = secrets.token_urlsafe(32)
+        now = datetime.utcnow()
+        statement = (
+            update(UserSession)
+            .where(
+                UserSession.token == JWTService.hash_refresh_token(refresh_token),
+                UserSession.expires_at > now
+            )
+            .values(
+                token=JWTService.hash_refresh_token(new_refresh_token),
+                expires_at=now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+                created_at=now
+            )
+            .returning(UserSession.user_id)
+            .execution_options(synchronize_session=False)
         )
-        db.add(session)
+        user_id = db.execute(statement).scalar_one_or_none()
         db.commit()
         
-        return refresh_token
+        if user_id is None:
+            return None
+        return user_id, new_refresh_token
     
     @staticmethod
     def verify_access_token(token: str) -> Optional[Dict[str, Any]]:
@@ -81,26 +149,25 @@ class JWTService:
     
     @staticmethod
     def verify_refresh_token(db: Session, refresh_token: str) -> Optional[User]:
-        """Verifica un refresh token dal database"""
-        session = db.query(UserSession).filter(UserSession.token == refresh_token).first()
-        
-        if not session:
-            return None
+        """Verifica un refresh token dal database (le sessioni scadute le rimuove lo sweep)"""
+        session = db.query(UserSession).filter(
+            UserSession.token == JWTService.hash_refresh_token(refresh_token)
+        ).first()
         
-        # Controlla scadenza
-        if datetime.utcnow() > session.expires_at:
-            # Token scaduto - rimuovilo
-            db.delete(session)
-            db.commit()
+        if not session or datetime.utcnow() > session.expires_at:
             return None
         
         return session.user
     
     @staticmethod
     def refresh_access_token(db: Session, refresh_token: str) -> Optional[Dict[str, str]]:
-        """Genera nuovo access token usando refresh token"""
-        user = JWTService.verify_refresh_token(db, refresh_token)
+        """Genera nuovo access token usando refresh token (ruotato ad ogni utilizzo)"""
+        rotated = JWTService.rotate_refresh_token(db, refresh_token)
+        if not rotated:
+            return None
+        user_id, new_refresh_token = rotated
         
+        user = db.get(User, user_id)
         if not user or not user.is_active:
             return None
         
@@ -113,9 +180,6 @@ class JWTService:
         
         new_access_token = JWTService.create_access_token(access_token_data)
         
-        # Opzionalmente rota il refresh token per maggiore sicurezza
-        new_refresh_token = JWTService.create_refresh_token(db, user.id)
-        
         return {
             "access_token": new_access_token,
             "refresh_token": new_refresh_token,
@@ -125,36 +189,44 @@ class JWTService:
     @staticmethod
     def revoke_refresh_token(db: Session, refresh_token: str) -> bool:
         """Revoca un refresh token (logout)"""
-        session = db.query(UserSession).filter(UserSession.token == refresh_token).first()
-        
-        if session:
-            db.delete(session)
-            db.commit()
-            return True
-        
-        return False
+        result = db.execute(
+            delete(UserSession)
+            .where(UserSession.token == JWTService.hash_refresh_token(refresh_token))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return result.rowcount > 0
     
     @staticmethod
     def revoke_all_user_tokens(db: Session, user_id: int) -> int:
         """Revoca tutti i token di un utente"""
-        count = db.query(UserSession).filter(UserSession.user_id == user_id).count()
-        db.query(UserSession).filter(UserSession.user_id == user_id).delete()
+        result = db.execute(
+            delete(UserSession)
+            .where(UserSession.user_id == user_id)
+            .execution_options(synchronize_session=False)
+        )
         db.commit()
-        return count
+        return result.rowcount
     
     @staticmethod
-    def cleanup_expired_tokens(db: Session) -> int:
-        """Pulisci tutti i token scaduti"""
-        expired_count = db.query(UserSession).filter(
-            UserSession.expires_at < datetime.utcnow()
-        ).count()
-        
-        db.query(UserSession).filter(
-            UserSession.expires_at < datetime.utcnow()
-        ).delete()
-        db.commit()
-        
-        return expired_count
+    def cleanup_expired_tokens(db: Session, batch_size: int = REFRESH_TOKEN_SWEEP_BATCH) -> int:
+        """
+        Pulisci tutti i token scaduti a blocchi di batch_size righe (indice su expires_at):
+        ogni blocco è una transazione breve, così lo sweep non blocca login e refresh
+        """
+        now = datetime.utcnow()
+        total_deleted = 0
+        while True:
+            expired_ids = select(UserSession.id).where(UserSession.expires_at < now).limit(batch_size)
+            result = db.execute(
+                delete(UserSession)
+                .where(UserSession.id.in_(expired_ids))
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            total_deleted += result.rowcount
+            if result.rowcount < batch_size:
+                return total_deleted
     
     @staticmethod
     def get_user_from_token(db: Session, token: str) -> Optional[User]:
@@ -0,0 +1,279 @@
+"""
+Indice di occupazione delle ubicazioni per WMS EPM
+La regola "una ubicazione contiene un solo SKU (eccetto TERRA)" era verificata con una
+query su inventory in ogni punto che carica, sposta o ubica merce. L'indice tiene in
+memoria la mappa ubicazione -> {SKU: quantità} di tutta la tabella inventory: i controlli
+diventano lookup O(1) senza query.
+
+L'indice è mantenuto in write-through dalle sessioni SQLAlchemy: ogni flush che tocca righe
+Inventory annota le ubicazioni coinvolte e, al commit, queste vengono invalidate e
+ricaricate con una query IN al primo uso successivo. InventoryMutationService annota
+esplicitamente le ubicazioni che scrive; gli altri statement Core/bulk sulla tabella (delete
+massivi, ripristino) invalidano l'intero indice. Dopo OCCUPANCY_INDEX_TTL secondi l'indice
+viene comunque ricaricato, così anche gli altri worker e le modifiche fatte fuori
+dall'applicazione vengono recepiti.
+
+Il ricaricamento usa sempre una sessione dedicata e breve: la sessione della richiesta può
+avere una transazione aperta con un'istantanea più vecchia dell'ultimo commit.
+"""
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from wms_app.models.inventory import Inventory
+
+OCCUPANCY_INDEX_TTL = float(os.getenv("OCCUPANCY_INDEX_TTL", 60))  # secondi
+
+# Ubicazione che può contenere più SKU
+GROUND_LOCATION = "TERRA"
+
+# Ubicazioni per query IN (sotto il limite di variabili di SQLite)
+_RELOAD_CHUNK_SIZE = 500
+
+# Chiavi in Session.info con le ubicazioni toccate dalla transazione in corso
+_TOUCHED_KEY = "occupancy_touched_locations"
+_TOUCHED_ALL_KEY = "occupancy_touched_all"
+
+
+def _query_occupancy(db: Session, locations: Optional[List[str]] = None) -> Dict[str, Dict[str, int]]:
+    query = select(Inventory.location_name, Inventory.product_sku, Inventory.quantity)
+    if locations is not None:
+        query = query.where(Inventory.location_name.in_(locations))
+    occupancy: Dict[str, Dict[str, int]] = {}
+    for location_name, product_sku, quantity in db.execute(query):
+        if location_name is None:
+            continue
+        occupancy.setdefault(location_name, {})[product_sku] = quantity or 0
+    return occupancy
+
+
+def _query_locations(db: Session, locations: Iterable[str]) -> Dict[str, Dict[str, int]]:
+    """Occupazione delle ubicazioni indicate, con una query IN per blocco di ubicazioni"""
+    locations = sorted(set(location for location in locations if location))
+    occupancy: Dict[str, Dict[str, int]] = {}
+    for start in range(0, len(locations), _RELOAD_CHUNK_SIZE):
+        occupancy.update(_query_occupancy(db, locations[start:start + _RELOAD_CHUNK_SIZE]))
+    return occupancy
+
+
+class OccupancySnapshot:
+    """Mappa ubicazione -> {SKU: quantità} in sola lettura, con i controlli della regola dello SKU unico"""
+
+    def __init__(self, occupancy: Optional[Dict[str, Dict[str, int]]] = None):
+        self._occupancy: Dict[str, Dict[str, int]] = occupancy or {}
+
+    @classmethod
+    def load(cls, db: Session, locations: Iterable[str]) -> "OccupancySnapshot":
+        """
+        Legge dal database le righe delle sole ubicazioni indicate (query IN a blocchi),
+        per i controlli che non possono basarsi sull'indice, aggiornato solo per processo
+        """
+        return cls(_query_locations(db, locations))
+
+    def contents(self, location: str) -> Mapping[str, int]:
+        """SKU e quantità registrati nell'ubicazione (righe a zero comprese)"""
+        return self._occupancy.get(location, {})
+
+    def quantity(self, location: str, sku: str) -> int:
+        return self._occupancy.get(location, {}).get(sku, 0)
+
+    def stocked_skus(self, location: str) -> List[Tuple[str, int]]:
+        """(SKU, quantità) con giacenza positiva nell'ubicazione, in ordine di SKU"""
+        return sorted(
+            (sku, quantity) for sku, quantity in self._occupancy.get(location, {}).items() if quantity > 0
+        )
+
+    def conflicting_sku(self, location: str, sku: str) -> Optional[Tuple[str, int]]:
+        """Primo altro SKU con giacenza nell'ubicazione (None se libera o se è TERRA)"""
+        if location == GROUND_LOCATION:
+            return None
+        return next(
+            ((stocked_sku, quantity) for stocked_sku, quantity in self.stocked_skus(location) if stocked_sku != sku),
+            None
+        )
+
+
+class LocationOccupancyIndex(OccupancySnapshot):
+    """Mappa ubicazione -> {SKU: quantità}, ricaricata per ubicazione dopo ogni commit"""
+
+    def __init__(self, ttl: float = OCCUPANCY_INDEX_TTL):
+        super().__init__()
+        self.ttl = ttl
+        self._loaded_at = 0.0
+        self._full_reload = True
+        self._dirty_locations: Set[str] = set()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def invalidate(self, locations: Optional[Iterable[str]] = None):
+        """Segnala ubicazioni modificate (None = tutte): verranno ricaricate al prossimo uso"""
+        with self._lock:
+            if locations is None:
+                self._full_reload = True
+            else:
+                self._dirty_locations.update(location for location in locations if location)
+
+    def _is_stale(self) -> bool:
+        return self._full_reload or bool(self._dirty_locations) or time.monotonic() - self._loaded_at > self.ttl
+
+    def ensure_loaded(self):
+        """Ricarica l'indice (tutto o le sole ubicazioni invalidate) se necessario"""
+        if not self._is_stale():
+            return
+        from wms_app.database.database import SessionLocal
+        with self._load_lock:
+            if not self._is_stale():
+                return
+            # Le invalidazioni che arrivano durante il caricamento restano per il giro successivo
+            with self._lock:
+                full_reload = self._full_reload or time.monotonic() - self._loaded_at > self.ttl
+                dirty_locations = self._dirty_locations
+                self._full_reload = False
+                self._dirty_locations = set()
+
+            db = SessionLocal()
+            try:
+                if full_reload:
+                    occupancy = _query_occupancy(db)
+                else:
+                    reloaded = _query_locations(db, dirty_locations)
+            except Exception:
+                self.invalidate(None if full_reload else dirty_locations)
+                raise
+            finally:
+                db.close()
+
+            # Le mappe interne non vengono mai modificate: i lettori vedono sempre uno stato coerente
+            with self._lock:
+                if full_reload:
+                    self._occupancy = occupancy
+                    self._loaded_at = time.monotonic()
+                else:
+                    updated = dict(self._occupancy)
+                    for location in dirty_locations:
+                        if location in reloaded:
+                            updated[location] = reloaded[location]
+                        else:
+                            updated.pop(location, None)
+                    self._occupancy = updated
+
+    async def ensure_loaded_async(self):
+        """Come ensure_loaded, con l'eventuale query nel threadpool (endpoint async)"""
+        if self._is_stale():
+            await run_in_threadpool(self.ensure_loaded)
+
+    # Le letture non ricaricano: chi esegue i controlli chiama ensure_loaded una volta all'inizio.
+    # contents, quantity, stocked_skus e conflicting_sku sono ereditati da OccupancySnapshot.
+
+    def audit(self, db: Session) -> dict:
+        """
+        Confronta l'indice con la tabella inventory e riporta le differenze, più le ubicazioni
+        (diverse da TERRA) che violano già la regola dello SKU unico. Se trova differenze
+        invalida l'indice, che verrà ricostruito al prossimo uso.
+        """
+        self.ensure_loaded()
+        indexed = self._occupancy
+        actual = _query_occupancy(db)
+
+        missing, unexpected, mismatched = [], [], []
+        for location in sorted(set(indexed) | set(actual)):
+            indexed_skus = indexed.get(location, {})
+            actual_skus = actual.get(location, {})
+            for sku in sorted(set(indexed_skus) | set(actual_skus)):
+                if sku not in indexed_skus:
+                    missing.append({"location": location, "sku": sku, "quantity": actual_skus[sku]})
+                elif sku not in actual_skus:
+                    unexpected.append({"location": location, "sku": sku, "quantity": indexed_skus[sku]})
+                elif indexed_skus[sku] != actual_skus[sku]:
+                    mismatched.append({
+                        "location": location, "sku": sku,
+                        "indexed_quantity": indexed_skus[sku], "actual_quantity": actual_skus[sku]
+                    })
+
+        multi_sku_locations = [
+            {"location": location, "skus": sorted(sku for sku, quantity in skus.items() if quantity > 0)}
+            for location, skus in sorted(actual.items())
+            if location != GROUND_LOCATION and sum(1 for quantity in skus.values() if quantity > 0) > 1
+        ]
+
+        consistent = not (missing or unexpected or mismatched)
+        if not consistent:
+            self.invalidate()
+        return {
+            "consistent": consistent,
+            "indexed_locations": len(indexed),
+            "inventory_locations": len(actual),
+            "missing_from_index": missing,
+            "unexpected_in_index": unexpected,
+            "quantity_mismatches": mismatched,
+            "multi_sku_locations": multi_sku_locations,
+            "rebuilt": not consistent,
+        }
+
+
+occupancy_index = LocationOccupancyIndex()
+
+
+# ---------- write-through dalle sessioni ----------
+
+def _touched_locations(session: Session) -> Set[str]:
+    return session.info.setdefault(_TOUCHED_KEY, set())
+
+
+def mark_locations_touched(db, locations: Iterable[str]):
+    """Annota le ubicazioni scritte con statement Core fuori dalla sessione: invalidate al commit"""
+    session = getattr(db, "sync_session", db)
+    _touched_locations(session).update(location for location in locations if location)
+
+
+def _after_flush(session: Session, flush_context):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if not isinstance(instance, Inventory):
+            continue
+        touched = _touched_locations(session)
+        touched.add(instance.location_name)
+        # Una riga spostata di ubicazione cambia anche quella di partenza
+        history = inspect(instance).attrs.location_name.history
+        touched.update(history.deleted or ())
+
+
+def _do_orm_execute(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    # Per gli statement ORM la tabella è una copia annotata: si confronta il nome
+    table = getattr(orm_execute_state.statement, "table", None)
+    if getattr(table, "name", None) == Inventory.__tablename__:
+        orm_execute_state.session.info[_TOUCHED_ALL_KEY] = True
+
+
+def _after_commit(session: Session):
+    touched = session.info.pop(_TOUCHED_KEY, None)
+    if session.info.pop(_TOUCHED_ALL_KEY, False):
+        occupancy_index.invalidate()
+    elif touched:
+        occupancy_index.invalidate(touched)
+
+
+def _after_rollback(session: Session):
+    session.info.pop(_TOUCHED_KEY, None)
+    session.info.pop(_TOUCHED_ALL_KEY, None)
+
+
+_tracking_installed = False
+
+
+def install_occupancy_tracking():
+    """Registra gli hook di sessione che mantengono l'indice (idempotente)"""
+    global _tracking_installed
+    if _tracking_installed:
+        return
+    event.listen(Session, "after_flush", _after_flush)
+    event.listen(Session, "do_orm_execute", _do_orm_execute)
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+    _tracking_installed = True
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, desc, asc
+from sqlalchemy import and_, or_, desc, asc, insert
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any, Union
 import time
@@ -178,23 +178,30 @@ class LoggingService:
         shared_operation_id = str(uuid.uuid4())
         
         try:
-            for i, op in enumerate(operations):
-                self.log_operation(
-                    operation_type=operation_type,
-                    operation_category=operation_category,
-                    status=op.get('status', OperationStatus.SUCCESS),
-                    product_sku=op.get('product_sku'),
-                    location_from=op.get('location_from'),
-                    location_to=op.get('location_to'),
-                    quantity=op.get('quantity'),
-                    user_id=user_id,
-                    file_name=file_name,
-                    file_line_number=op.get('line_number', i + 1),
-                    error_message=op.get('error_message'),
-                    warning_message=op.get('warning_message'),
-                    details=op.get('details'),
-                    operation_id=shared_operation_id
-                )
+            # Un solo INSERT multi-riga (executemany) invece di un oggetto ORM per operazione:
+            # con file da migliaia di righe il flush riga per riga domina il tempo di commit
+            rows = [
+                {
+                    'operation_id': shared_operation_id,
+                    'timestamp': datetime.utcnow(),
+                    'operation_type': operation_type,
+                    'operation_category': operation_category,
+                    'status': op.get('status', OperationStatus.SUCCESS),
+                    'product_sku': op.get('product_sku'),
+                    'location_from': op.get('location_from'),
+                    'location_to': op.get('location_to'),
+                    'quantity': op.get('quantity'),
+                    'user_id': user_id,
+                    'file_name': file_name,
+                    'file_line_number': op.get('line_number', i + 1),
+                    'error_message': op.get('error_message'),
+                    'warning_message': op.get('warning_message'),
+                    'details': op.get('details'),
+                }
+                for i, op in enumerate(operations)
+            ]
+            if rows:
+                self.db.execute(insert(OperationLog.__table__), rows)
             
             return shared_operation_id
             
@@ -0,0 +1,63 @@
+"""
+Concorrenza ottimistica sulle righe Inventory e OrderLine per WMS EPM
+Le due tabelle hanno una colonna version (version_id_col del mapper): ogni UPDATE o
+DELETE dell'ORM diventa "... WHERE id = ? AND version = ?" e incrementa la versione. Se
+un'altra transazione (un secondo palmare, un altro worker) ha modificato la riga dopo la
+lettura, nessuna riga viene toccata e SQLAlchemy solleva StaleDataError invece di
+sovrascrivere la modifica altrui.
+
+run_with_retry / run_with_retry_async rieseguono l'intera unità di lavoro (letture,
+controlli, scritture e commit) in una transazione nuova, fino a OPTIMISTIC_RETRY_ATTEMPTS
+tentativi con un backoff casuale crescente; oltre rispondono 409. L'operazione deve
+rileggere le righe a ogni tentativo: dopo il rollback gli oggetti caricati sono scaduti.
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
+
+OPTIMISTIC_RETRY_ATTEMPTS = int(os.getenv("OPTIMISTIC_RETRY_ATTEMPTS", 5))
+OPTIMISTIC_RETRY_BACKOFF_MS = float(os.getenv("OPTIMISTIC_RETRY_BACKOFF_MS", 20))  # moltiplicato per il tentativo
+
+CONFLICT_DETAIL = "La giacenza è stata modificata da un'altra operazione in corso. Riprova."
+
+T = TypeVar("T")
+
+
+def _backoff_seconds(attempt: int) -> float:
+    # Jitter casuale: i client in conflitto non si ripresentano tutti nello stesso istante
+    return random.uniform(0, OPTIMISTIC_RETRY_BACKOFF_MS * attempt) / 1000
+
+
+def run_with_retry(db: Session, operation: Callable[[], T], attempts: int = OPTIMISTIC_RETRY_ATTEMPTS) -> T:
+    """
+    Esegue operation (che fa il commit) ripetendola se una riga versionata risulta modificata.
+    Sincrona e con attese tra i tentativi: dagli endpoint async va chiamata con run_in_threadpool.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return operation()
+        except StaleDataError:
+            db.rollback()
+            if attempt == attempts:
+                raise HTTPException(status_code=409, detail=CONFLICT_DETAIL)
+            time.sleep(_backoff_seconds(attempt))
+
+
+async def run_with_retry_async(db: AsyncSession, operation: Callable[[], Awaitable[T]],
+                               attempts: int = OPTIMISTIC_RETRY_ATTEMPTS) -> T:
+    """Come run_with_retry, per gli endpoint che usano AsyncSession"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return await operation()
+        except StaleDataError:
+            await db.rollback()
+            if attempt == attempts:
+                raise HTTPException(status_code=409, detail=CONFLICT_DETAIL)
+            await asyncio.sleep(_backoff_seconds(attempt))
@@ -0,0 +1,152 @@
+"""
+Hashing delle password per WMS EPM
+La derivazione della chiave (bcrypt se installato, altrimenti scrypt della libreria
+standard) costa decine di millisecondi di CPU: la versione async la esegue in un pool
+di thread dedicato e limitato, così il login non blocca l'event loop e un picco di
+accessi a inizio turno non satura il server.
+
+Formati riconosciuti in users.password_hash:
+- $2b$...                      bcrypt
+- scrypt$n$r$p$salt$hash       scrypt (salt e hash in base64)
+- 64 caratteri esadecimali     SHA-256 legacy senza salt: accettato e convertito al login
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+try:
+    import bcrypt
+    BCRYPT_AVAILABLE = True
+except ImportError:
+    BCRYPT_AVAILABLE = False
+
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt" if BCRYPT_AVAILABLE else "scrypt").lower()
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+SCRYPT_N = int(os.getenv("SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.getenv("SCRYPT_R", 8))
+SCRYPT_P = int(os.getenv("SCRYPT_P", 1))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 64))  # hash in coda o in corso
+
+if PASSWORD_HASH_SCHEME == "bcrypt" and not BCRYPT_AVAILABLE:
+    PASSWORD_HASH_SCHEME = "scrypt"
+
+_LEGACY_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+class PasswordHasherBusy(Exception):
+    """Troppi hash in coda: il chiamante deve rispondere 503 e far riprovare"""
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, dklen=32,
+        maxmem=128 * r * n * 2  # il default di OpenSSL (32 MB) è troppo stretto per n alti
+    )
+
+
+class PasswordHasher:
+    """Hash, verifica e aggiornamento dei formati delle password"""
+
+    def __init__(
+        self,
+        scheme: str = PASSWORD_HASH_SCHEME,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_MAX_PENDING
+    ):
+        self.scheme = scheme
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None  # creato al primo uso
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    # ---------- operazioni sincrone (CPU) ----------
+
+    def hash(self, password: str) -> str:
+        if self.scheme == "bcrypt":
+            return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("ascii")
+        salt = secrets.token_bytes(16)
+        digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+
+    def verify(self, password: str, hashed: str) -> bool:
+        if not hashed:
+            return False
+        if hashed.startswith("$2"):
+            if not BCRYPT_AVAILABLE:
+                return False
+            return bcrypt.checkpw(password.encode(), hashed.encode("ascii"))
+        if hashed.startswith("scrypt$"):
+            try:
+                _, n, r, p, salt, digest = hashed.split("$")
+                expected = _b64decode(digest)
+                actual = _scrypt(password, _b64decode(salt), int(n), int(r), int(p))
+            except ValueError:
+                return False
+            return hmac.compare_digest(actual, expected)
+        if _LEGACY_SHA256.match(hashed):
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), hashed)
+        return False
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """True se l'hash non è nel formato/costo configurato (SHA-256 legacy compreso)"""
+        if self.scheme == "bcrypt":
+            return not hashed.startswith("$2") or hashed.split("$")[2] != f"{BCRYPT_ROUNDS:02d}"
+        return not hashed.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+    def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """Verifica la password; se corretta e l'hash è obsoleto restituisce anche il nuovo hash"""
+        if not self.verify(password, hashed):
+            return False, None
+        if self.needs_rehash(hashed):
+            return True, self.hash(password)
+        return True, None
+
+    # ---------- versioni async (pool limitato) ----------
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="password-hash"
+                    )
+        return self._executor
+
+    async def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._slots.release()
+
+    async def hash_async(self, password: str) -> str:
+        return await self._run(self.hash, password)
+
+    async def verify_and_update_async(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        return await self._run(self.verify_and_update, password, hashed)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,93 @@
+"""
+Mappa precompilata ruolo -> permessi per WMS EPM
+I controlli require_permission / require_role non percorrono più user.roles -> role.permissions
+con relazioni lazy: la mappa viene caricata con una sola query e i permessi effettivi di
+ogni combinazione di ruoli sono un frozenset (controllo O(1), nessun accesso al database).
+
+La mappa si ricarica quando cambia il contatore di versione (incrementato da admin.py
+quando modifica ruoli o permessi) e comunque dopo PERMISSION_REGISTRY_TTL secondi, così
+anche gli altri worker vedono le modifiche.
+"""
+import os
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, Optional
+
+from sqlalchemy.orm import Session
+
+from wms_app.models.auth import Permission, Role, role_permission_association
+
+PERMISSION_REGISTRY_TTL = float(os.getenv("PERMISSION_REGISTRY_TTL", 60))  # secondi
+
+
+class PermissionRegistry:
+    """Ruoli e permessi compilati in memoria, versionati"""
+
+    def __init__(self, ttl: float = PERMISSION_REGISTRY_TTL):
+        self.ttl = ttl
+        self._version = 0
+        self._loaded_version = -1
+        self._loaded_at = 0.0
+        self._role_permissions: Dict[str, FrozenSet[str]] = {}
+        self._combinations: Dict[FrozenSet[str], FrozenSet[str]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bump_version(self):
+        """Segnala che ruoli o permessi sono cambiati: la mappa verrà ricaricata al prossimo uso"""
+        with self._lock:
+            self._version += 1
+
+    def _is_stale(self) -> bool:
+        return self._loaded_version != self._version or time.monotonic() - self._loaded_at > self.ttl
+
+    def _load(self, db: Session):
+        version = self._version
+        rows = db.query(Role.name, Permission.name).outerjoin(
+            role_permission_association, role_permission_association.c.role_id == Role.id
+        ).outerjoin(
+            Permission, Permission.id == role_permission_association.c.permission_id
+        ).all()
+
+        role_permissions: Dict[str, set] = {}
+        for role_name, permission_name in rows:
+            permissions = role_permissions.setdefault(role_name, set())
+            if permission_name:
+                permissions.add(permission_name)
+
+        with self._lock:
+            self._role_permissions = {role: frozenset(perms) for role, perms in role_permissions.items()}
+            self._combinations = {}
+            self._loaded_version = version
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self, db: Optional[Session] = None):
+        """Ricarica la mappa se obsoleta; senza sessione ne apre una dedicata"""
+        if not self._is_stale():
+            return
+        if db is not None:
+            self._load(db)
+            return
+        from wms_app.database.database import SessionLocal
+        own_db = SessionLocal()
+        try:
+            self._load(own_db)
+        finally:
+            own_db.close()
+
+    def permissions_for_roles(self, role_names: Iterable[str], db: Optional[Session] = None) -> FrozenSet[str]:
+        """Permessi effettivi di un insieme di ruoli (memorizzati per combinazione)"""
+        self.ensure_loaded(db)
+        key = frozenset(role_names)
+        permissions = self._combinations.get(key)
+        if permissions is None:
+            role_permissions = self._role_permissions
+            permissions = frozenset().union(*(role_permissions.get(role, frozenset()) for role in key))
+            self._combinations[key] = permissions
+        return permissions
+
+
+permission_registry = PermissionRegistry()
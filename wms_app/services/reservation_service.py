@@ -2,10 +2,9 @@ from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy import func, and_
-import re
 import math
 
-from wms_app.models.inventory import Inventory
+from wms_app.models.inventory import Inventory, Location, parse_location_name
 from wms_app.models.reservations import InventoryReservation
 from wms_app.models.products import Product
 
@@ -18,31 +17,14 @@ class ReservationService:
         self.db = db
         self.reservation_timeout_hours = 4  # 4 ore come richiesto
     
-    def parse_location(self, location_name: str) -> Dict:
+    @staticmethod
+    def location_info(location_name: str, fila: Optional[int], campata: Optional[str],
+                      piano: Optional[int], posizione: Optional[int]) -> Dict:
         """
-        Parser per ubicazioni formato: [FILA][CAMPATA][PIANO]P[POSIZIONE]
-        Es: 1A1P1 = Fila 1, Campata A, Piano 1, Posizione 1
+        Info strutturali di un'ubicazione a partire dalle coordinate salvate su Location
+        Le ubicazioni fuori formato (es: TERRA) usano il fallback SPECIAL
         """
-        # Pattern: numeri + lettera + numeri + P + numeri
-        pattern = r'^(\d+)([A-Z]+)(\d+)P(\d+)$'
-        match = re.match(pattern, location_name.upper())
-        
-        if match:
-            fila = int(match.group(1))
-            campata = match.group(2)
-            piano = int(match.group(3))
-            posizione = int(match.group(4))
-            
-            return {
-                'fila': fila,
-                'campata': campata,
-                'piano': piano,
-                'posizione': posizione,
-                'is_ground_level': piano == 1,
-                'location_name': location_name
-            }
-        else:
-            # Fallback per ubicazioni speciali (es: TERRA)
+        if piano is None or posizione is None or fila is None or not campata:
             return {
                 'fila': 0,
                 'campata': 'SPECIAL',
@@ -51,6 +33,26 @@ class ReservationService:
                 'is_ground_level': True,
                 'location_name': location_name
             }
+        return {
+            'fila': fila,
+            'campata': campata,
+            'piano': piano,
+            'posizione': posizione,
+            'is_ground_level': piano == 1,
+            'location_name': location_name
+        }
+
+    def parse_location(self, location_name: str) -> Dict:
+        """
+        Parser per ubicazioni formato: [FILA][CAMPATA][PIANO]P[POSIZIONE]
+        Es: 1A1P1 = Fila 1, Campata A, Piano 1, Posizione 1
+        Per le ubicazioni lette dal database usare le colonne di Location (location_info)
+        """
+        coordinates = parse_location_name(location_name)
+        return self.location_info(
+            location_name, coordinates['fila'], coordinates['campata'],
+            coordinates['piano'], coordinates['posizione']
+        )
     
     def calculate_location_priority(self, location: Dict, reference_location: Optional[Dict] = None) -> Tuple:
         """
@@ -92,8 +94,12 @@ class ReservationService:
         Ordina le ubicazioni per efficienza picking ottimizzata
         """
         # Aggiungi informazioni strutturali a ogni ubicazione
+        # (già presenti se le ubicazioni arrivano da get_locations_with_availability)
         enhanced_locations = []
         for loc in locations:
+            if 'piano' in loc:
+                enhanced_locations.append(loc)
+                continue
             parsed = self.parse_location(loc['location_name'])
             enhanced_loc = {**loc, **parsed}
             enhanced_locations.append(enhanced_loc)
@@ -132,11 +138,15 @@ class ReservationService:
         Ottiene tutte le ubicazioni con disponibilità per un prodotto, ordinate per efficienza picking
         Priorità: 1) Prenotazioni attive, 2) Efficienza percorso (piano basso, vicinanza, ecc.)
         """
-        # Trova tutte le ubicazioni con il prodotto
+        # Trova tutte le ubicazioni con il prodotto, con le coordinate strutturate
         locations_query = self.db.query(
             Inventory.location_name,
-            Inventory.quantity.label('physical_quantity')
-        ).filter(
+            Inventory.quantity.label('physical_quantity'),
+            Location.fila,
+            Location.campata,
+            Location.piano,
+            Location.posizione
+        ).outerjoin(Location, Location.name == Inventory.location_name).filter(
             Inventory.product_sku == product_sku,
             Inventory.quantity > 0
         ).all()
@@ -157,8 +167,10 @@ class ReservationService:
         for location in locations_query:
             available_qty = self.get_available_quantity(location.location_name, product_sku)
             if available_qty > 0:
-                # Parse della struttura ubicazione
-                parsed_location = self.parse_location(location.location_name)
+                # Struttura ubicazione dalle colonne di Location
+                parsed_location = self.location_info(
+                    location.location_name, location.fila, location.campata, location.piano, location.posizione
+                )
                 
                 # Verifica se ha la quantità esatta richiesta
                 has_exact_quantity = available_qty == required_quantity
@@ -342,9 +354,10 @@ class ReservationService:
         
         return allocation_results
     
-    def complete_reservation(self, reservation_id: int, actually_picked: int) -> bool:
+    def complete_reservation(self, reservation_id: int, actually_picked: int, commit: bool = True) -> bool:
         """
-        Completa una prenotazione dopo il picking reale
+        Completa una prenotazione dopo il picking reale.
+        commit=False lascia il commit al chiamante (prelievo eseguito in un'unica transazione)
         """
         reservation = self.db.query(InventoryReservation).filter(
             InventoryReservation.id == reservation_id
@@ -360,7 +373,8 @@ class ReservationService:
             difference = reservation.reserved_quantity - actually_picked
             # La differenza viene automaticamente liberata marcando come completed
         
-        self.db.commit()
+        if commit:
+            self.db.commit()
         return True
     
     def cleanup_expired_reservations(self) -> int:
@@ -1,18 +1,19 @@
 import re
 import uuid
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Mapping, Tuple, Optional, Union
 from datetime import datetime
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 
 from wms_app.models.serials import ProductSerial, SerialValidationReport
-from wms_app.models.products import Product, EanCode
+from wms_app.models.products import Product
 from wms_app.models.orders import Order, OrderLine
 from wms_app.schemas.serials import (
     SerialUploadResult, SerialValidationSummary, SerialValidationError,
     OrderSerialsView, SerialParseResult, SerialRecapItem, SerialCommitRequest
 )
 from wms_app.services.logging_service import LoggingService
+from wms_app.services.barcode_resolver import barcode_resolver
 from wms_app.models.logs import OperationType, OperationCategory, OperationStatus
 
 class SerialService:
@@ -25,7 +26,7 @@ class SerialService:
         self.db = db
     
     
-    def parse_serial_file(self, file_content: str, uploaded_by: str = None, file_name: str = None) -> SerialUploadResult:
+    def parse_serial_file(self, file_content: Union[str, List[str]], uploaded_by: str = None, file_name: str = None) -> SerialUploadResult:
         """
         Parser del file seriali con formato scanner: ogni elemento su una riga
         
@@ -41,14 +42,14 @@ class SerialService:
         ...
         
         Args:
-            file_content: Contenuto del file come stringa
+            file_content: Contenuto del file come stringa, o righe già lette dall'upload
             uploaded_by: Utente che ha caricato il file
             
         Returns:
             SerialUploadResult con esito parsing e eventuali errori
         """
         upload_batch_id = str(uuid.uuid4())
-        lines = [line.strip() for line in file_content.strip().split('\n') if line.strip()]
+        lines = self._scanner_lines(file_content)
         
         total_serials_found = 0
         total_orders_found = 0
@@ -237,17 +238,27 @@ class SerialService:
         """Verifica se la stringa è un numero ordine valido (1-10 cifre)"""
         return bool(re.match(r'^\d{1,10}$', order_str))
     
-    def _build_ean_to_sku_map(self) -> Dict[str, str]:
-        """Costruisce mappa EAN -> SKU per performance"""
-        ean_codes = self.db.query(EanCode).all()
-        return {ean.ean: ean.product_sku for ean in ean_codes}
+    @staticmethod
+    def _scanner_lines(file_content: Union[str, List[str]]) -> List[str]:
+        """Righe non vuote del file; accetta anche l'elenco già letto a blocchi con read_upload_tokens"""
+        if isinstance(file_content, str):
+            return [line.strip() for line in file_content.strip().split('\n') if line.strip()]
+        return list(file_content)
+
+    def _build_ean_to_sku_map(self) -> Mapping[str, str]:
+        """
+        Mappa EAN -> SKU dal resolver condiviso (nessuna query se il catalogo è già in memoria);
+        un EAN non trovato ricarica il catalogo prima di trattare la riga come seriale
+        """
+        barcode_resolver.ensure_loaded(self.db)
+        return barcode_resolver.ean_lookup()
     
-    def parse_serial_file_with_recap(self, file_content: str, file_name: str = None) -> SerialParseResult:
+    def parse_serial_file_with_recap(self, file_content: Union[str, List[str]], file_name: str = None) -> SerialParseResult:
         """
         Parser del file seriali per sistema recap modificabile.
         Non esegue commit, restituisce solo il recap per validazione.
         """
-        lines = [line.strip() for line in file_content.strip().split('\n') if line.strip()]
+        lines = self._scanner_lines(file_content)
         
         # Cache per performance
         ean_to_sku_map = self._build_ean_to_sku_map()
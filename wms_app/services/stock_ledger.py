@@ -0,0 +1,354 @@
+"""
+Registro dei movimenti di giacenza (stock_movements) e fotografie notturne per WMS EPM
+Ogni variazione della tabella inventory produce righe tipizzate (SKU, ubicazione di
+partenza e di arrivo, quantità, causale, ordine, lotto) scritte nella stessa transazione
+della modifica: lo storico di un prodotto, di un'ubicazione o di un ordine diventa una
+scansione su indice invece di una ricerca ilike nel JSON di OperationLog.details.
+
+Le variazioni vengono raccolte dagli hook di sessione:
+- flush ORM di righe Inventory (create, modificate, eliminate);
+- DELETE in blocco sulla tabella inventory (righe lette prima della cancellazione);
+- scritture in blocco di InventoryMutationService, che le registra esplicitamente.
+Al commit le variazioni per (ubicazione, SKU) vengono accoppiate per SKU: un calo in
+un'ubicazione e un aumento in un'altra diventano uno spostamento, il resto entrate
+(location_from vuota) o uscite (location_to vuota).
+
+La causale si imposta con set_ledger_context() prima delle modifiche; in sua assenza si
+usa l'endpoint della richiesta (se attiva la strumentazione SQL) o "SISTEMA".
+
+Ogni notte (STOCK_SNAPSHOT_HOUR) viene salvata una fotografia delle giacenze per
+ubicazione: la giacenza a una data è la fotografia precedente più i movimenti successivi.
+"""
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, delete, event, func, insert, inspect, literal, or_, select
+from sqlalchemy.orm import Session
+
+from wms_app.database.instrumentation import endpoint_name, get_request_stats
+from wms_app.models.inventory import Inventory, StockMovement, StockSnapshot
+
+STOCK_SNAPSHOT_HOUR = int(os.getenv("STOCK_SNAPSHOT_HOUR", 1))
+STOCK_SNAPSHOT_RETENTION_DAYS = int(os.getenv("STOCK_SNAPSHOT_RETENTION_DAYS", 90))
+
+# Causale delle modifiche fatte fuori da una richiesta senza contesto (script, scheduler)
+DEFAULT_REASON = "SISTEMA"
+
+# Chiavi in Session.info: contesto corrente e variazioni non ancora registrate
+_CONTEXT_KEY = "stock_ledger_context"
+_PENDING_KEY = "stock_ledger_pending"
+
+InventoryKey = Tuple[str, str]
+
+
+class LedgerContext:
+    """Causale, ordine, lotto e utente dei movimenti registrati dalla sessione"""
+
+    __slots__ = ("reason", "order_number", "batch_id", "user_id")
+
+    def __init__(self, reason: str, order_number: Optional[str] = None,
+                 batch_id: Optional[str] = None, user_id: Optional[str] = None):
+        self.reason = reason
+        self.order_number = order_number
+        self.batch_id = batch_id
+        self.user_id = user_id
+
+
+def _request_user() -> Optional[str]:
+    stats = get_request_stats()
+    state = (stats.scope or {}).get("state") if stats is not None else None
+    user = state.get("current_user") if state else None
+    return getattr(user, "username", None)
+
+
+def _default_context() -> LedgerContext:
+    stats = get_request_stats()
+    endpoint = endpoint_name(stats.scope) if stats is not None else None
+    return LedgerContext((endpoint or DEFAULT_REASON)[:100])
+
+
+def set_ledger_context(db, reason: str, order_number: Optional[str] = None,
+                       batch_id: Optional[str] = None, user_id: Optional[str] = None):
+    """
+    Imposta la causale dei movimenti successivi della sessione (Session o AsyncSession).
+    Con una Session sincrona le modifiche già in sospeso vengono prima scaricate con la
+    causale precedente; con AsyncSession va chiamata prima di modificare le giacenze.
+    """
+    session = getattr(db, "sync_session", db)
+    if isinstance(db, Session) and (session.new or session.dirty or session.deleted):
+        session.flush()
+    session.info[_CONTEXT_KEY] = LedgerContext(reason, order_number, batch_id, user_id or _request_user())
+
+
+def _current_context(session: Session) -> LedgerContext:
+    context = session.info.get(_CONTEXT_KEY)
+    if context is None:
+        context = _default_context()
+        context.user_id = _request_user()
+        session.info[_CONTEXT_KEY] = context
+    return context
+
+
+def record_deltas(db: Session, deltas: Dict[InventoryKey, int]):
+    """Accoda variazioni di giacenza scritte senza passare dagli oggetti ORM"""
+    session = getattr(db, "sync_session", db)
+    context = _current_context(session)
+    pending = session.info.setdefault(_PENDING_KEY, [])
+    if not pending or pending[-1][0] is not context:
+        pending.append((context, defaultdict(int)))
+    buffer = pending[-1][1]
+    for key, delta in deltas.items():
+        if delta:
+            buffer[key] += delta
+
+
+def _movement_rows(context: LedgerContext, deltas: Dict[InventoryKey, int], timestamp: datetime,
+                   batch_id: str) -> List[dict]:
+    """Accoppia per SKU cali e aumenti in spostamenti; il resto sono entrate o uscite"""
+    by_sku: Dict[str, Tuple[list, list]] = defaultdict(lambda: ([], []))
+    for (location, sku), delta in sorted(deltas.items(), key=lambda item: (item[0][1] or "", item[0][0] or "")):
+        if delta < 0:
+            by_sku[sku][0].append([location, -delta])
+        elif delta > 0:
+            by_sku[sku][1].append([location, delta])
+
+    def row(sku, location_from, location_to, quantity):
+        return {
+            "timestamp": timestamp, "product_sku": sku,
+            "location_from": location_from, "location_to": location_to, "quantity": quantity,
+            "reason": context.reason, "order_number": context.order_number,
+            "batch_id": batch_id, "user_id": context.user_id,
+        }
+
+    rows = []
+    for sku, (outgoing, incoming) in by_sku.items():
+        while outgoing and incoming:
+            quantity = min(outgoing[0][1], incoming[0][1])
+            rows.append(row(sku, outgoing[0][0], incoming[0][0], quantity))
+            for side in (outgoing, incoming):
+                side[0][1] -= quantity
+                if not side[0][1]:
+                    side.pop(0)
+        rows.extend(row(sku, location, None, quantity) for location, quantity in outgoing)
+        rows.extend(row(sku, None, location, quantity) for location, quantity in incoming)
+    return rows
+
+
+# ---------- hook di sessione ----------
+
+def _original_value(instance, attribute: str):
+    history = inspect(instance).attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(instance, attribute)
+
+
+def _before_flush(session: Session, flush_context, instances):
+    # Prima del flush: i valori originali delle righe da eliminare sono ancora leggibili
+    deltas: Dict[InventoryKey, int] = defaultdict(int)
+    for instance in session.new:
+        if isinstance(instance, Inventory):
+            deltas[(instance.location_name, instance.product_sku)] += instance.quantity or 0
+    for instance in session.deleted:
+        if isinstance(instance, Inventory):
+            key = (_original_value(instance, "location_name"), _original_value(instance, "product_sku"))
+            deltas[key] -= _original_value(instance, "quantity") or 0
+    for instance in session.dirty:
+        if isinstance(instance, Inventory) and session.is_modified(instance):
+            old_key = (_original_value(instance, "location_name"), _original_value(instance, "product_sku"))
+            deltas[old_key] -= _original_value(instance, "quantity") or 0
+            deltas[(instance.location_name, instance.product_sku)] += instance.quantity or 0
+    if any(deltas.values()):
+        record_deltas(session, deltas)
+
+
+def _do_orm_execute(orm_execute_state):
+    if not orm_execute_state.is_delete:
+        return
+    statement = orm_execute_state.statement
+    table = getattr(statement, "table", None)
+    if getattr(table, "name", None) != Inventory.__tablename__:
+        return
+    # DELETE in blocco: si leggono le righe che verranno cancellate
+    query = select(Inventory.location_name, Inventory.product_sku, Inventory.quantity)
+    if statement.whereclause is not None:
+        query = query.where(statement.whereclause)
+    deltas: Dict[InventoryKey, int] = defaultdict(int)
+    for location_name, product_sku, quantity in orm_execute_state.session.execute(query):
+        deltas[(location_name, product_sku)] -= quantity or 0
+    if any(deltas.values()):
+        record_deltas(orm_execute_state.session, deltas)
+
+
+def _before_commit(session: Session):
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    timestamp = datetime.utcnow()
+    commit_batch_id = str(uuid.uuid4())
+    rows = []
+    for context, deltas in pending:
+        rows.extend(_movement_rows(context, deltas, timestamp, context.batch_id or commit_batch_id))
+    if rows:
+        session.connection().execute(insert(StockMovement.__table__), rows)
+
+
+def _after_rollback(session: Session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+_ledger_installed = False
+
+
+def install_stock_ledger():
+    """Registra gli hook di sessione che alimentano stock_movements (idempotente)"""
+    global _ledger_installed
+    if _ledger_installed:
+        return
+    event.listen(Session, "before_flush", _before_flush)
+    event.listen(Session, "do_orm_execute", _do_orm_execute)
+    event.listen(Session, "before_commit", _before_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+    _ledger_installed = True
+
+
+# ---------- fotografie e interrogazioni ----------
+
+class StockLedgerService:
+    """Fotografie delle giacenze, giacenza a una data e storico dei movimenti"""
+
+    @staticmethod
+    def take_snapshot(db: Session, retention_days: int = STOCK_SNAPSHOT_RETENTION_DAYS) -> dict:
+        """
+        Copia le giacenze non nulle in stock_snapshots con un solo INSERT ... SELECT ed
+        elimina le fotografie più vecchie di retention_days (l'ultima resta sempre).
+        Esegue il commit.
+        """
+        taken_at = datetime.utcnow()
+        last_movement_id = db.execute(select(func.max(StockMovement.id))).scalar() or 0
+        result = db.execute(
+            insert(StockSnapshot.__table__).from_select(
+                ["taken_at", "last_movement_id", "location_name", "product_sku", "quantity"],
+                select(
+                    literal(taken_at), literal(last_movement_id),
+                    Inventory.location_name, Inventory.product_sku, Inventory.quantity
+                ).where(
+                    Inventory.location_name.isnot(None),
+                    Inventory.quantity.isnot(None),
+                    Inventory.quantity != 0
+                )
+            )
+        )
+        pruned = db.execute(
+            delete(StockSnapshot.__table__).where(
+                StockSnapshot.taken_at < taken_at - timedelta(days=retention_days)
+            )
+        ).rowcount or 0
+        db.commit()
+        return {
+            "taken_at": taken_at.isoformat(),
+            "last_movement_id": last_movement_id,
+            "rows": result.rowcount or 0,
+            "pruned_rows": pruned,
+        }
+
+    @staticmethod
+    def stock_at(db: Session, at: datetime, location: Optional[str] = None,
+                 sku: Optional[str] = None) -> Optional[dict]:
+        """
+        Giacenze per (ubicazione, SKU) alla data indicata, filtrabili per ubicazione e SKU.
+        None se non esiste una fotografia anteriore alla data.
+        """
+        base = db.execute(
+            select(StockSnapshot.taken_at, StockSnapshot.last_movement_id)
+            .where(StockSnapshot.taken_at <= at)
+            .order_by(StockSnapshot.taken_at.desc())
+            .limit(1)
+        ).first()
+        if base is None:
+            return None
+
+        snapshot_query = select(
+            StockSnapshot.location_name, StockSnapshot.product_sku, StockSnapshot.quantity
+        ).where(StockSnapshot.taken_at == base.taken_at)
+        movement_query = select(
+            StockMovement.location_from, StockMovement.location_to,
+            StockMovement.product_sku, StockMovement.quantity
+        ).where(StockMovement.id > base.last_movement_id, StockMovement.timestamp <= at)
+        if location:
+            snapshot_query = snapshot_query.where(StockSnapshot.location_name == location)
+            movement_query = movement_query.where(
+                or_(StockMovement.location_from == location, StockMovement.location_to == location)
+            )
+        if sku:
+            snapshot_query = snapshot_query.where(StockSnapshot.product_sku == sku)
+            movement_query = movement_query.where(StockMovement.product_sku == sku)
+
+        stock: Dict[InventoryKey, int] = defaultdict(int)
+        for location_name, product_sku, quantity in db.execute(snapshot_query):
+            stock[(location_name, product_sku)] += quantity
+        for location_from, location_to, product_sku, quantity in db.execute(movement_query):
+            if location_from is not None and (not location or location_from == location):
+                stock[(location_from, product_sku)] -= quantity
+            if location_to is not None and (not location or location_to == location):
+                stock[(location_to, product_sku)] += quantity
+
+        items = [
+            {"location_name": location_name, "product_sku": product_sku, "quantity": quantity}
+            for (location_name, product_sku), quantity in sorted(stock.items())
+            if quantity
+        ]
+        return {
+            "at": at.isoformat(),
+            "snapshot_taken_at": base.taken_at.isoformat(),
+            "items": items,
+            "total_quantity": sum(item["quantity"] for item in items),
+        }
+
+    @staticmethod
+    def movements(db: Session, sku: Optional[str] = None, location: Optional[str] = None,
+                  order_number: Optional[str] = None, reason: Optional[str] = None,
+                  start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                  limit: int = 100, offset: int = 0) -> Tuple[List[StockMovement], int]:
+        """Movimenti filtrati, dal più recente, con il totale per la paginazione"""
+        conditions = []
+        if sku:
+            conditions.append(StockMovement.product_sku == sku)
+        if location:
+            conditions.append(or_(StockMovement.location_from == location, StockMovement.location_to == location))
+        if order_number:
+            conditions.append(StockMovement.order_number == order_number)
+        if reason:
+            conditions.append(StockMovement.reason == reason)
+        if start_date:
+            conditions.append(StockMovement.timestamp >= start_date)
+        if end_date:
+            conditions.append(StockMovement.timestamp <= end_date)
+        where = and_(*conditions) if conditions else None
+
+        count_query = select(func.count(StockMovement.id))
+        query = select(StockMovement).order_by(StockMovement.timestamp.desc(), StockMovement.id.desc())
+        if where is not None:
+            count_query = count_query.where(where)
+            query = query.where(where)
+        total = db.execute(count_query).scalar() or 0
+        rows = db.execute(query.offset(offset).limit(limit)).scalars().all()
+        return rows, total
+
+    @staticmethod
+    def order_pickups(db: Session, order_number: str, reasons: List[str]) -> List[StockMovement]:
+        """Prelievi (uscite con le causali indicate) registrati per un ordine, in ordine cronologico"""
+        return db.execute(
+            select(StockMovement)
+            .where(
+                StockMovement.order_number == order_number,
+                StockMovement.reason.in_(reasons),
+                StockMovement.location_from.isnot(None)
+            )
+            .order_by(StockMovement.id)
+        ).scalars().all()
@@ -0,0 +1,88 @@
+"""
+Lettura incrementale dei file caricati (file scanner, import TXT) per WMS EPM
+UploadFile tiene il corpo in un file temporaneo (su disco oltre 1 MB): invece di
+leggerlo tutto, decodificarlo e spezzarlo con splitlines() - tre copie del file in
+memoria - lo si legge a blocchi di UPLOAD_READ_CHUNK_SIZE byte con un decoder UTF-8
+incrementale (il BOM iniziale viene scartato) e le righe arrivano al parser una alla
+volta. Le righe sono le stesse di str.splitlines(), anche quando un \\r\\n o un carattere
+multibyte cade a cavallo di due blocchi.
+
+Un file non UTF-8 interrompe la lettura alla prima sequenza non valida con un
+HTTPException 400 (messaggio sovrascrivibile da chi chiama).
+"""
+import codecs
+import os
+from typing import AsyncIterator, BinaryIO, Iterator, List
+
+from fastapi import HTTPException, UploadFile
+
+UPLOAD_READ_CHUNK_SIZE = int(os.getenv("UPLOAD_READ_CHUNK_SIZE", 64 * 1024))  # byte
+
+INVALID_UTF8_DETAIL = "Il file non è in formato UTF-8 valido."
+
+
+class _LineSplitter:
+    """Decodifica incrementale e divisione in righe di blocchi di byte"""
+
+    def __init__(self, decode_error_detail: str):
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._pending = ""
+        self._decode_error_detail = decode_error_detail
+
+    def feed(self, data: bytes, final: bool = False) -> List[str]:
+        try:
+            text = self._pending + self._decoder.decode(data, final=final)
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail=self._decode_error_detail)
+        if final:
+            self._pending = ""
+            return text.splitlines()
+        parts = text.splitlines(keepends=True)
+        # L'ultimo pezzo può essere una riga incompleta o un \r il cui \n arriva col blocco dopo
+        self._pending = parts.pop() if parts else ""
+        return "".join(parts).splitlines()
+
+
+async def iter_upload_lines(
+    file: UploadFile,
+    decode_error_detail: str = INVALID_UTF8_DETAIL,
+    chunk_size: int = UPLOAD_READ_CHUNK_SIZE
+) -> AsyncIterator[str]:
+    """Righe del file caricato, lette a blocchi senza caricare tutto il corpo"""
+    splitter = _LineSplitter(decode_error_detail)
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        for line in splitter.feed(chunk):
+            yield line
+    for line in splitter.feed(b"", final=True):
+        yield line
+
+
+def iter_file_lines(
+    binary_file: BinaryIO,
+    decode_error_detail: str = INVALID_UTF8_DETAIL,
+    chunk_size: int = UPLOAD_READ_CHUNK_SIZE
+) -> Iterator[str]:
+    """Come iter_upload_lines su un file binario (UploadFile.file), per i parser eseguiti nel threadpool"""
+    splitter = _LineSplitter(decode_error_detail)
+    while True:
+        chunk = binary_file.read(chunk_size)
+        if not chunk:
+            break
+        yield from splitter.feed(chunk)
+    yield from splitter.feed(b"", final=True)
+
+
+async def read_upload_tokens(file: UploadFile, decode_error_detail: str = INVALID_UTF8_DETAIL) -> List[str]:
+    """
+    Righe non vuote e senza spazi del file caricato, per i formati che richiedono l'elenco
+    completo (coppie origine/destinazione, conteggio righe): in memoria restano solo i codici
+    """
+    tokens = []
+    async for raw_line in iter_upload_lines(file, decode_error_detail):
+        line = raw_line.strip()
+        if line:
+            tokens.append(line)
+    return tokens